@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+"""
+Benchmark of the conversion of a matrix of counts to an R matrix:
+pandas2ri (a data frame converted column by column and then as.matrix())
+versus Rmatrix() (one numeric vector with dimensions).
+The time spent in each method is measured with Rtimer and
+reported with RgetTimings().
+
+    python benchmarks/rconversion.py --spots 5000 --genes 15000 --repeats 3
+"""
+import argparse
+import numpy as np
+import pandas as pd
+import rpy2.robjects as robjects
+from rpy2.robjects import pandas2ri
+from stanalysis.rsession import Rmatrix, Rtimer, RgetTimings, RresetTimings
+
+def pandas2ri_matrix(counts):
+    """ The conversion used before Rmatrix()
+    (data frame to R data.frame and then as.matrix())
+    """
+    try:
+        pandas2ri.activate()
+        r_counts = pandas2ri.py2ri(counts)
+    except AttributeError:
+        # rpy2 >= 3.0
+        from rpy2.robjects.conversion import localconverter
+        with localconverter(robjects.default_converter + pandas2ri.converter):
+            r_counts = robjects.conversion.py2rpy(counts)
+    return robjects.r["as.matrix"](r_counts)
+
+def main(num_spots, num_genes, repeats, density):
+    random = np.random.RandomState(0)
+    values = random.poisson(1.0, size=(num_genes, num_spots)) * (random.rand(num_genes, num_spots) < density)
+    counts = pd.DataFrame(values, index=["gene{}".format(i) for i in range(num_genes)],
+                          columns=["{}x{}".format(i, i) for i in range(num_spots)])
+    timings = dict()
+    for name, function in [("pandas2ri + as.matrix", pandas2ri_matrix), ("Rmatrix", Rmatrix)]:
+        RresetTimings()
+        for _ in range(repeats):
+            with Rtimer("compute"):
+                r_counts = function(counts)
+            assert tuple(robjects.r["dim"](r_counts)) == (num_genes, num_spots)
+        # Rmatrix() records its own conversion time, only the total is compared
+        timings[name] = RgetTimings()["compute"] / repeats
+    print("Matrix of {} genes x {} spots (mean of {} runs)".format(num_genes, num_spots, repeats))
+    for name, seconds in timings.items():
+        print("{:<25}{:.3f} seconds".format(name, seconds))
+    print("Speed-up {:.1f}x".format(timings["pandas2ri + as.matrix"] / timings["Rmatrix"]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--spots", default=2000, type=int, help="The number of spots (default: %(default)s)")
+    parser.add_argument("--genes", default=10000, type=int, help="The number of genes (default: %(default)s)")
+    parser.add_argument("--repeats", default=3, type=int, help="The number of runs (default: %(default)s)")
+    parser.add_argument("--density", default=0.1, type=float,
+                        help="The fraction of non-zero counts (default: %(default)s)")
+    args = parser.parse_args()
+    main(args.spots, args.genes, args.repeats, args.density)
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+"""
+Benchmark of the native t-SNE (stanalysis.analysis.tsne(), methods
+BarnesHut and Exact) versus the R package Rtsne (used before the native
+implementation) with the same parameters.
+For each method the runtime and the quality of the embedding are reported:
+- trustworthiness: how well the local neighborhoods of the embedding
+are preserved from the input space (sklearn.manifold.trustworthiness)
+- knn preservation: mean fraction of the k nearest neighbors of each
+spot in the input space that are also its k nearest neighbors in the embedding
+The input space is the same PCA reduction that t-SNE uses (dims components).
+Rtsne is skipped if R or the Rtsne package are not available.
+
+    python benchmarks/tsne.py --spots 2000 --genes 5000 --repeats 3
+"""
+import argparse
+import time
+import numpy as np
+from sklearn.manifold import trustworthiness
+from sklearn.neighbors import NearestNeighbors
+from stanalysis.analysis import tsne, pca
+from stanalysis.rsession import RimportLibrary, Rmatrix, Rnumpy
+
+def knn_preservation(high, low, k):
+    """ Mean fraction of the k nearest neighbors of each spot in high
+    that are also k nearest neighbors in low
+    """
+    high_neighbors = NearestNeighbors(n_neighbors=k + 1).fit(high).kneighbors(return_distance=False)
+    low_neighbors = NearestNeighbors(n_neighbors=k + 1).fit(low).kneighbors(return_distance=False)
+    return np.mean([len(np.intersect1d(a, b)) / float(k)
+                    for a, b in zip(high_neighbors[:,:k], low_neighbors[:,:k])])
+
+def r_tsne(counts, dimensions, theta, dims, perplexity, max_iter):
+    """ The t-SNE used before the native implementation (Rtsne)
+    """
+    rtsne = RimportLibrary("Rtsne")
+    tsne_out = rtsne.Rtsne(Rmatrix(counts), dims=dimensions, theta=theta,
+                           check_duplicates=False, pca=True, initial_dims=dims,
+                           perplexity=perplexity, max_iter=max_iter, verbose=False)
+    return np.array(Rnumpy(tsne_out.rx2("Y")))
+
+def main(num_spots, num_genes, num_clusters, repeats, dims, perplexity, max_iter, k):
+    # Clusters of spots with different mean expression (log counts)
+    random = np.random.RandomState(0)
+    labels = random.randint(0, num_clusters, size=num_spots)
+    means = random.gamma(0.5, 2.0, size=(num_clusters, num_genes))
+    counts = np.log1p(random.poisson(means[labels]).astype(np.float64))
+    reduced = pca(counts, dims, random_state=0)
+    methods = [("BarnesHut", lambda: tsne(counts, 2, dims=dims, perplexity=perplexity,
+                                          max_iter=max_iter, method="BarnesHut")),
+               ("Exact", lambda: tsne(counts, 2, dims=dims, perplexity=perplexity,
+                                      max_iter=max_iter, method="Exact")),
+               ("Rtsne", lambda: r_tsne(counts, 2, 0.5, dims, perplexity, max_iter))]
+    print("{} spots x {} genes, {} clusters (mean of {} runs)".format(num_spots, num_genes,
+                                                                       num_clusters, repeats))
+    print("{:<12}{:>12}{:>18}{:>18}".format("method", "seconds", "trustworthiness",
+                                             "knn preservation"))
+    for name, function in methods:
+        try:
+            start = time.time()
+            for _ in range(repeats):
+                embedding = function()
+            seconds = (time.time() - start) / repeats
+        except (RuntimeError, ImportError, AttributeError) as e:
+            print("{:<12}skipped ({})".format(name, str(e).strip()))
+            continue
+        print("{:<12}{:>12.3f}{:>18.4f}{:>18.4f}".format(name, seconds,
+                                                        trustworthiness(reduced, embedding, n_neighbors=k),
+                                                        knn_preservation(reduced, embedding, k)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--spots", default=1000, type=int, help="The number of spots (default: %(default)s)")
+    parser.add_argument("--genes", default=2000, type=int, help="The number of genes (default: %(default)s)")
+    parser.add_argument("--clusters", default=5, type=int, help="The number of clusters (default: %(default)s)")
+    parser.add_argument("--repeats", default=1, type=int, help="The number of runs (default: %(default)s)")
+    parser.add_argument("--dims", default=50, type=int,
+                        help="The number of principal components (default: %(default)s)")
+    parser.add_argument("--perplexity", default=30, type=float, help="The perplexity (default: %(default)s)")
+    parser.add_argument("--max-iter", default=1000, type=int,
+                        help="The maximum number of iterations (default: %(default)s)")
+    parser.add_argument("--k", default=10, type=int,
+                        help="The number of neighbors of the quality metrics (default: %(default)s)")
+    args = parser.parse_args()
+    main(args.spots, args.genes, args.clusters, args.repeats, args.dims,
+         args.perplexity, args.max_iter, args.k)
@@ -2,6 +2,8 @@
 """ 
 This script performs Differential Expression Analysis 
 using DESeq2 or Scran + DESeq2 on ST datasets.
+The DEA can also be performed natively (without R) with
+a negative binomial GLM equivalent to DESeq2 (see --engine).
 
 The script can take one or several datasets with the following format:
 
@@ -18,6 +20,11 @@ Each comparison will be performed between datasets and the input should be:
 
 DATASET-DATASET DATASET-DATASET ...
 
+Spots are samples in the DEA by default, with --pseudobulk the counts 
+of the spots of each dataset (or of each region of each dataset, the spot
+names have the format REGION_XxY) are summed and the DEA is performed 
+on these pseudo-bulk samples instead (much faster).
+
 The script will output the list of up-regulated and down-regulated genes
 for each possible DEA comparison (between tables) as well as a set of volcano plots.
 
@@ -28,16 +35,83 @@ NOTE: soon Monocle and edgeR will be added
 import argparse
 import sys
 import os
+import time
+import multiprocessing
 import numpy as np
 import pandas as pd
-from stanalysis.normalization import RimportLibrary
-from stanalysis.preprocessing import compute_size_factors, aggregate_datatasets, remove_noise
+from stanalysis.cache import set_cache_dir
+from stanalysis.rsession import RimportLibrary
+from stanalysis.preprocessing import compute_size_factors, stream_aggregate_datatasets, \
+parse_spots, pseudo_bulk
 from stanalysis.visualization import volcano
 from stanalysis.analysis import deaDESeq2, deaScranDESeq2
+from stanalysis.dea import fitNegativeBinomial, resultsNegativeBinomial
 import matplotlib.pyplot as plt
+
+# Fitted native model (set in each worker process)
+_dea_fit = None
+
+def _init_worker(dea_fit):
+    """ Helper function of process_comparisons() that sets 
+    the fitted native model of the worker process
+    """
+    global _dea_fit
+    _dea_fit = dea_fit
+
+def process_comparison(task):
+    """ Computes the results of one comparison (native engine), filters and 
+    sorts them and writes them to the output folder with a volcano plot.
+    :param task: a tuple with the comparison (A,B), the DEA results (None
+    to compute them from the native model), the FDR and the output folder
+    :return: a tuple with the comparison and the time spent (seconds)
+    """
+    comp, dea_result, fdr, outdir = task
+    start = time.time()
+    if dea_result is None:
+        dea_result = resultsNegativeBinomial(_dea_fit, comp[0], comp[1], alpha=fdr)
+    # Filter results
+    dea_result = dea_result.loc[pd.notnull(dea_result["padj"])]
+    dea_result = dea_result.sort_values(by=["padj"], ascending=True, axis=0)
+    dea_result.to_csv(os.path.join(outdir,
+                                   "dea_results_{}_vs_{}.tsv"
+                                   .format(comp[0], comp[1])), sep="\t")
+    dea_result.loc[dea_result["padj"] <= fdr].to_csv(os.path.join(outdir,
+                                                                 "filtered_dea_results_{}_vs_{}.tsv"
+                                                                 .format(comp[0], comp[1])), sep="\t")
+    # Volcano plot
+    outfile = os.path.join(outdir, "volcano_{}_vs_{}.pdf".format(comp[0], comp[1]))
+    volcano(dea_result, fdr, outfile)
+    return comp, time.time() - start
+
+def process_comparisons(tasks, dea_fit=None, num_workers=None, start_method=None):
+    """ Processes the comparisons (see process_comparison()) in parallel 
+    processes. The fitted native model is passed to each worker
+    when it starts so any start method (fork, spawn, forkserver) works.
+    :param tasks: a list of tasks (see process_comparison())
+    :param dea_fit: the model returned by fitNegativeBinomial() (native engine)
+    :param num_workers: the number of processes (default the number of cores)
+    :param start_method: the multiprocessing start method (default the platform's)
+    :return: a list of tuples with the comparison and the time spent (seconds)
+    """
+    num_workers = multiprocessing.cpu_count() if num_workers is None else max(num_workers, 1)
+    num_workers = min(num_workers, len(tasks))
+    if num_workers > 1:
+        context = multiprocessing.get_context(start_method)
+        pool = context.Pool(num_workers, initializer=_init_worker, initargs=(dea_fit,))
+        try:
+            return pool.map(process_comparison, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    _init_worker(dea_fit)
+    try:
+        return [process_comparison(task) for task in tasks]
+    finally:
+        _init_worker(None)
     
 def main(counts_table_files, conditions, comparisons, outdir, fdr, 
-         normalization, num_exp_spots, num_exp_genes, min_gene_expression):
+         normalization, num_exp_spots, num_exp_genes, min_gene_expression,
+         engine="R", pseudobulk=None, num_workers=None):
 
     if len(counts_table_files) == 0 or \
     any([not os.path.isfile(f) for f in counts_table_files]):
@@ -49,12 +123,11 @@ def main(counts_table_files, conditions, comparisons, outdir, fdr,
         
     print("Output folder {}".format(outdir))
       
-    # Merge input datasets (Spots are rows and genes are columns)
-    counts = aggregate_datatasets(counts_table_files)
-    
-    # Remove noisy spots and genes (Spots are rows and genes are columns)
-    counts = remove_noise(counts, num_exp_genes / 100.0, num_exp_spots / 100.0, 
-                          min_expression=min_gene_expression)
+    # Merge input datasets and remove noisy spots and genes while reading them
+    # (Spots are rows and genes are columns)
+    counts = stream_aggregate_datatasets(counts_table_files, num_exp_genes / 100.0, 
+                                         num_exp_spots / 100.0, 
+                                         min_expression=min_gene_expression)
     
     # Get the comparisons as tuples
     comparisons = [c.split("-") for c in comparisons]
@@ -64,14 +137,26 @@ def main(counts_table_files, conditions, comparisons, outdir, fdr,
     for cond in conditions:
         d, c = cond.split(":")
         conds_repl[d] = c
-    conds = list()
-    for spot in counts.index:
-        index = spot.split("_")[0]
-        try:
-            conds.append(conds_repl[index])
-        except KeyError:
-            counts.drop(spot, axis=0, inplace=True)
-            continue
+    # Spots of datasets without a condition are discarded
+    spot_index = parse_spots(counts.index)
+    spot_conds = pd.Series(spot_index["dataset"].values.astype(str),
+                           index=counts.index).map(conds_repl)
+    keep = spot_conds.notnull().values
+    counts = counts.take(rows=keep)
+    spot_index = spot_index[keep]
+    conds = list(spot_conds.dropna())
+    
+    if pseudobulk is not None:
+        # The spots of each dataset (or region of each dataset) are summed
+        groups = spot_index["dataset"].values.astype(str)
+        if pseudobulk == "region":
+            groups = np.char.add(np.char.add(groups, "_"), spot_index["tag"].values.astype(str))
+        counts = pseudo_bulk(counts, groups)
+        group_conds = dict(zip(groups, conds))
+        conds = [group_conds[group] for group in counts.index]
+        print("Aggregated the spots into {} pseudo-bulk samples".format(len(conds)))
+    else:
+        counts = counts.to_dataframe()
 
     # Write the conditions to a file
     with open("conditions.txt", "w") as filehandler:
@@ -95,8 +180,15 @@ def main(counts_table_files, conditions, comparisons, outdir, fdr,
     counts = counts.transpose()
     
     # DEA call
+    dea_fit = None
     try:
-        if normalization in "DESeq2":
+        if engine == "Native":
+            size_factors = compute_size_factors(counts.transpose(), "Scran", False) \
+                if normalization in "Scran" else None
+            # The results of each comparison are computed by the workers
+            dea_fit = fitNegativeBinomial(counts, conds, size_factors=size_factors)
+            dea_results = [None] * len(comparisons)
+        elif normalization in "DESeq2":
             dea_results = deaDESeq2(counts, conds, comparisons, alpha=fdr, size_factors=None)
         else:
             dea_results = deaScranDESeq2(counts, conds, comparisons, alpha=fdr, scran_clusters=False)
@@ -105,21 +197,13 @@ def main(counts_table_files, conditions, comparisons, outdir, fdr,
         sys.exit(1)
     
     assert(len(comparisons) == len(dea_results))
-    for dea_result, comp in zip(dea_results, comparisons):
-        # Filter results
-        dea_result = dea_result.loc[pd.notnull(dea_result["padj"])]
-        dea_result = dea_result.sort_values(by=["padj"], ascending=True, axis=0)
-        print("Writing DE genes to output using a FDR cut-off of {}".format(fdr))
-        dea_result.to_csv(os.path.join(outdir,
-                                       "dea_results_{}_vs_{}.tsv"
-                                       .format(comp[0], comp[1])), sep="\t")
-        dea_result.ix[dea_result["padj"] <= fdr].to_csv(os.path.join(outdir,
-                                                                     "filtered_dea_results_{}_vs_{}.tsv"
-                                                                     .format(comp[0], comp[1])), sep="\t")
-        # Volcano plot
-        print("Writing volcano plot to output")
-        outfile = os.path.join(outdir, "volcano_{}_vs_{}.pdf".format(comp[0], comp[1]))
-        volcano(dea_result, fdr, outfile)  
+    # The comparisons are processed in parallel (at most num_workers at once)
+    print("Writing DE genes and volcano plots to output using a FDR cut-off of {}".format(fdr))
+    tasks = [(tuple(comp), dea_result, fdr, outdir) 
+             for comp, dea_result in zip(comparisons, dea_results)]
+    timings = process_comparisons(tasks, dea_fit, num_workers)
+    for comp, elapsed in timings:
+        print("Comparison {} vs {} done in {:.2f} seconds".format(comp[0], comp[1], elapsed))
         
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__,
@@ -152,8 +236,29 @@ if __name__ == '__main__':
                         "considered expressed (default: %(default)s)")
     parser.add_argument("--fdr", type=float, default=0.01,
                         help="The FDR minimum confidence threshold (default: %(default)s)")
+    parser.add_argument("--pseudobulk", default=None, nargs="?", const="dataset",
+                        type=str, choices=["dataset", "region"],
+                        help="Sum the counts of the spots of each dataset (dataset) or of each\n" \
+                        "region of each dataset (region, spot names as REGION_XxY) and perform\n" \
+                        "the DEA on these pseudo-bulk samples (default: dataset if given)")
+    parser.add_argument("--engine", default="R", metavar="[STR]", 
+                        type=str, choices=["R", "Native"],
+                        help="The engine used to perform the DEA:\n" \
+                        "R = DESeq2 in R\n" \
+                        "Native = negative binomial GLM (DESeq2 method) computed in parallel\n" \
+                        "processes without R (much faster with many spots)\n" \
+                        "(default: %(default)s)")
+    parser.add_argument("--num-workers", default=None, metavar="[INT]", type=int,
+                        help="The number of processes used to write the results of the comparisons\n" \
+                        "(default: the number of cores)")
     parser.add_argument("--outdir", help="Path to output dir")
+    parser.add_argument("--cache-dir", default=None, type=str,
+                        help="Path to a folder where the parsed matrices and other intermediate\n" \
+                        "results are cached to be reused in later runs\n" \
+                        "(default: STANALYSIS_CACHE_DIR if set, otherwise no cache)")
     args = parser.parse_args()
+    if args.cache_dir is not None:
+        set_cache_dir(args.cache_dir)
     main(args.counts_table_files, args.conditions, args.comparisons, args.outdir,
          args.fdr, args.normalization, args.num_exp_spots, args.num_exp_genes, 
-         args.min_gene_expression)
\ No newline at end of file
+         args.min_gene_expression, args.engine, args.pseudobulk, args.num_workers)
\ No newline at end of file
@@ -16,7 +16,8 @@ matching the regular expression given as input.
 import argparse
 import sys
 import os
-import pandas as pd
+from stanalysis.cache import set_cache_dir
+from stanalysis.preprocessing import read_counts_table
 import re
 
 def main(counts_matrix, reg_exps, outfile):
@@ -29,7 +30,7 @@ def main(counts_matrix, reg_exps, outfile):
         outfile = "filtered_{}".format(os.path.basename(counts_matrix).split(".")[0])
     
     # Read the data frame (genes as columns)
-    counts_table = pd.read_table(counts_matrix, sep="\t", header=0, index_col=0)
+    counts_table = read_counts_table(counts_matrix)
     genes = counts_table.columns
     # Filter out genes that match any of the reg-exps
     genes = [gene for gene in genes if any([re.match(regex,gene) for regex in reg_exps])]
@@ -48,6 +49,12 @@ if __name__ == '__main__':
                         default=None,
                         type=str,
                         action='append')
+    parser.add_argument("--cache-dir", default=None, type=str,
+                        help="Path to a folder where the parsed matrices and other intermediate\n" \
+                        "results are cached to be reused in later runs\n" \
+                        "(default: STANALYSIS_CACHE_DIR if set, otherwise no cache)")
     args = parser.parse_args()
+    if args.cache_dir is not None:
+        set_cache_dir(args.cache_dir)
     main(args.counts_matrix, args.filter_genes, args.outfile)
 
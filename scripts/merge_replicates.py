@@ -1,18 +1,19 @@
 #! /usr/bin/env python
 """
-This scripts merges two ST datasets (technical replicates
+This scripts merges two or more ST datasets (technical replicates
 from the same individual).
 
-It keeps only the genes that are in both datasets
+It keeps only the genes that are in all the datasets
 (summing their counts or averaging them).
 
-Assumes that both matrices have the same order of genes and spots
-and that the spots of both datasets are located in the same part of the tissue (aligned).
+Assumes that the spots of the datasets are located in the same part of the tissue (aligned).
+The spots of each dataset are matched to the nearest spot of the first dataset
+and the genes are matched by name.
 
 The spots coordinates of the merged dataset will be the ones present in the first
 dataset.
 
-merge_replicates.py --input-files datasetA.tsv datasetB.tsv --output merged.tsv
+merge_replicates.py --input-files datasetA.tsv datasetB.tsv [datasetC.tsv ...] --outfile merged.tsv
 
 @Author Jose Fernandez Navarro <jose.fernandez.navarro@scilifelab.se>
 """
@@ -20,12 +21,12 @@ merge_replicates.py --input-files datasetA.tsv datasetB.tsv --output merged.tsv
 import argparse
 import sys
 import os
-import pandas as pd
-from stanalysis.preprocessing import merge_datasets
+from stanalysis.cache import set_cache_dir
+from stanalysis.preprocessing import merge_replicates, read_counts_table
 
 def main(input_files, outfile, merging_action):
 
-    if len(input_files) != 2 or any([not os.path.isfile(f) for f in input_files]):
+    if len(input_files) < 2 or any([not os.path.isfile(f) for f in input_files]):
         sys.stderr.write("Error, input file not present or invalid format\n")
         sys.exit(1)
      
@@ -33,21 +34,15 @@ def main(input_files, outfile, merging_action):
         outfile = "merged.tsv"
     
     # Read the data frames (genes as columns)
-    counts_tableA = pd.read_table(input_files[0], sep="\t", header=0, index_col=0)
-    counts_tableB = pd.read_table(input_files[1], sep="\t", header=0, index_col=0)
-
-    num_spotsA = len(counts_tableA.index)
-    num_spotsB = len(counts_tableB.index)
-    if num_spotsA != num_spotsB:
-        sys.stderr.write("Error, datasets have different number of spots "
-                         "{} and {}\n".format(num_spotsA, num_spotsB))
-        sys.exit(1)
-         
-    print("Merging dataset {} with {} spots and {} genes with "
-          "dataset {} with {} spots and {} genes".format(input_files[0], input_files[1], 
-                                                         num_spotsA, num_spotsB))
-    # Merge the two datasets
-    merged_table = merge_datasets(counts_tableA, counts_tableB, merging_action)
+    counts_tables = [read_counts_table(f) for f in input_files]
+    for name, counts in zip(input_files, counts_tables):
+        print("Merging dataset {} with {} spots and {} genes".format(name, 
+                                                                   len(counts.index), 
+                                                                   len(counts.columns)))
+        
+    # Merge the datasets
+    merged_table = merge_replicates(counts_tables, 
+                                    "SUM" if merging_action == "Sum" else "AVG")
     
     # Write merged table
     merged_table.to_csv(outfile, sep='\t')
@@ -56,13 +51,19 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("--input-files", required=True, nargs='+', type=str,
-                        help="Two ST datasets (matrix of counts in TSV format)")
+                        help="Two or more ST datasets (matrix of counts in TSV format)")
     parser.add_argument("--outfile", help="Name of the output file")
     parser.add_argument("--merging-action", default="Sum", metavar="[STR]", 
                         type=str, choices=["Sum", "Median"],
-                        help="How to merge the counts of common genes in both datasets.\n"
-                        "Sum will sum the counts of both and Median will sum the counts and "
-                        "divided by 2 (default: %(default)s).")
+                        help="How to merge the counts of common genes in the datasets.\n"
+                        "Sum will sum the counts and Median will sum the counts and "
+                        "divide them by the number of datasets (default: %(default)s).")
+    parser.add_argument("--cache-dir", default=None, type=str,
+                        help="Path to a folder where the parsed matrices and other intermediate\n" \
+                        "results are cached to be reused in later runs\n" \
+                        "(default: STANALYSIS_CACHE_DIR if set, otherwise no cache)")
     args = parser.parse_args()
+    if args.cache_dir is not None:
+        set_cache_dir(args.cache_dir)
     main(args.input_files, args.outfile, args.merging_action)
 
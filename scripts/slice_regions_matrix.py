@@ -27,7 +27,8 @@ slice_regions_matrix.py --counts-matrix dataset.tsv --spot-classes classes.txt -
 import argparse
 import sys
 import os
-import pandas as pd
+from stanalysis.cache import set_cache_dir
+from stanalysis.preprocessing import read_counts_table
 from collections import defaultdict
 
 def main(counts_matrix, class_file, regions):
@@ -40,7 +41,7 @@ def main(counts_matrix, class_file, regions):
     # Get the file name
     base_name = os.path.basename(counts_matrix).split(".")[0]
     # Read the data frame (genes as columns)
-    counts_table = pd.read_table(counts_matrix, sep="\t", header=0, index_col=0)
+    counts_table = read_counts_table(counts_matrix)
     # Load the spot classes
     spot_classes = defaultdict(list)
     with open(class_file) as filehandler:
@@ -68,6 +69,12 @@ if __name__ == '__main__':
     parser.add_argument("--regions", 
                         help="The regions (CLASSES) to split the dataset into",
                         required=True, nargs='+', type=str)
+    parser.add_argument("--cache-dir", default=None, type=str,
+                        help="Path to a folder where the parsed matrices and other intermediate\n" \
+                        "results are cached to be reused in later runs\n" \
+                        "(default: STANALYSIS_CACHE_DIR if set, otherwise no cache)")
     args = parser.parse_args()
+    if args.cache_dir is not None:
+        set_cache_dir(args.cache_dir)
     main(args.counts_matrix, args.spot_classes, args.regions)
 
@@ -22,11 +22,13 @@ what spots to plot
 import argparse
 import re
 from matplotlib import pyplot as plt
+from stanalysis.cache import set_cache_dir
 from stanalysis.visualization import scatter_plot
 from stanalysis.preprocessing import *
 from stanalysis.alignment import parseAlignmentMatrix
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
 import os
 import sys
 
@@ -65,66 +67,62 @@ def main(counts_table_files,
     print("Output directory {}".format(outdir))
     print("Input datasets {}".format(" ".join(counts_table_files))) 
          
-    # Merge input datasets (Spots are rows and genes are columns)
-    counts = aggregate_datatasets(counts_table_files)
-    print("Total number of spots {}".format(len(counts.index)))
-    print("Total number of genes {}".format(len(counts.columns)))
-
-    # Remove noisy spots and genes (Spots are rows and genes are columns)
-    counts = remove_noise(counts, 1 / 100.0, 1 / 100.0, min_expression=1)
+    # Merge input datasets and remove noisy spots and genes while reading them
+    # (Spots are rows and genes are columns)
+    counts = stream_aggregate_datatasets(counts_table_files, 1 / 100.0, 1 / 100.0, min_expression=1)
     
-    # Normalization
+    # Normalization (the counts are kept sparse)
     print("Computing per spot normalization...")
     counts = normalize_data(counts, normalization)
                          
-    # Extract the list of the genes that must be shown
-    genes_to_keep = list()
+    # Extract the genes that must be shown (the reg-exps are
+    # compiled once into a single alternation)
     if filter_genes:
-        for gene in counts.columns:
-            for regex in filter_genes:
-                if re.match(regex, gene):
-                    genes_to_keep.append(gene)
-                    break                         
+        genes_regex = re.compile("|".join("(?:{})".format(regex) for regex in filter_genes))
+        genes_to_keep = np.array([genes_regex.match(str(gene)) is not None 
+                                  for gene in counts.columns], dtype=bool)
     else: 
-        genes_to_keep = counts.columns
+        genes_to_keep = np.ones(len(counts.columns), dtype=bool)
     
-    if len(genes_to_keep) == 0:
+    if not genes_to_keep.any():
         sys.stderr.write("Error, no genes found with the reg-exp given\n")
         sys.exit(1)        
     
-    # Create a scatter plot for each dataset
+    # Compute the expression of each spot as the sum of the 
+    # counts of the genes to show that are above the cut-off
+    values = counts.matrix if isinstance(counts, SparseCounts) else counts.values
+    values = values[:,np.flatnonzero(genes_to_keep)]
+    if sp.issparse(values):
+        values = sp.csr_matrix(values, dtype=np.float64, copy=True)
+        values.data[values.data <= cutoff] = 0.0
+        expression = np.asarray(values.sum(axis=1)).ravel()
+    else:
+        values = np.asarray(values, dtype=np.float64)
+        expression = np.where(values > cutoff, values, 0.0).sum(axis=1)
+    expressed = expression > 0.0
+    if use_log_scale:
+        expression[expressed] = np.log2(expression[expressed])
+    if expressed.any():
+        vmin = expression[expressed].min()
+        vmax = expression[expressed].max()
+    
+    # Group the expressed spots by dataset
     print("Plotting data...")
-    total_spots = counts.index
-    vmin = 10e6
-    vmax = -1
-    x_points = list()
-    y_points = list()
-    colors = list()
-    for i, name in enumerate(counts_table_files):
-        spots = filter(lambda x:'{}_'.format(i) in x, total_spots)
-        # Compute the expressions for each spot
-        # as the sum of all spots that pass the thresholds (Gene and counts)
-        x_points.append(list())
-        y_points.append(list())
-        colors.append(list())
-        for spot in spots:
-            tokens = spot.split("x")
-            assert(len(tokens) == 2)
-            y = float(tokens[1])
-            x = float(tokens[0].split("_")[1])
-            exp = sum(count for count in counts.loc[spot,genes_to_keep] if count > cutoff)
-            if exp > 0.0:
-                x_points[i].append(x)
-                y_points[i].append(y)
-                if use_log_scale: exp = np.log2(exp)
-                vmin = min(vmin, exp)
-                vmax = max(vmax, exp)
-                colors[i].append(exp)
+    spot_index = parse_spots(counts.index)
+    dataset_ids = spot_index["dataset"].values[expressed]
+    order = np.argsort(dataset_ids, kind="mergesort")
+    bounds = np.searchsorted(dataset_ids[order], np.arange(len(counts_table_files) + 1))
+    x_values = spot_index["x"].values[expressed][order]
+    y_values = spot_index["y"].values[expressed][order]
+    exp_values = expression[expressed][order]
+    x_points = [x_values[bounds[i]:bounds[i + 1]] for i in range(len(counts_table_files))]
+    y_points = [y_values[bounds[i]:bounds[i + 1]] for i in range(len(counts_table_files))]
+    colors = [exp_values[bounds[i]:bounds[i + 1]] for i in range(len(counts_table_files))]
                 
     for i, name in enumerate(counts_table_files):
         
         if len(colors[i]) == 0:
-            sys.stdount.write("Warning, the gene/s given are not expressed in {}\n".format(name))
+            sys.stdout.write("Warning, the gene/s given are not expressed in {}\n".format(name))
             continue 
  
         # Retrieve alignment matrix and image if any
@@ -200,7 +198,13 @@ if __name__ == '__main__':
                         action='append')
     parser.add_argument("--outdir", default=None, help="Path to output dir")
     parser.add_argument("--use-log-scale", action="store_true", default=False, help="Use log2(counts + 1) values")
+    parser.add_argument("--cache-dir", default=None, type=str,
+                        help="Path to a folder where the parsed matrices and other intermediate\n" \
+                        "results are cached to be reused in later runs\n" \
+                        "(default: STANALYSIS_CACHE_DIR if set, otherwise no cache)")
     args = parser.parse_args()
+    if args.cache_dir is not None:
+        set_cache_dir(args.cache_dir)
 
     main(args.counts_table_files,
          args.image_files,
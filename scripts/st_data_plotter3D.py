@@ -20,6 +20,7 @@ It allows to apply a cut-off on the number of reads.
 import argparse
 import plotly
 from plotly.graph_objs import Scatter3d, Layout, ColorBar
+from stanalysis.cache import set_cache_dir
 from stanalysis.preprocessing import *
 import pandas as pd
 import numpy as np
@@ -46,7 +47,7 @@ def main(counts_table,
     print("Output directory {}".format(outdir))
          
     # Counts table (Spots are rows and genes are columns)
-    counts = pd.read_table(counts_table, sep="\t", header=0, index_col=0)
+    counts = read_counts_table(counts_table)
     print("Total number of spots {}".format(len(counts.index)))
     print("Total number of genes {}".format(len(counts.columns)))
 
@@ -136,7 +137,13 @@ if __name__ == '__main__':
                         action='append')
     parser.add_argument("--outdir", default=None, help="Path to output dir")
     parser.add_argument("--use-log-scale", action="store_true", default=False, help="Use log2(counts + 1) values")
+    parser.add_argument("--cache-dir", default=None, type=str,
+                        help="Path to a folder where the parsed matrices and other intermediate\n" \
+                        "results are cached to be reused in later runs\n" \
+                        "(default: STANALYSIS_CACHE_DIR if set, otherwise no cache)")
     args = parser.parse_args()
+    if args.cache_dir is not None:
+        set_cache_dir(args.cache_dir)
 
     main(args.counts_table,
          args.meta_info,
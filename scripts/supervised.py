@@ -30,8 +30,8 @@ import argparse
 import sys
 import os
 import numpy as np
-import pandas as pd
 #from sklearn.feature_selection import VarianceThreshold
+from stanalysis.cache import set_cache_dir
 from stanalysis.preprocessing import *
 from sklearn.svm import LinearSVC, SVC
 from sklearn import metrics
@@ -91,7 +91,7 @@ def main(train_data,
          
     # loads the test set
     # spots are rows and genes are columns
-    test_data_frame = pd.read_table(test_data, sep="\t", header=0, index_col=0)    
+    test_data_frame = read_counts_table(test_data)
     test_genes = list(test_data_frame.columns.values)
     
     # loads all the classes for the test set
@@ -163,15 +163,12 @@ def main(train_data,
     unique_colors = [color_map[i] for i in set(sorted(predicted_class))]
     with open(os.path.join(outdir, "predicted_classes.txt"), "w") as filehandler:
         labels = list(test_data_frame.index)
+        spot_index = parse_spots(test_data_frame.index, with_dataset=False)
         for i,label in enumerate(predicted_class):
             probs = predicted_prob[i].tolist()
             merged_prob_colors.append(composite_colors(unique_colors, probs))
-            tokens = labels[i].split("x")
-            assert(len(tokens) == 2)
-            y = float(tokens[1])
-            x = float(tokens[0])
-            x_points.append(x)
-            y_points.append(y)
+            x_points.append(spot_index["x"].values[i])
+            y_points.append(spot_index["y"].values[i])
             filehandler.write("{0}\t{1}\t{2}\n".format(labels[i], label,
                                                        "\t".join(['{:.6f}'.format(x) for x in probs])))
             
@@ -251,7 +248,13 @@ if __name__ == '__main__':
     parser.add_argument("--outdir", help="Path to output dir")
     parser.add_argument("--spot-size", default=20, metavar="[INT]", type=int, choices=range(1, 100),
                         help="The size of the spots when generating the plots. (default: %(default)s)")
+    parser.add_argument("--cache-dir", default=None, type=str,
+                        help="Path to a folder where the parsed matrices and other intermediate\n" \
+                        "results are cached to be reused in later runs\n" \
+                        "(default: STANALYSIS_CACHE_DIR if set, otherwise no cache)")
     args = parser.parse_args()
+    if args.cache_dir is not None:
+        set_cache_dir(args.cache_dir)
     main(args.train_data, args.test_data, args.train_classes, 
          args.test_classes, args.use_log_scale, args.normalization, 
          args.outdir, args.alignment, args.image, args.spot_size)
@@ -24,18 +24,22 @@ Noisy genes (expressed in very few spots) are removed using a parameter.
 import argparse
 import sys
 import os
+import tempfile
 import numpy as np
 import pandas as pd
-from sklearn.manifold import TSNE
-from sklearn.decomposition import PCA, FastICA, SparsePCA
+import scipy.sparse as sp
+from sklearn.decomposition import FastICA, SparsePCA
 from sklearn.cluster import DBSCAN
-from sklearn.cluster import KMeans
+from sklearn.neighbors import radius_neighbors_graph
 from sklearn.cluster import AgglomerativeClustering
 from sklearn.mixture import GaussianMixture
+from stanalysis.cache import set_cache_dir
 from stanalysis.visualization import scatter_plot, scatter_plot3d, histogram
 from stanalysis.preprocessing import *
 from stanalysis.alignment import parseAlignmentMatrix
-from stanalysis.analysis import Rtsne, linear_conv, computeNClusters
+from stanalysis.analysis import Rtsne, tsne, pca, linear_conv, graph_clustering, \
+kmeans, estimate_num_clusters, estimate_num_clusters_hierarchical
+from stanalysis.neighbors import knn_graph
 from collections import defaultdict
 import matplotlib.pyplot as plt
   
@@ -58,7 +62,16 @@ def main(counts_table_files,
          use_adjusted_log,
          tsne_perplexity,
          tsne_theta,
-         color_space_plots):
+         color_space_plots,
+         tsne_method="BarnesHut",
+         pca_dims=None,
+         pca_method="Randomized",
+         graph_resolution=1.0,
+         kmeans_batch_size=1024,
+         kmeans_restarts=10,
+         out_of_core=False,
+         max_clusters=15,
+         dbscan_eps=0.5):
 
     if len(counts_table_files) == 0 or \
     any([not os.path.isfile(f) for f in counts_table_files]):
@@ -97,14 +110,11 @@ def main(counts_table_files,
     print("Output directory {}".format(outdir))
     print("Input datasets {}".format(" ".join(counts_table_files))) 
          
-    # Merge input datasets (Spots are rows and genes are columns)
-    counts = aggregate_datatasets(counts_table_files)
-    print("Total number of spots {}".format(len(counts.index)))
-    print("Total number of genes {}".format(len(counts.columns)))
-    
-    # Remove noisy spots and genes (Spots are rows and genes are columns)
-    counts = remove_noise(counts, num_exp_genes / 100.0, num_exp_spots / 100.0, 
-                          min_expression=min_gene_expression)
+    # Merge input datasets and remove noisy spots and genes while reading them
+    # (Spots are rows and genes are columns)
+    counts = stream_aggregate_datatasets(counts_table_files, num_exp_genes / 100.0, 
+                                         num_exp_spots / 100.0, 
+                                         min_expression=min_gene_expression)
 
     if len(counts.index) < 5 or len(counts.columns) < 10:
         sys.stdout.write("Error, too many spots/genes were filtered.\n")
@@ -118,54 +128,119 @@ def main(counts_table_files,
 
     # Keep top genes (variance or expressed)
     norm_counts = keep_top_genes(norm_counts, num_genes_keep / 100.0, criteria=top_genes_criteria)
-       
-    # Compute the expected number of clusters
-    if num_clusters is None:
-        num_clusters = computeNClusters(counts)
-        print("Computation of number of clusters obtained {} clusters".format(num_clusters))
-        
-    if use_log_scale:
-        print("Using pseudo-log counts log2(counts + 1)")
-        norm_counts = np.log2(norm_counts + 1)  
+    
+    # The sparse matrix is kept until a method needs a dense matrix
+    if isinstance(norm_counts, SparseCounts):
+        reduced_data = norm_counts.matrix
+        if use_log_scale:
+            print("Using pseudo-log counts log2(counts + 1)")
+            reduced_data = reduced_data.log1p() / np.log(2.0)
+    else:
+        reduced_data = norm_counts.values
+        if use_log_scale:
+            print("Using pseudo-log counts log2(counts + 1)")
+            reduced_data = np.log2(reduced_data + 1)
       
     print("Performing dimensionality reduction...") 
-           
+    
+    # Optional reduction to the first principal components before 
+    # the dimensionality reduction method (truncated PCA)
+    if pca_dims is not None and dimensionality != "PCA":
+        print("Reducing the data to {} principal components...".format(pca_dims))
+        reduced_data = pca(reduced_data, pca_dims, method=pca_method)
+    
     if "tSNE" in dimensionality:
-        # NOTE the Scipy tsne seems buggy so we use the R one instead
-        reduced_data = Rtsne(norm_counts, num_dimensions, theta=tsne_theta, perplexity=tsne_perplexity)
+        if tsne_method == "Rtsne":
+            reduced_data = Rtsne(reduced_data, num_dimensions, 
+                                 theta=tsne_theta, perplexity=tsne_perplexity)
+        else:
+            reduced_data = tsne(reduced_data, num_dimensions, theta=tsne_theta, 
+                                perplexity=tsne_perplexity, method=tsne_method)
+    elif "SPCA" in dimensionality:
+        decomp_model = SparsePCA(n_components=num_dimensions, alpha=1)
     elif "PCA" in dimensionality:
-        # n_components = None, number of mle to estimate optimal
-        decomp_model = PCA(n_components=num_dimensions, whiten=True, copy=True)
+        reduced_data = pca(reduced_data, num_dimensions, whiten=True, method=pca_method)
     elif "ICA" in dimensionality:
         decomp_model = FastICA(n_components=num_dimensions, 
                                algorithm='parallel', whiten=True,
                                fun='logcosh', w_init=None, random_state=None)
-    elif "SPCA" in dimensionality:
-        decomp_model = SparsePCA(n_components=num_dimensions, alpha=1)
     else:
         sys.stderr.write("Error, incorrect dimensionality reduction method\n")
         sys.exit(1)
      
-    if not "tSNE" in dimensionality:
+    if dimensionality in ["ICA", "SPCA"]:
+        if sp.issparse(reduced_data):
+            reduced_data = reduced_data.toarray()
         # Perform dimensionality reduction, outputs a bunch of 2D/3D coordinates
-        reduced_data = decomp_model.fit_transform(norm_counts)
+        reduced_data = decomp_model.fit_transform(reduced_data)
     
+    reduced_dir = None
+    if out_of_core:
+        # The reduced coordinates are moved to a memory-mapped temporary file
+        # so the estimation of the number of clusters and KMeans stream them
+        reduced_dir = tempfile.TemporaryDirectory(prefix="stanalysis_")
+        coords = np.lib.format.open_memmap(os.path.join(reduced_dir.name, "reduced_coordinates.npy"),
+                                           mode="w+", dtype=np.float64, shape=reduced_data.shape)
+        coords[:] = reduced_data.toarray() if sp.issparse(reduced_data) else reduced_data
+        coords.flush()
+        del coords, reduced_data
+        reduced_data = np.load(os.path.join(reduced_dir.name, "reduced_coordinates.npy"), mmap_mode="r")
+    
+    # The nearest neighbors graph of the reduced coordinates is built 
+    # once for the clustering methods that use neighbors
+    if clustering in ["Hierarchical", "Graph"]:
+        graph = knn_graph(reduced_data, n_neighbors=15)
+    
+    # Estimate the number of clusters from the reduced coordinates
+    # (DBSCAN and Graph infer the number of clusters)
+    kmeans_method = "MiniBatch" if clustering == "MiniBatchKMeans" else "Full"
+    estimated_labels = None
+    if num_clusters is None and clustering == "Hierarchical":
+        # Cuts of the same Ward tree used for the clustering
+        num_clusters, estimated_labels = estimate_num_clusters_hierarchical(reduced_data,
+                                                                            connectivity=graph,
+                                                                            max_clusters=max_clusters)
+        print("Computation of number of clusters obtained {} clusters".format(num_clusters))
+    elif num_clusters is None and clustering not in ["DBSCAN", "Graph"]:
+        num_clusters, estimated_labels = estimate_num_clusters(reduced_data, 
+                                                               max_clusters=max_clusters,
+                                                               kmeans_method=kmeans_method,
+                                                               n_init=kmeans_restarts,
+                                                               batch_size=kmeans_batch_size)
+        print("Computation of number of clusters obtained {} clusters".format(num_clusters))
+        
     print("Performing clustering...")
     # Do clustering of the dimensionality reduced coordinates
-    if "KMeans" in clustering:
-        labels = KMeans(init='k-means++',
-                        n_clusters=num_clusters,
-                        n_init=10).fit_predict(reduced_data)
+    if clustering in ["KMeans", "MiniBatchKMeans", "Hierarchical"] and estimated_labels is not None:
+        # The model chosen when estimating the number of clusters is reused
+        labels = estimated_labels
+    elif "KMeans" in clustering:
+        # The restarts run in parallel processes
+        labels = kmeans(reduced_data, num_clusters,
+                        method=kmeans_method,
+                        n_init=kmeans_restarts, batch_size=kmeans_batch_size)
     elif "Hierarchical" in clustering:
+        # Ward constrained to the neighbors graph (no pairwise distances matrix)
         labels = AgglomerativeClustering(n_clusters=num_clusters,
-                                         affinity='euclidean',
+                                         connectivity=graph,
                                          linkage='ward').fit_predict(reduced_data)
     elif "DBSCAN" in clustering:
-        labels = DBSCAN(eps=0.5, min_samples=5, 
-                        metric='euclidean', n_jobs=-1).fit_predict(reduced_data)
+        # The eps-neighborhoods are taken from the (sparse) graph of all the spots
+        # within eps (the same neighborhoods as the euclidean DBSCAN)
+        graph = radius_neighbors_graph(reduced_data, dbscan_eps, mode="distance")
+        labels = DBSCAN(eps=dbscan_eps, min_samples=5, 
+                        metric='precomputed', n_jobs=-1).fit_predict(graph)
+    elif "Graph" in clustering:
+        labels = graph_clustering(graph, resolution=graph_resolution)
     elif "Gaussian" in clustering:
+        # The KMeans model chosen when estimating the number of clusters
+        # initializes the means of the mixture
+        means_init = None if estimated_labels is None else \
+            np.array([np.asarray(reduced_data)[estimated_labels == label].mean(axis=0) 
+                      for label in range(num_clusters)])
         gm = GaussianMixture(n_components=num_clusters,
-                             covariance_type='full').fit(reduced_data)
+                             covariance_type='full',
+                             means_init=means_init).fit(reduced_data)
         labels = gm.predict(reduced_data)
     else:
         sys.stderr.write("Error, incorrect clustering method\n")
@@ -206,28 +281,23 @@ def main(counts_table_files,
                     for name in counts_table_files]
     # Write the coordinates and the label/class that they belong to
     spot_plot_data = defaultdict(lambda: [[],[],[],[]])
-    for i, spot in enumerate(norm_counts.index):
-        tokens = spot.split("x")
-        assert(len(tokens) == 2)
-        y = float(tokens[1])
-        tokens2 = tokens[0].split("_")
-        # This is to account for the cases where the spots already contain a tag (separated by "_")
-        if len(tokens2) == 3:
-            x = float(tokens2[2])
-        elif len(tokens2) == 2:
-            x = float(tokens2[1])
-        else:
-            sys.stderr.write("Error, the spots in the input data have "
-                             "the wrong format {}\n.".format(spot))
-            sys.exit(1)
-        index = int(tokens2[0])
+    # The spots are parsed once (dataset index, tag and coordinates)
+    try:
+        spot_index = parse_spots(norm_counts.index)
+    except RuntimeError as e:
+        sys.stderr.write(str(e))
+        sys.exit(1)
+    for i, (index, tag, x, y) in enumerate(zip(spot_index["dataset"].values, 
+                                               spot_index["tag"].values,
+                                               spot_index["x"].values, 
+                                               spot_index["y"].values)):
         spot_plot_data[index][0].append(x)
         spot_plot_data[index][1].append(y)
         spot_plot_data[index][2].append(labels[i])
         spot_plot_data[index][3].append(labels_colors[i])
         # This is to account for the cases where the spots already contain a tag (separated by "_")
-        if len(tokens2) == 3:
-            spot_str = "{}_{}x{}".format(tokens2[1],x,y)
+        if tag:
+            spot_str = "{}_{}x{}".format(tag,x,y)
         else:
             spot_str = "{}x{}".format(x,y)
         file_writers[index].write("{0}\t{1}\n".format(spot_str, labels[i]))
@@ -315,6 +385,11 @@ def main(counts_table_files,
                          image=image, 
                          alpha=1.0, 
                          size=spot_size)        
+    
+    # Remove the memory-mapped reduced coordinates
+    if reduced_dir is not None:
+        del reduced_data
+        reduced_dir.cleanup()
                                 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__,
@@ -339,7 +414,12 @@ if __name__ == '__main__':
     parser.add_argument("--num-clusters", default=None, metavar="[INT]", type=int, choices=range(2, 16),
                         help="The number of clusters/regions expected to be found.\n" \
                         "If not given the number of clusters will be computed.\n" \
-                        "Note that this parameter has no effect with DBSCAN clustering.")
+                        "Note that this parameter has no effect with DBSCAN and Graph clustering.")
+    parser.add_argument("--max-clusters", default=15, metavar="[INT]", type=int,
+                        help="The maximum number of clusters when the number of clusters is computed\n" \
+                        "(the one with the highest silhouette is chosen). The candidates are the cuts\n" \
+                        "of the Ward tree with Hierarchical and KMeans models otherwise (the chosen\n" \
+                        "KMeans model initializes the means of Gaussian) (default: %(default)s)")
     parser.add_argument("--num-exp-genes", default=1, metavar="[FLOAT]", type=float,
                         help="The percentage of number of expressed genes (>= --min-gene-expression) a spot\n" \
                         "must have to be kept from the distribution of all expressed genes (default: %(default)s)")
@@ -355,12 +435,15 @@ if __name__ == '__main__':
                         "(see --top-genes-criteria)\n " \
                         "Low variance or low expressed will be discarded (default: %(default)s)")
     parser.add_argument("--clustering", default="KMeans", metavar="[STR]", 
-                        type=str, choices=["Hierarchical", "KMeans", "DBSCAN", "Gaussian"],
+                        type=str, choices=["Hierarchical", "KMeans", "MiniBatchKMeans", "DBSCAN", "Gaussian", "Graph"],
                         help="What clustering algorithm to use after the dimensionality reduction:\n" \
                         "Hierarchical = Hierarchical Clustering (Ward)\n" \
                         "KMeans = Suitable for small number of clusters\n" \
-                        "DBSCAN = Number of clusters will be automatically inferred\n" \
+                        "MiniBatchKMeans = KMeans on mini-batches of spots (large datasets)\n" \
+                        "DBSCAN = Number of clusters will be automatically inferred (see --dbscan-eps)\n" \
                         "Gaussian = Gaussian Mixtures Model\n" \
+                        "Graph = Modularity (Louvain) clustering of the nearest neighbors graph\n" \
+                        "(the number of clusters will be automatically inferred, see --graph-resolution)\n" \
                         "(default: %(default)s)")
     parser.add_argument("--dimensionality", default="tSNE", metavar="[STR]", 
                         type=str, choices=["tSNE", "PCA", "ICA", "SPCA"],
@@ -398,11 +481,49 @@ if __name__ == '__main__':
                         help="The value of the perplexity for the t-sne method. (default: %(default)s)")
     parser.add_argument("--tsne-theta", default=0.5, metavar="[FLOAT]", type=float,
                         help="The value of theta for the t-sne method. (default: %(default)s)")
+    parser.add_argument("--tsne-method", default="BarnesHut", metavar="[STR]", 
+                        type=str, choices=["BarnesHut", "Exact", "FFT", "Rtsne"],
+                        help="The t-sne implementation to use:\n" \
+                        "BarnesHut = approximate nearest neighbors and Barnes-Hut gradients\n" \
+                        "Exact = exact affinities and gradients (small datasets only)\n" \
+                        "FFT = FFT interpolated gradients (requires openTSNE)\n" \
+                        "Rtsne = the R package Rtsne\n" \
+                        "(default: %(default)s)")
+    parser.add_argument("--pca-dims", default=None, metavar="[INT]", type=int,
+                        help="Reduce the data to this number of principal components (truncated PCA)\n" \
+                        "before the dimensionality reduction (tSNE, ICA or SPCA). (default: %(default)s)")
+    parser.add_argument("--pca-method", default="Randomized", metavar="[STR]", 
+                        type=str, choices=["Randomized", "Lanczos"],
+                        help="The truncated SVD used in the PCA and in the reduction before t-sne:\n" \
+                        "Randomized = randomized SVD (Halko et al.)\n" \
+                        "Lanczos = ARPACK truncated SVD\n" \
+                        "(default: %(default)s)")
+    parser.add_argument("--graph-resolution", default=1.0, metavar="[FLOAT]", type=float,
+                        help="The resolution of the Graph clustering, higher values give\n" \
+                        "more clusters (default: %(default)s)")
+    parser.add_argument("--dbscan-eps", default=0.5, metavar="[FLOAT]", type=float,
+                        help="The maximum distance between two spots (in the dimensionality reduced\n" \
+                        "coordinates) to be neighbors in DBSCAN (default: %(default)s)")
+    parser.add_argument("--kmeans-batch-size", default=1024, metavar="[INT]", type=int,
+                        help="The number of spots of each mini-batch in MiniBatchKMeans (default: %(default)s)")
+    parser.add_argument("--kmeans-restarts", default=10, metavar="[INT]", type=int,
+                        help="The number of restarts of KMeans and MiniBatchKMeans, they run\n" \
+                        "in parallel and the best one is kept (default: %(default)s)")
+    parser.add_argument("--out-of-core", action="store_true", default=False,
+                        help="The reduced coordinates are kept in a memory-mapped temporary file\n" \
+                        "instead of in memory and KMeans, MiniBatchKMeans and the estimation of the\n" \
+                        "number of clusters stream them from it (large datasets)")
     parser.add_argument("--outdir", default=None, help="Path to output dir")
     parser.add_argument("--color-space-plots", action="store_true", default=False,
                         help="Generate also plots using the representation in color space of the\n" \
                         "dimensionality reduced coordinates")   
+    parser.add_argument("--cache-dir", default=None, type=str,
+                        help="Path to a folder where the parsed matrices and other intermediate\n" \
+                        "results are cached to be reused in later runs\n" \
+                        "(default: STANALYSIS_CACHE_DIR if set, otherwise no cache)")
     args = parser.parse_args()
+    if args.cache_dir is not None:
+        set_cache_dir(args.cache_dir)
     main(args.counts_table_files, 
          args.normalization, 
          args.num_clusters,
@@ -422,5 +543,14 @@ if __name__ == '__main__':
          args.use_adjusted_log,
          args.tsne_perplexity,
          args.tsne_theta,
-         args.color_space_plots)
+         args.color_space_plots,
+         args.tsne_method,
+         args.pca_dims,
+         args.pca_method,
+         args.graph_resolution,
+         args.kmeans_batch_size,
+         args.kmeans_restarts,
+         args.out_of_core,
+         args.max_clusters,
+         args.dbscan_eps)
 
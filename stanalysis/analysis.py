@@ -1,131 +1,95 @@
 """ Different functions for
 analysis of ST datasets
 """
-from stanalysis.normalization import RimportLibrary
+from stanalysis.rsession import RimportLibrary, RregisterParallel, Rtimer, \
+Rmatrix, Rnumpy, RdataFrame
+from stanalysis.preprocessing import compute_size_factors
+from stanalysis.cache import array_fingerprint, cache_get, cache_put, cache_enabled
+from stanalysis.dea import dea_fingerprint
+from stanalysis.neighbors import knn_graph
 from matplotlib.colors import LinearSegmentedColormap
 from matplotlib import colors as mpcolors
-from collections import Counter
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import LinearOperator, svds
+from sklearn.manifold import TSNE
+from sklearn.cluster import KMeans, MiniBatchKMeans, kmeans_plusplus, ward_tree
+from sklearn.metrics import silhouette_score
 import multiprocessing
-import rpy2.robjects.packages as rpackages
-import rpy2.robjects as robjects
-from rpy2.robjects import pandas2ri, r, numpy2ri, globalenv
-robjects.conversion.py2ri = numpy2ri
-base = rpackages.importr("base")
 
 def computeNClusters(counts, min_size=20):
     """Computes the number of clusters
     from the data using Scran::quickCluster"""
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts.transpose())
     scran = RimportLibrary("scran")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))  
-    as_matrix = r["as.matrix"]
-    clusters = scran.quickCluster(as_matrix(r_counts), min_size)
+    RregisterParallel()
+    r_counts = Rmatrix(counts.transpose())
+    with Rtimer("compute"):
+        clusters = scran.quickCluster(r_counts, min_size)
     n_clust = len(set(clusters))
-    pandas2ri.deactivate()
     return n_clust
 
-def deaDESeq2(counts, conds, comparisons, alpha, size_factors=None):
+def deaDESeq2(counts, conds, comparisons, alpha, size_factors=None, use_cache=True):
     """Makes a call to DESeq2 to
     perform D.E.A. in the given
     counts matrix with the given conditions and comparisons.
     Can be given size factors. 
+    The fitted DESeq2 object is stored (serialized) in the on-disk cache
+    keyed by the counts, the conditions and the size factors so new
+    comparisons and FDR thresholds do not need to fit the model again.
     Returns a list of DESeq2 results for each comparison
     """
+    import rpy2.robjects as robjects
+    from rpy2.robjects import r
     results = list()
     try:
-        pandas2ri.activate()
         deseq2 = RimportLibrary("DESeq2")
-        multicore = RimportLibrary("BiocParallel")
-        multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-        # Create the R conditions and counts data
-        r_counts = pandas2ri.py2ri(counts)
-        cond = robjects.DataFrame({"conditions": robjects.StrVector(conds)})
-        design = r('formula(~ conditions)')
-        dds = r.DESeqDataSetFromMatrix(countData=r_counts, colData=cond, design=design)
-        if size_factors is None:
-            dds = r.DESeq(dds, parallel=True)
-        else:
-            assign_sf = r["sizeFactors<-"]
-            dds = assign_sf(object=dds, value=robjects.FloatVector(size_factors))
-            dds = r.estimateDispersions(dds)
-            dds = r.nbinomWaldTest(dds)
+        RregisterParallel()
+        dds = None
+        cache_key = None
+        if use_cache and cache_enabled():
+            cache_key = dea_fingerprint(counts, conds, "DESeq2",
+                                        None if size_factors is None
+                                        else array_fingerprint([np.asarray(size_factors, dtype=np.float64)]))
+            cached = cache_get("deseq2_fit", cache_key, mmap=False)
+            if cached is not None and "dds" in cached:
+                with Rtimer("conversion"):
+                    dds = r.unserialize(robjects.vectors.ByteVector(cached["dds"].tobytes()))
+        if dds is None:
+            # Create the R conditions and counts data
+            r_counts = Rmatrix(counts)
+            cond = robjects.DataFrame({"conditions": robjects.StrVector(conds)})
+            with Rtimer("compute"):
+                design = r('formula(~ conditions)')
+                dds = r.DESeqDataSetFromMatrix(countData=r_counts, colData=cond, design=design)
+                if size_factors is None:
+                    dds = r.DESeq(dds, parallel=True)
+                else:
+                    assign_sf = r["sizeFactors<-"]
+                    dds = assign_sf(object=dds, value=robjects.FloatVector(size_factors))
+                    dds = r.estimateDispersions(dds)
+                    dds = r.nbinomWaldTest(dds)
+            if cache_key is not None:
+                serialized = np.array(Rnumpy(r.serialize(dds, robjects.NULL)), dtype=np.uint8)
+                cache_put("deseq2_fit", cache_key, {"dds": serialized})
         # Perform the comparisons and store results in list
         for A,B in comparisons:
-            result = r.results(dds, contrast=r.c("conditions", A, B), alpha=alpha)
-            result = r['as.data.frame'](result)
-            genes = r['rownames'](result)
-            result = pandas2ri.ri2py_dataframe(result)
-            # There seems to be a problem parsing the rownames from R to pandas
-            # so we do it manually
-            result.index = genes
-            results.append(result)
-        pandas2ri.deactivate()
+            with Rtimer("compute"):
+                result = r.results(dds, contrast=r.c("conditions", A, B), alpha=alpha)
+                result = r['as.data.frame'](result)
+            results.append(RdataFrame(result))
     except Exception as e:
         raise e
     return results
 
 def deaScranDESeq2(counts, conds, comparisons, alpha, scran_clusters=False):
-    """Makes a call to DESeq2 with SCRAN to
+    """Makes a call to DESeq2 with SCRAN size factors 
+    (computed natively and cached, see compute_size_factors()) to
     perform D.E.A. in the given
     counts matrix with the given conditions and comparisons.
     Returns a list of DESeq2 results for each comparison
     """
-    results = list()
-    n_cells = len(counts.columns)
-    try:
-        pandas2ri.activate()
-        deseq2 = RimportLibrary("DESeq2")
-        scran = RimportLibrary("scran")
-        multicore = RimportLibrary("BiocParallel")
-        multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-        as_matrix = r["as.matrix"]
-        # Create the R conditions and counts data
-        r_counts = pandas2ri.py2ri(counts)
-        cond = robjects.StrVector(conds)
-        r_call = """
-            function(r_counts) {
-                sce = SingleCellExperiment(assays=list(counts=r_counts))
-                return(sce)
-            }
-        """
-        r_func = r(r_call)
-        sce = r_func(as_matrix(r_counts))
-        if scran_clusters:
-            r_clusters = scran.quickCluster(as_matrix(r_counts), max(n_cells/10, 10))
-            min_cluster_size = min(Counter(r_clusters).values())
-            sizes = list(set([round((min_cluster_size/2) / i) for i in [5,4,3,2,1]]))
-            sce = scran.computeSumFactors(sce, clusters=r_clusters, sizes=sizes, positive=True)
-        else:
-            sizes = list(set([round((n_cells/2) * i) for i in [0.1,0.2,0.3,0.4,0.5]]))
-            sce = scran.computeSumFactors(sce, sizes=sizes, positive=True)   
-        sce = r.normalize(sce)
-        dds = r.convertTo(sce, type="DESeq2")
-        r_call = """
-            function(dds, conditions){
-                colData(dds)$conditions = as.factor(conditions)
-                design(dds) = formula(~ conditions)
-                return(dds)
-            }
-        """
-        r_func = r(r_call)
-        dds = r_func(dds, cond)
-        dds = r.DESeq(dds)
-        # Perform the comparisons and store results in list
-        for A,B in comparisons:
-            result = r.results(dds, contrast=r.c("conditions", A, B), alpha=alpha)
-            result = r['as.data.frame'](result)
-            genes = r['rownames'](result)
-            result = pandas2ri.ri2py_dataframe(result)
-            # There seems to be a problem parsing the rownames from R to pandas
-            # so we do it manually
-            result.index = genes
-            results.append(result)
-        pandas2ri.deactivate()
-    except Exception as e:
-        raise e
-    return results
+    size_factors = compute_size_factors(counts.transpose(), "Scran", scran_clusters)
+    return deaDESeq2(counts, conds, comparisons, alpha, size_factors)
 
 def linear_conv(old, min, max, new_min, new_max):
     """ A simple linear conversion of one value for one scale to another
@@ -158,21 +122,544 @@ def composite_colors(colors, probs):
 def Rtsne(counts, dimensions, theta=0.5, dims=50, perplexity=30, max_iter=1000):
     """Performs dimensionality reduction
     using the R package Rtsne"""
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
     tsne = RimportLibrary("Rtsne")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-    as_matrix = r["as.matrix"]
-    tsne_out = tsne.Rtsne(as_matrix(counts), 
-                          dims=dimensions, 
-                          theta=theta, 
-                          check_duplicates=False, 
-                          pca=True, 
-                          initial_dims=dims, 
-                          perplexity=perplexity, 
-                          max_iter=max_iter, 
-                          verbose=False)
-    pandas_tsne_out = pandas2ri.ri2py(tsne_out.rx2('Y'))
-    pandas2ri.deactivate()
-    return pandas_tsne_out
\ No newline at end of file
+    RregisterParallel()
+    r_counts = Rmatrix(counts)
+    with Rtimer("compute"):
+        tsne_out = tsne.Rtsne(r_counts, 
+                              dims=dimensions, 
+                              theta=theta, 
+                              check_duplicates=False, 
+                              pca=True, 
+                              initial_dims=dims, 
+                              perplexity=perplexity, 
+                              max_iter=max_iter, 
+                              verbose=False)
+    return Rnumpy(tsne_out.rx2('Y'))
+
+def pca(counts, n_components, whiten=False, method="Randomized", 
+        n_oversamples=10, n_iter=7, random_state=0):
+    """Performs dimensionality reduction using a truncated PCA.
+    The data is centered implicitly (the centered matrix is only used
+    through products) so sparse matrices are never made dense and the
+    memory used is the input plus a few dense matrices of spots x components.
+    The methods are:
+    - Randomized: randomized range finder with power iterations (Halko et al.)
+    - Lanczos: ARPACK truncated SVD
+    :param counts: a Pandas data frame, a numpy array or a scipy sparse matrix (spots as rows)
+    :param n_components: the number of components
+    :param whiten: True to scale the components to unit variance
+    :param method: Randomized or Lanczos
+    :param n_oversamples: the number of extra random vectors (Randomized)
+    :param n_iter: the number of power iterations (Randomized)
+    :param random_state: the seed
+    :return: a numpy array with the principal components (spots as rows)
+    :raises: RuntimeError
+    """
+    if hasattr(counts, "values") and not sp.issparse(counts):
+        counts = counts.values
+    if sp.issparse(counts):
+        counts = sp.csr_matrix(counts, dtype=np.float64)
+    else:
+        counts = np.asarray(counts, dtype=np.float64)
+    num_spots, num_features = counts.shape
+    n_components = max(min(n_components, min(num_spots, num_features) - 1), 1)
+    mean = np.asarray(counts.mean(axis=0)).ravel()
+    # Products with the centered matrix (counts - mean)
+    def matmat(values):
+        return counts.dot(values) - mean.dot(values)
+    def rmatmat(values):
+        return counts.T.dot(values) - np.outer(mean, values.sum(axis=0))
+    random = np.random.RandomState(random_state)
+    if method == "Lanczos":
+        operator = LinearOperator((num_spots, num_features), dtype=np.float64,
+                                  matvec=lambda v: matmat(v.reshape(-1, 1)).ravel(),
+                                  rmatvec=lambda v: rmatmat(v.reshape(-1, 1)).ravel(),
+                                  matmat=matmat, rmatmat=rmatmat)
+        u, s, vt = svds(operator, k=n_components, 
+                        v0=random.uniform(-1, 1, min(num_spots, num_features)))
+        order = np.argsort(s)[::-1]
+        u, s, vt = u[:,order], s[order], vt[order]
+    elif method == "Randomized":
+        size = min(n_components + n_oversamples, min(num_spots, num_features))
+        basis = matmat(random.normal(size=(num_features, size)))
+        for _ in range(n_iter):
+            basis = np.linalg.qr(basis)[0]
+            basis = np.linalg.qr(rmatmat(basis))[0]
+            basis = matmat(basis)
+        basis = np.linalg.qr(basis)[0]
+        u, s, vt = np.linalg.svd(rmatmat(basis).T, full_matrices=False)
+        u = basis.dot(u[:,:n_components])
+        s = s[:n_components]
+        vt = vt[:n_components]
+    else:
+        raise RuntimeError("Error, incorrect PCA method {}\n".format(method))
+    # The largest loading of each component is positive (deterministic signs)
+    signs = np.sign(vt[np.arange(len(s)), np.argmax(np.abs(vt), axis=1)])
+    signs[signs == 0] = 1.0
+    u *= signs
+    if whiten:
+        return u * np.sqrt(num_spots - 1)
+    return u * s
+
+def tsne(counts, dimensions, theta=0.5, dims=50, perplexity=30, max_iter=1000,
+         method="BarnesHut", random_state=0, n_jobs=-1, n_iter_without_progress=300,
+         graph=None):
+    """Performs dimensionality reduction using t-SNE natively (same
+    parameters as Rtsne()). The data is first reduced to dims 
+    principal components (a truncated SVD for sparse matrices) and the
+    embedding is initialized with PCA so it is deterministic for a given seed.
+    The methods are:
+    - BarnesHut: affinities from the nearest neighbors graph (see stanalysis.neighbors)
+    and Barnes-Hut gradients
+    - Exact: exact affinities and gradients (only for small datasets)
+    - FFT: approximate affinities and FFT interpolated gradients (requires openTSNE)
+    The optimization stops early when the KL divergence does not improve
+    in n_iter_without_progress iterations.
+    :param counts: a Pandas data frame, a numpy array or a scipy sparse matrix (spots as rows)
+    :param dimensions: the number of dimensions of the embedding
+    :param theta: the angle of the Barnes-Hut approximation
+    :param dims: the number of principal components to use
+    :param perplexity: the perplexity of the affinities
+    :param max_iter: the maximum number of iterations
+    :param method: BarnesHut, Exact or FFT
+    :param random_state: the seed
+    :param n_jobs: the number of threads (-1 for all the cores)
+    :param n_iter_without_progress: the number of iterations without progress before stopping
+    :param graph: a precomputed nearest neighbors graph of the spots (see knn_graph())
+    with at least 3 * perplexity neighbors per spot sorted by distance (BarnesHut)
+    :return: a numpy array with the embedding (spots as rows)
+    :raises: RuntimeError
+    """
+    if hasattr(counts, "values") and not sp.issparse(counts):
+        counts = counts.values
+    num_spots, num_features = counts.shape
+    # The perplexity must be smaller than the number of spots
+    perplexity = min(perplexity, max((num_spots - 1) / 3.0, 1.0))
+    if dims < min(num_spots, num_features):
+        counts = pca(counts, dims, random_state=random_state)
+    elif sp.issparse(counts):
+        counts = counts.toarray()
+    counts = np.asarray(counts, dtype=np.float64)
+    if method == "FFT":
+        try:
+            from openTSNE import TSNE as openTSNE
+        except ImportError:
+            raise RuntimeError("Error, the FFT t-SNE method requires the package openTSNE\n")
+        return np.asarray(openTSNE(n_components=dimensions, perplexity=perplexity,
+                                   n_iter=max_iter, initialization="pca",
+                                   negative_gradient_method="fft", n_jobs=n_jobs,
+                                   random_state=random_state).fit(counts))
+    elif method not in ["BarnesHut", "Exact"]:
+        raise RuntimeError("Error, incorrect t-SNE method {}\n".format(method))
+    params = dict(n_components=dimensions, perplexity=perplexity, angle=theta, init="pca",
+                  method="barnes_hut" if method == "BarnesHut" else "exact",
+                  n_iter_without_progress=n_iter_without_progress,
+                  random_state=random_state, n_jobs=n_jobs)
+    if method == "BarnesHut":
+        # The affinities are computed from the shared nearest neighbors graph
+        n_neighbors = min(num_spots - 1, int(3.0 * perplexity + 1))
+        if graph is None or np.diff(graph.indptr).min() < n_neighbors:
+            graph = knn_graph(counts, n_neighbors, random_state=random_state)
+        # t-SNE uses squared euclidean distances and expects the spots
+        # to be their own nearest neighbors (explicit zeroes)
+        starts = graph.indptr[:-1]
+        graph = sp.csr_matrix((np.insert(graph.data ** 2, starts, 0.0),
+                               np.insert(graph.indices, starts, np.arange(num_spots)),
+                               graph.indptr + np.arange(num_spots + 1)),
+                              shape=(num_spots, num_spots))
+        # PCA initialization (scaled as scikit-learn does)
+        init = pca(counts, dimensions, random_state=random_state)
+        params.update(metric="precomputed", init=init / np.std(init[:,0]) * 1e-4)
+        counts = graph
+    try:
+        model = TSNE(max_iter=max_iter, **params)
+    except TypeError:
+        # scikit-learn < 1.5
+        model = TSNE(n_iter=max_iter, **params)
+    return model.fit_transform(counts)
+
+def graph_clustering(graph, resolution=1.0, max_sweeps=50, random_state=0):
+    """Clusters the spots by modularity optimization (Louvain) 
+    on their nearest neighbors graph (see stanalysis.neighbors). 
+    The number of clusters is inferred from the data and
+    higher resolutions give more (and smaller) clusters.
+    In each sweep the best community of every spot is computed at once
+    from the edges (linear in the number of edges) and a random half
+    of the spots that improve move, the partition with the highest 
+    modularity is kept. The communities are then merged into nodes of
+    a new graph until the modularity does not improve.
+    :param graph: a sparse matrix (spots x spots) with the neighbors of each spot
+    :param resolution: the resolution of the modularity
+    :param max_sweeps: the maximum number of sweeps in each level
+    :param random_state: the seed
+    :return: a vector with the cluster (0 to N-1) of each spot
+    """
+    random = np.random.RandomState(random_state)
+    # Symmetric unweighted graph
+    adjacency = sp.csr_matrix(graph, dtype=np.float64, copy=True)
+    adjacency.data[:] = 1.0
+    adjacency = adjacency.maximum(adjacency.T).tocsr()
+    labels = np.arange(adjacency.shape[0])
+    while True:
+        communities = _modularity_level(adjacency, resolution, max_sweeps, random)
+        communities = np.unique(communities, return_inverse=True)[1]
+        num_communities = communities.max() + 1
+        if num_communities == adjacency.shape[0]:
+            break
+        labels = communities[labels]
+        # Each community is a node of the next level (with self loops)
+        indicator = sp.csr_matrix((np.ones(len(communities)), 
+                                   (np.arange(len(communities)), communities)))
+        adjacency = indicator.T.dot(adjacency).dot(indicator).tocsr()
+        if num_communities == 1:
+            break
+    return labels
+
+def _modularity_level(adjacency, resolution, max_sweeps, random, patience=5):
+    """ Helper function of graph_clustering() that moves the 
+    nodes of a graph between communities to maximize the modularity
+    :return: a vector with the community of each node
+    """
+    num_nodes = adjacency.shape[0]
+    degrees = np.asarray(adjacency.sum(axis=1)).ravel()
+    total_weight = degrees.sum()
+    if total_weight == 0:
+        return np.arange(num_nodes)
+    coo = adjacency.tocoo()
+    edges = coo.row != coo.col
+    rows = coo.row[edges].astype(np.int64)
+    cols = coo.col[edges].astype(np.int64)
+    weights = coo.data[edges]
+    def modularity(communities):
+        internal = np.bincount(communities[coo.row], 
+                               weights=coo.data * (communities[coo.row] == communities[coo.col]),
+                               minlength=num_nodes)
+        totals = np.bincount(communities, weights=degrees, minlength=num_nodes)
+        return (internal.sum() - resolution * (totals ** 2).sum() / total_weight) / total_weight
+    communities = np.arange(num_nodes)
+    best_communities = communities.copy()
+    best_modularity = modularity(communities)
+    without_progress = 0
+    for _ in range(max_sweeps):
+        totals = np.bincount(communities, weights=degrees, minlength=num_nodes)
+        # Weight from each node to each neighbor community
+        keys, inverse = np.unique(rows * num_nodes + communities[cols], return_inverse=True)
+        community_weights = np.bincount(inverse, weights=weights)
+        nodes = keys // num_nodes
+        targets = keys % num_nodes
+        own = targets == communities[nodes]
+        target_totals = totals[targets] - np.where(own, degrees[nodes], 0.0)
+        gains = community_weights - resolution * target_totals * degrees[nodes] / total_weight
+        # Gain of staying in the own community
+        stay = -resolution * (totals[communities] - degrees) * degrees / total_weight
+        stay[nodes[own]] = gains[own]
+        # Best community of each node
+        order = np.lexsort((-gains, nodes))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = nodes[order][1:] != nodes[order][:-1]
+        best = order[first]
+        best_gains = np.full(num_nodes, -np.inf)
+        best_targets = communities.copy()
+        best_gains[nodes[best]] = gains[best]
+        best_targets[nodes[best]] = targets[best]
+        improves = best_gains > stay + 1e-12
+        if not improves.any():
+            break
+        move = improves & (random.rand(num_nodes) < 0.5)
+        communities = communities.copy()
+        communities[move] = best_targets[move]
+        current_modularity = modularity(communities)
+        if current_modularity > best_modularity + 1e-12:
+            best_modularity = current_modularity
+            best_communities = communities.copy()
+            without_progress = 0
+        else:
+            without_progress += 1
+            if without_progress >= patience:
+                break
+    return best_communities
+
+def kmeans(data, n_clusters, method="MiniBatch", n_init=10, batch_size=1024, 
+           max_iter=100, n_jobs=-1, random_state=0, chunk_size=100000):
+    """Clusters the spots with KMeans. The restarts (n_init) run in parallel
+    in different processes and the one with the lowest inertia is kept.
+    The methods are:
+    - Full: full batch KMeans (Lloyd)
+    - MiniBatch: mini-batch KMeans, each iteration uses batch_size random spots
+    When the data is a memory-mapped array (numpy.memmap or numpy.load(mmap_mode="r"))
+    it is never fully loaded, the mini-batches are streamed from the file 
+    (out-of-core) and the inertia and the labels are computed in chunks.
+    :param data: a numpy array or a numpy memory-mapped array (spots as rows)
+    :param n_clusters: the number of clusters
+    :param method: MiniBatch or Full
+    :param n_init: the number of restarts
+    :param batch_size: the number of spots of each mini-batch (MiniBatch)
+    :param max_iter: the maximum number of iterations (passes over the data with MiniBatch)
+    :param n_jobs: the number of processes (-1 for all the cores)
+    :param random_state: the seed
+    :param chunk_size: the number of spots to process at once when streaming
+    :return: a vector with the cluster (0 to n_clusters-1) of each spot
+    :raises: RuntimeError
+    """
+    if method not in ["MiniBatch", "Full"]:
+        raise RuntimeError("Error, incorrect KMeans method {}\n".format(method))
+    if n_clusters < 1 or n_clusters > data.shape[0]:
+        raise RuntimeError("Error, incorrect number of clusters {}\n".format(n_clusters))
+    # Memory-mapped arrays are opened again by the workers (not copied)
+    source = _data_source(data)
+    seeds = np.random.RandomState(random_state).randint(np.iinfo(np.int32).max, size=n_init)
+    tasks = [(n_clusters, method, batch_size, max_iter, seed, chunk_size) for seed in seeds]
+    n_jobs = multiprocessing.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+    n_jobs = min(n_jobs, n_init)
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs, initializer=_kmeans_init, initargs=(source,))
+        try:
+            results = pool.map(_kmeans_restart, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _kmeans_init(source)
+        results = [_kmeans_restart(task) for task in tasks]
+    _, centers = min(results, key=lambda result: result[0])
+    _kmeans_init(source)
+    data = _kmeans_data
+    _kmeans_init(None)
+    labels = np.empty(data.shape[0], dtype=np.int64)
+    for start in range(0, data.shape[0], chunk_size):
+        end = min(start + chunk_size, data.shape[0])
+        labels[start:end] = _nearest_centers(np.asarray(data[start:end], dtype=np.float64), 
+                                             centers)[0]
+    return labels
+
+# Data of the KMeans restarts (set in each worker process)
+_kmeans_data = None
+
+def _data_source(data):
+    """ Helper function of kmeans() and estimate_num_clusters() that 
+    returns the data to send to the worker processes: the location of
+    the file of a memory-mapped array (so it is not copied) or the array
+    """
+    if isinstance(data, np.memmap) and data.filename is not None:
+        return (data.filename, data.dtype.str, data.shape, data.offset,
+                "F" if np.isfortran(data) else "C")
+    return np.asarray(data, dtype=np.float64)
+
+def _open_source(source):
+    """ Helper function of kmeans() and estimate_num_clusters() that
+    returns the data of a source (memory-mapped arrays are opened again)
+    """
+    if isinstance(source, tuple):
+        filename, dtype, shape, offset, order = source
+        source = np.memmap(filename, dtype=np.dtype(dtype), mode="r",
+                           shape=shape, offset=offset, order=order)
+    return source
+
+def _kmeans_init(source):
+    """ Helper function of kmeans() that sets the data of
+    the restarts (memory-mapped arrays are opened again)
+    """
+    global _kmeans_data
+    _kmeans_data = _open_source(source)
+
+def _nearest_centers(points, centers):
+    """ Helper function of kmeans() that returns the nearest
+    center of each point and the squared distance to it
+    """
+    distances = (np.einsum("ij,ij->i", points, points)[:,np.newaxis] 
+                 - 2.0 * points.dot(centers.T) + np.einsum("ij,ij->i", centers, centers))
+    nearest = np.argmin(distances, axis=1)
+    return nearest, np.maximum(distances[np.arange(len(points)), nearest], 0.0)
+
+def _kmeans_restart(task):
+    """ Helper function of kmeans() that runs one restart
+    :return: a tuple with the inertia and the centers
+    """
+    n_clusters, method, batch_size, max_iter, seed, chunk_size = task
+    data = _kmeans_data
+    num_spots = data.shape[0]
+    if not isinstance(data, np.memmap):
+        if method == "Full":
+            model = KMeans(n_clusters=n_clusters, init="k-means++", n_init=1,
+                           max_iter=max_iter, random_state=seed).fit(data)
+        else:
+            model = MiniBatchKMeans(n_clusters=n_clusters, init="k-means++", n_init=1,
+                                    batch_size=batch_size, max_iter=max_iter,
+                                    random_state=seed).fit(data)
+        return model.inertia_, model.cluster_centers_
+    random = np.random.RandomState(seed)
+    # k-means++ seeding on a sample of the spots (sorted for sequential reads)
+    sample = np.sort(random.choice(num_spots, min(num_spots, max(3 * batch_size, 3 * n_clusters)),
+                                   replace=False))
+    centers, _ = kmeans_plusplus(np.asarray(data[sample], dtype=np.float64), n_clusters,
+                                 random_state=seed)
+    if method == "MiniBatch":
+        model = MiniBatchKMeans(n_clusters=n_clusters, init=centers, n_init=1,
+                                batch_size=batch_size, random_state=seed)
+        num_batches = int(np.ceil(num_spots / float(batch_size)))
+        previous = centers
+        for _ in range(max_iter):
+            # Each pass reads the mini-batches (contiguous blocks) in random order
+            for batch in random.permutation(num_batches):
+                start = batch * batch_size
+                model.partial_fit(np.asarray(data[start:start + batch_size], dtype=np.float64))
+            shift = ((model.cluster_centers_ - previous) ** 2).sum()
+            previous = model.cluster_centers_.copy()
+            if shift <= 1e-8 * (previous ** 2).sum():
+                break
+        centers = model.cluster_centers_
+    else:
+        # Lloyd iterations accumulating the sums of each cluster in chunks
+        for _ in range(max_iter):
+            sums = np.zeros(centers.shape)
+            sizes = np.zeros(n_clusters)
+            for start in range(0, num_spots, chunk_size):
+                points = np.asarray(data[start:start + chunk_size], dtype=np.float64)
+                nearest = _nearest_centers(points, centers)[0]
+                indicator = sp.csr_matrix((np.ones(len(nearest)), (nearest, np.arange(len(nearest)))),
+                                          shape=(n_clusters, len(nearest)))
+                sums += indicator.dot(points)
+                sizes += np.bincount(nearest, minlength=n_clusters)
+            # Empty clusters keep their center
+            new_centers = np.where(sizes[:,np.newaxis] > 0, 
+                                   sums / np.maximum(sizes, 1)[:,np.newaxis], centers)
+            shift = ((new_centers - centers) ** 2).sum()
+            centers = new_centers
+            if shift <= 1e-8 * (centers ** 2).sum():
+                break
+    inertia = 0.0
+    for start in range(0, num_spots, chunk_size):
+        points = np.asarray(data[start:start + chunk_size], dtype=np.float64)
+        inertia += _nearest_centers(points, centers)[1].sum()
+    return inertia, centers
+
+def estimate_num_clusters(data, min_clusters=2, max_clusters=20, kmeans_method="Full", 
+                          n_init=10, batch_size=1024, sample_size=5000, n_jobs=-1, random_state=0):
+    """Estimates the number of clusters of the spots from their 
+    dimensionality reduced coordinates (natively, an alternative to computeNClusters()).
+    The spots are clustered with KMeans (see kmeans()) for each candidate 
+    number of clusters (in parallel processes) and the one with the highest
+    mean silhouette (computed on a sample of sample_size spots) is chosen.
+    The labels of the chosen model are returned so they can be used directly.
+    Memory-mapped arrays are never fully loaded (see kmeans()).
+    :param data: a numpy array or a numpy memory-mapped array with 
+    the reduced coordinates (spots as rows)
+    :param min_clusters: the minimum number of clusters
+    :param max_clusters: the maximum number of clusters
+    :param kmeans_method: the KMeans method, Full or MiniBatch
+    :param n_init: the number of KMeans restarts
+    :param batch_size: the size of the KMeans mini-batches
+    :param sample_size: the number of spots used to compute the silhouette
+    :param n_jobs: the number of processes (-1 for all the cores)
+    :param random_state: the seed
+    :return: a tuple with the number of clusters and the KMeans 
+    labels (0 to N-1) of the chosen number of clusters
+    :raises: RuntimeError
+    """
+    source = _data_source(data)
+    num_spots = data.shape[0]
+    max_clusters = min(max_clusters, num_spots - 1)
+    min_clusters = max(min_clusters, 2)
+    if max_clusters < min_clusters:
+        raise RuntimeError("Error, not enough spots to estimate the number of clusters\n")
+    tasks = [(num_clusters, kmeans_method, n_init, batch_size, sample_size, random_state)
+             for num_clusters in range(min_clusters, max_clusters + 1)]
+    n_jobs = multiprocessing.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+    n_jobs = min(n_jobs, len(tasks))
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs, initializer=_candidate_init, initargs=(source,))
+        try:
+            results = pool.map(_candidate_clusters, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _candidate_init(source)
+        results = [_candidate_clusters(task) for task in tasks]
+    _candidate_init(None)
+    scores = [score for score, _ in results]
+    for task, score in zip(tasks, scores):
+        print("Number of clusters {} silhouette {:.4f}".format(task[0], score))
+    best = int(np.argmax(scores))
+    return tasks[best][0], results[best][1]
+
+def estimate_num_clusters_hierarchical(data, connectivity=None, min_clusters=2, max_clusters=20,
+                                       sample_size=5000, random_state=0):
+    """Estimates the number of clusters of the spots for the hierarchical
+    clustering (Ward) from their dimensionality reduced coordinates.
+    The Ward tree is built once and cut at each candidate number of clusters,
+    the one with the highest mean silhouette (computed on a sample
+    of sample_size spots) is chosen. The labels of the chosen cut are 
+    the same clusters as AgglomerativeClustering(linkage="ward") with the 
+    same connectivity so they can be used directly.
+    :param data: a numpy array with the reduced coordinates (spots as rows)
+    :param connectivity: the neighbors graph of the spots (see knn_graph()) or None
+    :param min_clusters: the minimum number of clusters
+    :param max_clusters: the maximum number of clusters
+    :param sample_size: the number of spots used to compute the silhouette
+    :param random_state: the seed
+    :return: a tuple with the number of clusters and the labels 
+    (0 to N-1) of the chosen number of clusters
+    :raises: RuntimeError
+    """
+    data = np.asarray(data, dtype=np.float64)
+    num_spots = data.shape[0]
+    max_clusters = min(max_clusters, num_spots - 1)
+    min_clusters = max(min_clusters, 2)
+    if max_clusters < min_clusters:
+        raise RuntimeError("Error, not enough spots to estimate the number of clusters\n")
+    children = ward_tree(data, connectivity=connectivity)[0]
+    sample = np.sort(np.random.RandomState(random_state).permutation(num_spots)[:sample_size])
+    # The merges are applied in order (union-find of the nodes of the tree)
+    # so the spots are in max_clusters clusters, then in one less, etc..
+    parents = np.arange(num_spots + len(children))
+    def root(node):
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+    def merge(step):
+        left, right = children[step]
+        parents[root(left)] = num_spots + step
+        parents[root(right)] = num_spots + step
+    for step in range(num_spots - max_clusters):
+        merge(step)
+    results = dict()
+    for num_clusters in range(max_clusters, min_clusters - 1, -1):
+        if num_clusters < max_clusters:
+            merge(num_spots - num_clusters - 1)
+        labels = np.unique([root(spot) for spot in range(num_spots)], return_inverse=True)[1]
+        score = silhouette_score(data[sample], labels[sample]) \
+            if len(np.unique(labels[sample])) > 1 else -1.0
+        results[num_clusters] = (score, labels.ravel())
+    for num_clusters in range(min_clusters, max_clusters + 1):
+        print("Number of clusters {} silhouette {:.4f}".format(num_clusters, results[num_clusters][0]))
+    best = max(range(min_clusters, max_clusters + 1), key=lambda k: (results[k][0], -k))
+    return best, results[best][1]
+
+# Data of the candidate clusterings (set in each worker process)
+_candidate_data = None
+
+def _candidate_init(source):
+    """ Helper function of estimate_num_clusters() that sets 
+    the data of the candidate clusterings (memory-mapped arrays are opened again)
+    """
+    global _candidate_data
+    _candidate_data = _open_source(source)
+
+def _candidate_clusters(task):
+    """ Helper function of estimate_num_clusters() that clusters
+    the spots with a candidate number of clusters
+    :return: a tuple with the mean silhouette and the labels
+    """
+    num_clusters, kmeans_method, n_init, batch_size, sample_size, random_state = task
+    data = _candidate_data
+    labels = kmeans(data, num_clusters, method=kmeans_method, n_init=n_init,
+                    batch_size=batch_size, n_jobs=1, random_state=random_state)
+    if len(np.unique(labels)) < 2:
+        return -1.0, labels
+    # Only the sampled spots are loaded (memory-mapped arrays)
+    sample = np.sort(np.random.RandomState(random_state).permutation(data.shape[0])[:sample_size])
+    score = silhouette_score(np.asarray(data[sample], dtype=np.float64), labels[sample])
+    return score, labels
@@ -0,0 +1,188 @@
+"""
+On-disk cache functions for the st analysis package.
+Entries are sets of NumPy arrays stored in a compact binary
+format (one .npy file per array) that are memory-mapped when loaded.
+Entries are grouped in namespaces and identified by a key (normally
+a content hash). The cache is bounded in size and the least recently
+used entries are evicted first.
+The cache is disabled unless a location is given, either with set_cache_dir()
+(the --cache-dir option of the scripts) or with the environment variable
+STANALYSIS_CACHE_DIR. The maximum size (bytes) can be set with the
+environment variable STANALYSIS_CACHE_MAX_SIZE (a maximum size of 0 disables the cache).
+"""
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+CACHE_DIR = os.environ.get("STANALYSIS_CACHE_DIR") or None
+CACHE_MAX_SIZE = int(os.environ.get("STANALYSIS_CACHE_MAX_SIZE", 10 * 1024 ** 3))
+
+def set_cache_dir(cache_dir, max_size=None):
+    """ Enables the cache in the given folder (or disables it)
+    :param cache_dir: the path to the folder of the cache (None to disable the cache)
+    :param max_size: the maximum size of the cache in bytes (default CACHE_MAX_SIZE)
+    """
+    global CACHE_DIR, CACHE_MAX_SIZE
+    CACHE_DIR = os.path.abspath(cache_dir) if cache_dir else None
+    if max_size is not None:
+        CACHE_MAX_SIZE = int(max_size)
+
+def cache_enabled():
+    """ Returns True if the cache is enabled
+    """
+    return CACHE_DIR is not None and CACHE_MAX_SIZE > 0
+
+def file_fingerprint(filename):
+    """ Returns a hash of the content of a file. The hash is stored
+    together with the size and modification time of the file so
+    it is only computed again when the file changes.
+    :param filename: the path to the file
+    :return: the hexadecimal SHA1 of the content of the file
+    """
+    filename = os.path.abspath(filename)
+    if not cache_enabled():
+        return _file_sha1(filename)
+    stat = os.stat(filename)
+    stamp_file = os.path.join(CACHE_DIR, "stamps",
+                              hashlib.sha1(filename.encode("utf-8")).hexdigest() + ".json")
+    try:
+        with open(stamp_file) as filehandler:
+            stamp = json.load(filehandler)
+        if stamp["size"] == stat.st_size and stamp["mtime"] == stat.st_mtime:
+            # Mark the stamp as recently used
+            os.utime(stamp_file, None)
+            return stamp["hash"]
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    stamp = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": _file_sha1(filename)}
+    try:
+        if not os.path.isdir(os.path.dirname(stamp_file)):
+            os.makedirs(os.path.dirname(stamp_file))
+        with open(stamp_file, "w") as filehandler:
+            json.dump(stamp, filehandler)
+    except (IOError, OSError):
+        pass
+    return stamp["hash"]
+
+def _file_sha1(filename):
+    """ Helper function of file_fingerprint() that hashes the content of a file
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as filehandler:
+        for block in iter(lambda: filehandler.read(1024 * 1024), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def array_fingerprint(arrays, *params):
+    """ Returns a hash of the content of a list of arrays (their bytes,
+    shapes and types) and some extra parameters (that are converted to text).
+    :param arrays: a list of numpy arrays
+    :param params: extra values to add to the hash (for instance method names)
+    :return: the hexadecimal SHA1
+    """
+    sha1 = hashlib.sha1()
+    for values in arrays:
+        values = np.ascontiguousarray(values)
+        sha1.update("{}{}".format(values.dtype.str, values.shape).encode("utf-8"))
+        sha1.update(values.reshape(-1).view(np.uint8))
+    sha1.update(repr(params).encode("utf-8"))
+    return sha1.hexdigest()
+
+def cache_get(namespace, key, mmap=True, writable=False):
+    """ Loads an entry from the cache.
+    :param namespace: the namespace of the entry
+    :param key: the key of the entry
+    :param mmap: True to memory-map the arrays instead of reading them
+    :param writable: True to memory-map the arrays copy-on-write (the arrays
+    can be modified, only the modified pages are copied and the entry is not changed)
+    :return: a dictionary of name -> numpy array or None if the entry is not present
+    """
+    if not cache_enabled():
+        return None
+    entry_dir = os.path.join(CACHE_DIR, namespace, key)
+    if not os.path.isdir(entry_dir):
+        return None
+    try:
+        arrays = dict()
+        for filename in os.listdir(entry_dir):
+            name, ext = os.path.splitext(filename)
+            if ext == ".npy":
+                arrays[name] = np.load(os.path.join(entry_dir, filename),
+                                       mmap_mode=("c" if writable else "r") if mmap else None,
+                                       allow_pickle=False)
+        # Mark the entry as recently used
+        os.utime(entry_dir, None)
+    except (IOError, OSError, ValueError):
+        return None
+    return arrays
+
+def cache_put(namespace, key, arrays):
+    """ Stores an entry in the cache and evicts the least
+    recently used entries if the cache is over its maximum size.
+    Errors writing to the cache are reported but not raised.
+    :param namespace: the namespace of the entry
+    :param key: the key of the entry
+    :param arrays: a dictionary of name -> numpy array
+    """
+    if not cache_enabled():
+        return
+    entry_dir = os.path.join(CACHE_DIR, namespace, key)
+    tmp_dir = "{}.tmp{}".format(entry_dir, os.getpid())
+    try:
+        if not os.path.isdir(tmp_dir):
+            os.makedirs(tmp_dir)
+        for name, values in arrays.items():
+            np.save(os.path.join(tmp_dir, name + ".npy"), np.asarray(values), allow_pickle=False)
+        # Entries appear atomically (another process may have stored it already)
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(tmp_dir)
+        else:
+            os.rename(tmp_dir, entry_dir)
+        cache_evict()
+    except (IOError, OSError) as e:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        print("Warning, could not write to the cache {} {}".format(CACHE_DIR, e))
+
+def cache_evict(max_size=None):
+    """ Removes the least recently used entries (and file stamps, see
+    file_fingerprint()) until the total size of the cache is below the maximum size.
+    :param max_size: the maximum size in bytes (default CACHE_MAX_SIZE)
+    """
+    if CACHE_DIR is None or not os.path.isdir(CACHE_DIR):
+        return
+    max_size = CACHE_MAX_SIZE if max_size is None else max_size
+    entries = list()
+    total_size = 0
+    for namespace in os.listdir(CACHE_DIR):
+        namespace_dir = os.path.join(CACHE_DIR, namespace)
+        if not os.path.isdir(namespace_dir):
+            continue
+        if namespace == "stamps":
+            # Each stamp is a small file, removing it only means hashing the file again
+            for filename in os.listdir(namespace_dir):
+                stamp_file = os.path.join(namespace_dir, filename)
+                entries.append((os.path.getmtime(stamp_file), 
+                                os.path.getsize(stamp_file), stamp_file))
+                total_size += entries[-1][1]
+            continue
+        for key in os.listdir(namespace_dir):
+            entry_dir = os.path.join(namespace_dir, key)
+            if ".tmp" in key or not os.path.isdir(entry_dir):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, filename))
+                       for filename in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+            total_size += size
+    for _, size, entry_dir in sorted(entries):
+        if total_size <= max_size:
+            break
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry_dir)
+            except OSError:
+                pass
+        total_size -= size
@@ -0,0 +1,422 @@
+"""
+Native differential expression analysis functions for the st analysis package.
+The counts of each gene are modelled with a negative binomial GLM
+(design ~ conditions) as in DESeq2: gene-wise dispersions (Cox-Reid adjusted
+profile likelihood), a fitted dispersion trend, shrinkage of the dispersions
+towards the trend (maximum a posteriori) and Wald tests for each contrast.
+The genes are processed in chunks (vectorized with NumPy) that are
+distributed over a pool of processes.
+The model is fitted once (fitNegativeBinomial()) and any number of
+contrasts can be evaluated on it (resultsNegativeBinomial()). The fitted
+models are stored in the on-disk cache (see stanalysis.cache) keyed by
+the counts, the conditions and the size factors so new contrasts and
+FDR thresholds do not need to fit the model again.
+"""
+import multiprocessing
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.special import gammaln, polygamma
+from scipy.stats import norm, trim_mean
+from stanalysis.normalization import estimateSizeFactorsForMatrix
+from stanalysis.cache import array_fingerprint, cache_get, cache_put, cache_enabled
+
+# Bounds of the dispersions (same as DESeq2)
+MIN_DISPERSION = 1e-8
+# Bound of the coefficients (natural log scale)
+MAX_COEFFICIENT = 30.0 * np.log(2.0)
+
+def deaNegativeBinomial(counts, conds, comparisons, alpha, size_factors=None,
+                        n_jobs=-1, chunk_size=500, use_cache=True):
+    """Performs D.E.A. natively (an in-process alternative to deaDESeq2())
+    in the given counts matrix with the given conditions and comparisons.
+    Can be given size factors (DESeq2 median of ratios otherwise).
+    :param counts: a matrix of counts (genes as rows) as a Pandas data frame,
+    a numpy array or a scipy sparse matrix
+    :param conds: the condition of each spot
+    :param comparisons: a list of tuples (A,B) (log2 fold changes are A vs B)
+    :param alpha: the FDR threshold used for the independent filtering
+    :param size_factors: the size factor of each spot
+    :param n_jobs: the number of processes (-1 for all the cores)
+    :param chunk_size: the number of genes to process at once
+    :param use_cache: False to always fit the model
+    :return: a list of data frames (one for each comparison) with the columns
+    baseMean, log2FoldChange, lfcSE, stat, pvalue and padj (genes as rows)
+    """
+    fit = fitNegativeBinomial(counts, conds, size_factors, n_jobs, chunk_size, use_cache)
+    return [resultsNegativeBinomial(fit, A, B, alpha) for A,B in comparisons]
+
+def dea_fingerprint(counts, conds, *params):
+    """ Returns a hash of a matrix of counts (genes as rows), the
+    gene names, the conditions of the spots and some extra parameters
+    to store fitted models in the cache.
+    :param counts: a matrix of counts (genes as rows) as a Pandas data frame,
+    a numpy array or a scipy sparse matrix
+    :param conds: the condition of each spot
+    :param params: extra values to add to the hash (for instance the size factors)
+    :return: the hexadecimal SHA1
+    """
+    genes = counts.index if isinstance(counts, pd.DataFrame) else np.arange(counts.shape[0])
+    values = counts.values if isinstance(counts, pd.DataFrame) else counts
+    if sp.issparse(values):
+        values = sp.csr_matrix(values)
+        arrays = [values.indptr, values.indices, values.data]
+    else:
+        arrays = [values]
+    arrays += [np.asarray(genes, dtype=str), np.asarray(conds, dtype=str)]
+    return array_fingerprint(arrays, counts.shape, *params)
+
+def fitNegativeBinomial(counts, conds, size_factors=None, n_jobs=-1, chunk_size=500,
+                        use_cache=True):
+    """Fits a negative binomial GLM (design ~ conditions) to the
+    counts of each gene as DESeq2::DESeq() does. The fitted model is
+    stored in the on-disk cache (see dea_fingerprint()).
+    :param counts: a matrix of counts (genes as rows) as a Pandas data frame,
+    a numpy array or a scipy sparse matrix
+    :param conds: the condition of each spot
+    :param size_factors: the size factor of each spot (DESeq2 median of ratios otherwise)
+    :param n_jobs: the number of processes (-1 for all the cores)
+    :param chunk_size: the number of genes to process at once
+    :param use_cache: False to always fit the model
+    :return: a dictionary of numpy arrays with the genes, the conditions, the baseMean,
+    the dispersions, the coefficients (log mean of each condition) and their variances
+    :raises: RuntimeError
+    """
+    cache_key = None
+    if use_cache and cache_enabled():
+        cache_key = dea_fingerprint(counts, conds, "NegativeBinomial", 
+                                    None if size_factors is None 
+                                    else array_fingerprint([np.asarray(size_factors, dtype=np.float64)]))
+        cached = cache_get("nb_fit", cache_key, mmap=False)
+        if cached is not None and "coefficients" in cached:
+            return cached
+    genes = np.asarray(counts.index if isinstance(counts, pd.DataFrame) 
+                       else np.arange(counts.shape[0]))
+    # Object arrays cannot be stored in the cache
+    if genes.dtype == object:
+        genes = genes.astype(str)
+    if isinstance(counts, pd.DataFrame):
+        counts = counts.values
+    num_genes, num_spots = counts.shape
+    conditions, groups = np.unique(np.asarray(conds, dtype=str), return_inverse=True)
+    if len(groups) != num_spots:
+        raise RuntimeError("Error, the number of conditions and spots is not the same\n")
+    if num_spots <= len(conditions):
+        raise RuntimeError("Error, the conditions have no replicates "
+                           "so the dispersions cannot be estimated\n")
+    if size_factors is None:
+        try:
+            size_factors = estimateSizeFactorsForMatrix(counts)
+        except RuntimeError:
+            # Every gene has zeroes (sparse data), library size factors are used instead
+            print("Warning, median of ratios size factors cannot be computed, "
+                  "using library size factors")
+            lib_size = np.asarray(counts.sum(axis=0), dtype=np.float64).ravel()
+            size_factors = lib_size / np.exp(np.mean(np.log(lib_size)))
+    size_factors = np.asarray(size_factors, dtype=np.float64)
+    # The spots are sorted by condition so the sums over the
+    # spots of each condition are contiguous
+    order = np.argsort(groups, kind="mergesort")
+    counts = sp.csr_matrix(counts)[:,order] if sp.issparse(counts) else counts[:,order]
+    data = {"counts": counts, "size_factors": size_factors[order],
+            "starts": np.searchsorted(groups[order], np.arange(len(conditions)))}
+    chunks = [(start, min(start + chunk_size, num_genes))
+              for start in range(0, num_genes, chunk_size)]
+    # Gene-wise dispersions
+    results = _dea_map(_genewise_dispersions, chunks, data, n_jobs)
+    base_mean, rough_disp, genewise_disp = [np.concatenate(values) for values in zip(*results)]
+    # Dispersion trend and prior variance of the log dispersions
+    max_disp = max(10.0, num_spots)
+    used = (genewise_disp >= 100 * MIN_DISPERSION) & (base_mean > 0)
+    if not used.any():
+        raise RuntimeError("Error, all the gene-wise dispersions are too small to fit a trend\n")
+    trend_coefs = _fitDispersionTrend(base_mean[used], genewise_disp[used])
+    trend_disp = _dispersionTrend(base_mean, trend_coefs)
+    residuals = np.log(genewise_disp[used]) - np.log(trend_disp[used])
+    var_log_residuals = (1.4826 * np.median(np.abs(residuals - np.median(residuals)))) ** 2
+    prior_var = max(var_log_residuals - polygamma(1, (num_spots - len(conditions)) / 2.0), 0.25)
+    # Maximum a posteriori dispersions and final fit
+    tasks = [(start, end, trend_disp[start:end], rough_disp[start:end], 
+              genewise_disp[start:end], prior_var, np.sqrt(var_log_residuals), max_disp)
+             for start, end in chunks]
+    results = _dea_map(_map_dispersions_fit, tasks, data, n_jobs)
+    dispersions, coefficients, variances = [np.concatenate(values) for values in zip(*results)]
+    fit = {"genes": genes, "conditions": conditions, "base_mean": base_mean,
+           "dispersions": dispersions, "coefficients": coefficients, "variances": variances}
+    if cache_key is not None:
+        cache_put("nb_fit", cache_key, fit)
+    return fit
+
+def resultsNegativeBinomial(fit, A, B, alpha=0.1):
+    """Performs the Wald test of the contrast A vs B on a
+    model fitted with fitNegativeBinomial() as DESeq2::results() does
+    (adjusted p-values with Benjamini-Hochberg and independent filtering
+    on the mean of the normalized counts).
+    :param fit: the model returned by fitNegativeBinomial()
+    :param A: the condition in the numerator
+    :param B: the condition in the denominator
+    :param alpha: the FDR threshold used for the independent filtering
+    :return: a data frame with the columns baseMean, log2FoldChange, lfcSE,
+    stat, pvalue and padj (genes as rows)
+    :raises: RuntimeError
+    """
+    conditions = list(fit["conditions"])
+    if A not in conditions or B not in conditions:
+        raise RuntimeError("Error, incorrect contrast {} vs {}\n".format(A, B))
+    a, b = conditions.index(A), conditions.index(B)
+    coefficients = fit["coefficients"]
+    variances = fit["variances"]
+    base_mean = np.asarray(fit["base_mean"])
+    lfc = (coefficients[:,a] - coefficients[:,b]) / np.log(2.0)
+    lfc_se = np.sqrt(variances[:,a] + variances[:,b]) / np.log(2.0)
+    stat = lfc / lfc_se
+    pvalue = 2.0 * norm.sf(np.abs(stat))
+    # Genes without counts are not tested
+    zero = base_mean == 0
+    lfc[zero] = lfc_se[zero] = stat[zero] = pvalue[zero] = np.nan
+    padj = _independentFiltering(pvalue, base_mean, alpha)
+    return pd.DataFrame({"baseMean": base_mean, "log2FoldChange": lfc, "lfcSE": lfc_se,
+                         "stat": stat, "pvalue": pvalue, "padj": padj},
+                        index=fit["genes"],
+                        columns=["baseMean", "log2FoldChange", "lfcSE", "stat", "pvalue", "padj"])
+
+def p_adjust_bh(pvalues):
+    """ Adjusts p-values with the Benjamini-Hochberg method
+    (as R p.adjust(method="BH")), NaN values are ignored
+    :param pvalues: a vector of p-values
+    :return: a vector with the adjusted p-values
+    """
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    padj = np.full(len(pvalues), np.nan)
+    tested = np.flatnonzero(~np.isnan(pvalues))
+    if len(tested) == 0:
+        return padj
+    order = tested[np.argsort(pvalues[tested])[::-1]]
+    ranks = np.arange(len(tested), 0, -1)
+    padj[order] = np.minimum(1.0, np.minimum.accumulate(pvalues[order] * len(tested) / ranks))
+    return padj
+
+def _independentFiltering(pvalue, base_mean, alpha, num_thetas=50):
+    """ Helper function of resultsNegativeBinomial() that adjusts the p-values
+    of the genes whose baseMean is above the quantile that maximizes
+    the number of rejections (as DESeq2 does, the number of rejections
+    is smoothed with a moving average instead of lowess).
+    :return: a vector with the adjusted p-values (NaN for the filtered genes)
+    """
+    lower = np.mean(base_mean == 0)
+    thetas = np.linspace(lower, 0.95, num_thetas) if lower < 0.95 else np.array([lower])
+    cutoffs = np.quantile(base_mean, thetas)
+    all_padj = list()
+    num_rejections = np.zeros(len(thetas))
+    for i, cutoff in enumerate(cutoffs):
+        padj = p_adjust_bh(np.where(base_mean > cutoff if i > 0 else base_mean >= cutoff,
+                                    pvalue, np.nan))
+        all_padj.append(padj)
+        num_rejections[i] = np.sum(padj < alpha)
+    if num_rejections.max() <= 10:
+        return all_padj[0]
+    fitted = np.convolve(np.pad(num_rejections, 2, mode="edge"), np.ones(5) / 5.0, mode="valid")
+    residuals = num_rejections[num_rejections > 0] - fitted[num_rejections > 0]
+    threshold = fitted.max() - np.sqrt(np.mean(residuals ** 2))
+    best = np.flatnonzero(num_rejections > threshold)
+    return all_padj[best[0] if len(best) > 0 else 0]
+
+def _fitDispersionTrend(base_mean, dispersions, max_iter=10):
+    """ Helper function of fitNegativeBinomial() that fits the
+    parametric dispersion trend (asymptotic + extra / baseMean) with
+    a gamma GLM (identity link) iteratively removing outliers as DESeq2 does.
+    If the fit fails the trend is the (trimmed) mean of the dispersions.
+    :return: a tuple with the coefficients (asymptotic, extra)
+    """
+    coefs = np.array([0.1, 1.0])
+    design = np.column_stack([np.ones(len(base_mean)), 1.0 / base_mean])
+    for _ in range(max_iter):
+        ratio = dispersions / design.dot(coefs)
+        good = (ratio > 1e-4) & (ratio < 15)
+        new_coefs = coefs
+        # Gamma GLM with identity link (IRLS, the weights are 1 / fitted^2)
+        for _ in range(25):
+            fitted = design[good].dot(new_coefs)
+            if np.any(fitted <= 0):
+                break
+            weights = 1.0 / fitted
+            previous = new_coefs
+            new_coefs = np.linalg.lstsq(design[good] * weights[:,np.newaxis],
+                                        dispersions[good] * weights, rcond=None)[0]
+            if np.allclose(new_coefs, previous, rtol=1e-8, atol=0.0):
+                break
+        if np.any(new_coefs <= 0):
+            print("Warning, the parametric dispersion trend failed, using the mean dispersion")
+            return np.array([trim_mean(dispersions, 0.001), 0.0])
+        converged = np.sum(np.log(new_coefs / coefs) ** 2) < 1e-6
+        coefs = new_coefs
+        if converged:
+            break
+    return coefs
+
+def _dispersionTrend(base_mean, coefs):
+    """ Helper function that evaluates the dispersion trend
+    """
+    with np.errstate(divide="ignore"):
+        trend = coefs[0] + coefs[1] / base_mean
+    return np.where(np.isfinite(trend), trend, coefs[0] + coefs[1])
+
+# Data of the D.E.A. (set in each worker process)
+_dea_data = None
+
+def _dea_init(data):
+    """ Helper function that sets the data of the D.E.A. tasks
+    """
+    global _dea_data
+    _dea_data = data
+
+def _dea_map(function, tasks, data, n_jobs):
+    """ Helper function that runs the tasks in a pool of processes
+    that share the data of the D.E.A. (not copied with fork)
+    :return: the list of results
+    """
+    n_jobs = multiprocessing.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+    n_jobs = min(n_jobs, len(tasks))
+    if n_jobs <= 1:
+        _dea_init(data)
+        try:
+            return [function(task) for task in tasks]
+        finally:
+            _dea_init(None)
+    pool = multiprocessing.Pool(n_jobs, initializer=_dea_init, initargs=(data,))
+    try:
+        return pool.map(function, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+def _chunk_counts(start, end):
+    """ Helper function that returns the dense counts of a chunk of genes
+    """
+    counts = _dea_data["counts"][start:end]
+    counts = counts.toarray() if sp.issparse(counts) else counts
+    return np.asarray(counts, dtype=np.float64)
+
+def _group_sums(values, starts):
+    """ Helper function that sums the values (genes x spots)
+    of the spots of each condition
+    """
+    return np.add.reduceat(values, starts, axis=1)
+
+def _fit_coefficients(counts, size_factors, starts, dispersions, max_iter=50):
+    """ Helper function that fits the coefficients (log mean of each condition)
+    of each gene with Newton iterations (the design matrix of the conditions
+    makes the information matrix diagonal).
+    :return: a tuple with the coefficients and their variances (genes x conditions)
+    """
+    sizes = np.diff(np.append(starts, counts.shape[1]))
+    norm_means = _group_sums(counts / size_factors, starts) / sizes
+    coefs = np.log(np.maximum(norm_means, np.exp(-MAX_COEFFICIENT)))
+    group_of_spot = np.repeat(np.arange(len(starts)), sizes)
+    disp = dispersions[:,np.newaxis]
+    for _ in range(max_iter):
+        mu = np.exp(coefs)[:,group_of_spot] * size_factors
+        scaling = 1.0 / (1.0 + disp * mu)
+        step = _group_sums((counts - mu) * scaling, starts) / _group_sums(mu * scaling, starts)
+        coefs = np.clip(coefs + step, -MAX_COEFFICIENT, MAX_COEFFICIENT)
+        if np.max(np.abs(step)) < 1e-6:
+            break
+    mu = np.exp(coefs)[:,group_of_spot] * size_factors
+    variances = 1.0 / _group_sums(mu / (1.0 + disp * mu), starts)
+    return coefs, variances, mu
+
+def _log_gamma_ratio(counts, inv_disp):
+    """ Helper function that computes lgamma(counts + r) - lgamma(r) avoiding
+    the cancellation for large values of r (small dispersions)
+    """
+    small = inv_disp < 1e6
+    ratio = np.empty(counts.shape)
+    ratio[small] = gammaln(counts[small] + inv_disp[small]) - gammaln(inv_disp[small])
+    large = ~small
+    ratio[large] = counts[large] * np.log(inv_disp[large]) + \
+        counts[large] * (counts[large] - 1.0) / (2.0 * inv_disp[large])
+    return ratio
+
+def _log_posterior(log_disp, counts, mu, starts, nonzero, prior_mean=None, prior_var=None):
+    """ Helper function that computes the Cox-Reid adjusted profile log likelihood
+    of the dispersions of each gene (and the log prior if given)
+    """
+    disp = np.exp(log_disp)
+    mu_disp = mu * disp[:,np.newaxis]
+    # The terms of the zero counts are only -r * log(1 + dispersion * mu)
+    loglik = -(np.log1p(mu_disp) / disp[:,np.newaxis]).sum(axis=1)
+    rows, cols = nonzero
+    values = counts[rows, cols]
+    loglik += np.bincount(rows, weights=_log_gamma_ratio(values, 1.0 / disp[rows])
+                          + values * (np.log(mu_disp[rows, cols]) - np.log1p(mu_disp[rows, cols])),
+                          minlength=len(disp))
+    # Cox-Reid adjustment (the information matrix is diagonal)
+    loglik -= 0.5 * np.log(_group_sums(mu / (1.0 + mu_disp), starts)).sum(axis=1)
+    if prior_mean is not None:
+        loglik -= (log_disp - prior_mean) ** 2 / (2.0 * prior_var)
+    return loglik
+
+def _maximize_dispersions(counts, mu, starts, max_disp, prior_mean=None,
+                          prior_var=None, num_points=20, num_refinements=3):
+    """ Helper function that maximizes the (adjusted) likelihood of the dispersion
+    of each gene with a grid search on the log dispersions refined around the
+    maximum of each gene.
+    :return: the dispersion of each gene
+    """
+    num_genes = counts.shape[0]
+    nonzero = np.nonzero(counts)
+    grid = np.linspace(np.log(MIN_DISPERSION), np.log(max_disp), num_points)
+    values = np.array([_log_posterior(np.full(num_genes, log_disp), counts, mu, starts,
+                                      nonzero, prior_mean, prior_var) for log_disp in grid])
+    best = grid[np.argmax(values, axis=0)]
+    step = grid[1] - grid[0]
+    for _ in range(num_refinements):
+        offsets = np.linspace(-step, step, 11)
+        candidates = np.clip(best[np.newaxis,:] + offsets[:,np.newaxis],
+                             np.log(MIN_DISPERSION), np.log(max_disp))
+        values = np.array([_log_posterior(log_disp, counts, mu, starts, nonzero,
+                                          prior_mean, prior_var) for log_disp in candidates])
+        best = candidates[np.argmax(values, axis=0), np.arange(num_genes)]
+        step = offsets[1] - offsets[0]
+    return np.exp(best)
+
+def _genewise_dispersions(task):
+    """ Helper function of fitNegativeBinomial() that computes the baseMean,
+    a rough (moments) dispersion and the gene-wise dispersion of a chunk of genes
+    :return: a tuple with the three vectors
+    """
+    start, end = task
+    counts = _chunk_counts(start, end)
+    size_factors = _dea_data["size_factors"]
+    starts = _dea_data["starts"]
+    num_spots = counts.shape[1]
+    norm_counts = counts / size_factors
+    base_mean = norm_counts.mean(axis=1)
+    # Rough dispersions from the moments (as initial values)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rough_disp = (norm_counts.var(axis=1, ddof=1) - base_mean * np.mean(1.0 / size_factors)) \
+            / base_mean ** 2
+    max_disp = max(10.0, num_spots)
+    rough_disp = np.clip(np.nan_to_num(rough_disp), MIN_DISPERSION, max_disp)
+    mu = _fit_coefficients(counts, size_factors, starts, rough_disp)[2]
+    genewise_disp = _maximize_dispersions(counts, mu, starts, max_disp)
+    return base_mean, rough_disp, genewise_disp
+
+def _map_dispersions_fit(task):
+    """ Helper function of fitNegativeBinomial() that computes the maximum
+    a posteriori dispersions of a chunk of genes (the prior is centered at the trend)
+    and fits the coefficients with them. The dispersion outliers (more than
+    two standard deviations above the trend) keep their gene-wise dispersion.
+    :return: a tuple with the dispersions, the coefficients and their variances
+    """
+    start, end, trend_disp, rough_disp, genewise_disp, prior_var, residuals_sd, max_disp = task
+    counts = _chunk_counts(start, end)
+    size_factors = _dea_data["size_factors"]
+    starts = _dea_data["starts"]
+    mu = _fit_coefficients(counts, size_factors, starts, rough_disp)[2]
+    map_disp = _maximize_dispersions(counts, mu, starts, max_disp,
+                                     np.log(trend_disp), prior_var)
+    outliers = np.log(genewise_disp) > np.log(trend_disp) + 2.0 * residuals_sd
+    dispersions = np.where(outliers, genewise_disp, map_disp)
+    coefs, variances, _ = _fit_coefficients(counts, size_factors, starts, dispersions)
+    return dispersions, coefs, variances
@@ -0,0 +1,150 @@
+"""
+Nearest neighbors graph functions for the st analysis package.
+The k nearest neighbors graph of a set of spots is built once
+(exact for small datasets and approximate with random projection trees
+refined with NN-descent for large ones) and it is shared by the
+methods that need neighbors (t-SNE affinities, connectivity constrained
+Ward clustering, DBSCAN and graph clustering).
+The graph is a scipy sparse matrix (spots x spots) with the euclidean
+distances to the k nearest neighbors of each spot (itself excluded) in each row.
+"""
+import numpy as np
+import scipy.sparse as sp
+from sklearn.neighbors import NearestNeighbors
+
+# Number of spots from which the approximate method is used by default
+APPROXIMATE_MIN_SPOTS = 50000
+
+def knn_graph(data, n_neighbors=15, method="auto", n_trees=None, leaf_size=None,
+              n_iter=2, max_candidates=60, random_state=0, chunk_size=1024):
+    """ Computes the k nearest neighbors graph of a set of spots.
+    :param data: a numpy array or a scipy sparse matrix (spots as rows)
+    :param n_neighbors: the number of neighbors of each spot
+    :param method: exact, approximate or auto (approximate for more than
+    APPROXIMATE_MIN_SPOTS spots with more than 3 dimensions)
+    :param n_trees: the number of random projection trees (approximate)
+    :param leaf_size: the maximum number of spots in the leaves of the trees (approximate)
+    :param n_iter: the number of NN-descent iterations (approximate)
+    :param max_candidates: the number of neighbors of neighbors evaluated per spot
+    in each NN-descent iteration (approximate)
+    :param random_state: the seed
+    :param chunk_size: the number of spots to process at once
+    :return: a scipy CSR matrix (spots x spots) with the distances to the neighbors
+    :raises: RuntimeError
+    """
+    if sp.issparse(data):
+        data = data.toarray()
+    data = np.asarray(data, dtype=np.float64)
+    num_spots = data.shape[0]
+    n_neighbors = min(n_neighbors, num_spots - 1)
+    if n_neighbors < 1:
+        raise RuntimeError("Error, at least two spots are needed to compute neighbors\n")
+    if method == "auto":
+        method = "approximate" if num_spots > APPROXIMATE_MIN_SPOTS and data.shape[1] > 3 \
+            else "exact"
+    if method == "exact":
+        model = NearestNeighbors(n_neighbors=n_neighbors).fit(data)
+        return model.kneighbors_graph(mode="distance").tocsr()
+    elif method != "approximate":
+        raise RuntimeError("Error, incorrect neighbors method {}\n".format(method))
+
+    random = np.random.RandomState(random_state)
+    n_trees = n_trees if n_trees is not None else \
+        min(32, 5 + int(round(num_spots ** 0.25)))
+    leaf_size = max(leaf_size if leaf_size is not None else 0, 2 * (n_neighbors + 1), 64)
+    indices = np.full((num_spots, n_neighbors), -1, dtype=np.int64)
+    distances = np.full((num_spots, n_neighbors), np.inf)
+    # The nearest spots in the same leaf of each tree are candidates
+    for _ in range(n_trees):
+        leaf_indices = np.full((num_spots, n_neighbors), -1, dtype=np.int64)
+        leaf_distances = np.full((num_spots, n_neighbors), np.inf)
+        for leaf in _random_projection_leaves(data, leaf_size, random):
+            points = data[leaf]
+            sq_norms = np.einsum("ij,ij->i", points, points)
+            leaf_dist = sq_norms[:,np.newaxis] + sq_norms - 2.0 * points.dot(points.T)
+            np.fill_diagonal(leaf_dist, np.inf)
+            size = min(n_neighbors, len(leaf) - 1)
+            if size < 1:
+                continue
+            nearest = np.argpartition(leaf_dist, size - 1, axis=1)[:,:size]
+            leaf_indices[leaf,:size] = leaf[nearest]
+            leaf_distances[leaf,:size] = np.sqrt(np.maximum(
+                np.take_along_axis(leaf_dist, nearest, axis=1), 0.0))
+        indices, distances = _merge_neighbors(indices, distances, leaf_indices, leaf_distances)
+    # NN-descent, the neighbors of the neighbors are candidates
+    for _ in range(n_iter):
+        candidates = _sample_neighbors_of_neighbors(indices, max_candidates, random)
+        candidate_distances = np.empty(candidates.shape)
+        for start in range(0, num_spots, chunk_size):
+            end = min(start + chunk_size, num_spots)
+            diff = data[candidates[start:end]] - data[start:end,np.newaxis,:]
+            candidate_distances[start:end] = np.sqrt(np.einsum("ijk,ijk->ij", diff, diff))
+        candidate_distances[candidates < 0] = np.inf
+        indices, distances = _merge_neighbors(indices, distances, candidates, candidate_distances)
+    # Spots without enough candidates are searched exactly
+    missing = np.flatnonzero((indices < 0).any(axis=1))
+    if len(missing) > 0:
+        model = NearestNeighbors(n_neighbors=n_neighbors + 1).fit(data)
+        exact_distances, exact_indices = model.kneighbors(data[missing])
+        for row, spot in enumerate(missing):
+            keep = exact_indices[row] != spot
+            indices[spot] = exact_indices[row][keep][:n_neighbors]
+            distances[spot] = exact_distances[row][keep][:n_neighbors]
+    return sp.csr_matrix((distances.ravel(), indices.ravel(),
+                          np.arange(0, num_spots * n_neighbors + 1, n_neighbors)),
+                         shape=(num_spots, num_spots))
+
+def _random_projection_leaves(data, leaf_size, random):
+    """ Helper function that splits the spots recursively with random
+    hyperplanes (equidistant to two random spots) until the groups have
+    at most leaf_size spots.
+    :return: a list with the positions of the spots of each leaf
+    """
+    leaves = list()
+    stack = [np.arange(data.shape[0])]
+    while stack:
+        positions = stack.pop()
+        if len(positions) <= leaf_size:
+            leaves.append(positions)
+            continue
+        first, second = data[random.choice(positions, 2, replace=False)]
+        normal = first - second
+        side = data[positions].dot(normal) > normal.dot((first + second) / 2.0)
+        # Duplicated spots cannot be split by a hyperplane
+        if side.all() or not side.any():
+            side = random.rand(len(positions)) < 0.5
+        stack.append(positions[side])
+        stack.append(positions[~side])
+    return leaves
+
+def _sample_neighbors_of_neighbors(indices, max_candidates, random):
+    """ Helper function that returns (for each spot) a random sample
+    of max_candidates neighbors of its neighbors (-1 if unknown).
+    """
+    num_spots, n_neighbors = indices.shape
+    num_candidates = min(max_candidates, n_neighbors * n_neighbors)
+    samples = random.randint(0, n_neighbors * n_neighbors, size=(num_spots, num_candidates))
+    neighbors = np.take_along_axis(indices, samples // n_neighbors, axis=1)
+    candidates = indices[neighbors, samples % n_neighbors]
+    candidates[neighbors < 0] = -1
+    return candidates
+
+def _merge_neighbors(indices, distances, new_indices, new_distances):
+    """ Helper function that keeps the nearest neighbors (unique and 
+    excluding the spot itself) of each spot from two sets of neighbors.
+    :return: a tuple with the indices and the distances (spots x n_neighbors),
+    -1 and inf when a spot has not enough neighbors
+    """
+    num_spots, n_neighbors = indices.shape
+    merged_indices = np.hstack([indices, new_indices])
+    merged_distances = np.hstack([distances, new_distances])
+    order = np.argsort(merged_indices, axis=1, kind="mergesort")
+    merged_indices = np.take_along_axis(merged_indices, order, axis=1)
+    merged_distances = np.take_along_axis(merged_distances, order, axis=1)
+    invalid = (merged_indices < 0) | (merged_indices == np.arange(num_spots)[:,np.newaxis])
+    invalid[:,1:] |= merged_indices[:,1:] == merged_indices[:,:-1]
+    merged_distances[invalid] = np.inf
+    merged_indices[invalid] = -1
+    nearest = np.argsort(merged_distances, axis=1, kind="mergesort")[:,:n_neighbors]
+    return np.take_along_axis(merged_indices, nearest, axis=1), \
+        np.take_along_axis(merged_distances, nearest, axis=1)
@@ -3,23 +3,121 @@ Normalization functions for the st analysis package
 """
 import numpy as np
 import pandas as pd
-from collections import Counter
-import multiprocessing
-import rpy2.robjects.packages as rpackages
-from rpy2.robjects import pandas2ri, r, numpy2ri
-import rpy2.robjects as ro
-ro.conversion.py2ri = numpy2ri
-base = rpackages.importr("base")
+import scipy.sparse as sp
+from scipy.sparse.linalg import lsqr
+from scipy.stats import rankdata
+from sklearn.decomposition import TruncatedSVD
+from sklearn.cluster import KMeans
+from stanalysis.rsession import RimportLibrary, RregisterParallel, Rtimer, Rmatrix, Rnumpy
 
-def RimportLibrary(lib_name):
-    """ Helper function to import R libraries
-    using the rpy2 binder
+def dense_chunks(counts, chunk_size=256):
+    """ Iterates a matrix of counts (genes as rows) in chunks
+    of spots (columns) so that only one chunk at a time is dense.
+    :param counts: a numpy array or a scipy sparse matrix (genes as rows)
+    :param chunk_size: the number of spots in each chunk
+    :return: a generator of tuples (start, end, dense chunk)
     """
-    if not rpackages.isinstalled(lib_name):
-        base.source("http://www.bioconductor.org/biocLite.R")
-        biocinstaller = rpackages.importr("BiocInstaller")
-        biocinstaller.biocLite(lib_name)
-    return rpackages.importr(lib_name)
+    if sp.issparse(counts):
+        counts = counts.tocsc()
+    num_spots = counts.shape[1]
+    for start in range(0, num_spots, chunk_size):
+        end = min(start + chunk_size, num_spots)
+        chunk = counts[:,start:end]
+        yield start, end, chunk.toarray() if sp.issparse(chunk) else chunk
+
+def calcNormFactors(counts, method="TMM", logratio_trim=0.3, sum_trim=0.05,
+                    do_weighting=True, a_cutoff=-1e10, chunk_size=256):
+    """ Native implementation of edgeR::calcNormFactors() for 
+    the TMM and RLE methods. The spots are processed in chunks 
+    and each chunk is computed at once with vectorized operations.
+    :param counts: a matrix of counts (genes as rows) as a Pandas data frame,
+    a numpy array or a scipy sparse matrix
+    :param method: the method to use (TMM or RLE)
+    :param logratio_trim: the amount of trim to use on log-ratios (TMM)
+    :param sum_trim: the amount of trim to use on the absolute expression (TMM)
+    :param do_weighting: True to compute asymptotic binomial precision weights (TMM)
+    :param a_cutoff: cutoff on the absolute expression (TMM)
+    :param chunk_size: the number of spots to process at once
+    :return returns the normalization factors a vector (they multiply to one)
+    """
+    if isinstance(counts, pd.DataFrame):
+        counts = counts.values
+    if sp.issparse(counts):
+        counts = sp.csr_matrix(counts, dtype=np.float64)
+        counts.eliminate_zeros()
+        lib_size = np.asarray(counts.sum(axis=0)).ravel()
+        # Remove the genes with all zero counts
+        counts = counts[np.diff(counts.indptr) > 0]
+    else:
+        counts = np.asarray(counts, dtype=np.float64)
+        lib_size = counts.sum(axis=0)
+        counts = counts[(counts > 0).any(axis=1)]
+    num_genes, num_spots = counts.shape
+    if num_genes == 0 or num_spots == 1:
+        return np.ones(num_spots)
+    factors = np.empty(num_spots)
+    if method == "TMM":
+        # The reference spot is the one whose upper quartile is closest to the mean
+        f75 = np.empty(num_spots)
+        for start, end, chunk in dense_chunks(counts, chunk_size):
+            f75[start:end] = np.percentile(chunk, 75, axis=0) / lib_size[start:end]
+        if np.median(f75) < 1e-20:
+            sqrt_sums = np.asarray((counts.sqrt() if sp.issparse(counts) 
+                                    else np.sqrt(counts)).sum(axis=0)).ravel()
+            ref_column = np.argmax(sqrt_sums)
+        else:
+            ref_column = np.argmin(np.abs(f75 - np.mean(f75)))
+        ref = counts[:,ref_column]
+        ref = ref.toarray().ravel() if sp.issparse(ref) else ref
+        # Only the genes present in the reference can give finite ratios
+        genes = ref > 0
+        counts = counts[genes]
+        n_ref = lib_size[ref_column]
+        ref_prop = (ref[genes] / n_ref)[:,np.newaxis]
+        var_ref = ((n_ref - ref[genes]) / n_ref / ref[genes])[:,np.newaxis]
+        for start, end, obs in dense_chunks(counts, chunk_size):
+            n_obs = lib_size[start:end]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                log_ratio = np.log2((obs / n_obs) / ref_prop)
+                abs_exp = (np.log2(obs / n_obs) + np.log2(ref_prop)) / 2
+                variance = (n_obs - obs) / n_obs / obs + var_ref
+            finite = np.isfinite(log_ratio) & np.isfinite(abs_exp) & (abs_exp > a_cutoff)
+            # Non finite values are ranked last so they do not affect the trimming
+            rank_ratio = rankdata(np.where(finite, log_ratio, np.inf), axis=0)
+            rank_exp = rankdata(np.where(finite, abs_exp, np.inf), axis=0)
+            n = finite.sum(axis=0)
+            lo_l = np.floor(n * logratio_trim) + 1
+            hi_l = n + 1 - lo_l
+            lo_s = np.floor(n * sum_trim) + 1
+            hi_s = n + 1 - lo_s
+            keep = finite & (rank_ratio >= lo_l) & (rank_ratio <= hi_l) \
+                   & (rank_exp >= lo_s) & (rank_exp <= hi_s)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                if do_weighting:
+                    f = np.where(keep, log_ratio / variance, 0).sum(axis=0) \
+                        / np.where(keep, 1 / variance, 0).sum(axis=0)
+                else:
+                    f = np.where(keep, log_ratio, 0).sum(axis=0) / keep.sum(axis=0)
+            max_ratio = np.where(finite, np.abs(log_ratio), 0).max(axis=0)
+            f[~np.isfinite(f) | (max_ratio < 1e-6)] = 0
+            factors[start:end] = 2 ** f
+    elif method == "RLE":
+        # Only the genes present in every spot have a geometric mean > 0
+        if sp.issparse(counts):
+            counts = counts[np.diff(counts.indptr) == num_spots]
+        loggeomeans = np.zeros(counts.shape[0])
+        with np.errstate(divide="ignore"):
+            for start, end, chunk in dense_chunks(counts, chunk_size):
+                loggeomeans += np.log(chunk).sum(axis=1)
+        geomeans = np.exp(loggeomeans / num_spots)
+        genes = geomeans > 0
+        for start, end, chunk in dense_chunks(counts[genes], chunk_size):
+            factors[start:end] = np.median(chunk / geomeans[genes,np.newaxis], axis=0)
+        factors = factors / lib_size
+    else:
+        raise RuntimeError("Error, incorrect normalization method\n")
+    # Factors should multiply to one
+    return factors / np.exp(np.mean(np.log(factors)))
 
 def computeTMMFactors(counts):
     """ Compute normalization size factors
@@ -27,17 +125,8 @@ def computeTMMFactors(counts):
     :param counts: a matrix of counts (genes as rows)
     :return returns the normalization factors a vector
     """
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
-    edger = RimportLibrary("edgeR")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-    as_matrix = r["as.matrix"]
-    dds = edger.calcNormFactors(as_matrix(r_counts), method="TMM")
-    pandas_sf = pandas2ri.ri2py(dds)
-    pandas_cm = pandas2ri.ri2py(r.colSums(counts))
-    pandas2ri.deactivate()
-    return pandas_sf * pandas_cm
+    lib_size = np.asarray(counts.sum(axis=0), dtype=np.float64).ravel()
+    return calcNormFactors(counts, method="TMM") * lib_size
 
 def computeRLEFactors(counts):
     """ Compute normalization size factors
@@ -45,74 +134,277 @@ def computeRLEFactors(counts):
     :param counts: a matrix of counts (genes as rows)
     :return returns the normalization factors a vector
     """
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
-    edger = RimportLibrary("edgeR")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-    as_matrix = r["as.matrix"]
-    dds = edger.calcNormFactors(as_matrix(r_counts), method="RLE")
-    pandas_sf = pandas2ri.ri2py(dds)
-    pandas_cm = pandas2ri.ri2py(r.colSums(counts))
-    pandas2ri.deactivate()
-    return pandas_sf * pandas_cm
+    lib_size = np.asarray(counts.sum(axis=0), dtype=np.float64).ravel()
+    return calcNormFactors(counts, method="RLE") * lib_size
 
-def computeSumFactors(counts, scran_clusters=True):
-    """ Compute normalization factors
-    using the deconvolution method
-    described in Merioni et al.
-    Returns the computed size factors as a vector.
-    :param counts: a matrix of counts (genes as rows)
+def quickCluster(counts, min_size=10, num_components=20, random_state=0):
+    """ Native replacement of scran::quickCluster() to group spots with
+    similar expression before computing size factors with computeSumFactors().
+    The log of the library size normalized counts is projected with a 
+    truncated SVD and the projections are clustered with KMeans. Clusters
+    smaller than min_size are merged into the nearest cluster.
+    :param counts: a matrix of counts (genes as rows) as a Pandas data frame,
+    a numpy array or a scipy sparse matrix
+    :param min_size: the minimum number of spots of each cluster
+    :param num_components: the number of components of the SVD
+    :param random_state: the seed of the SVD and KMeans
+    :return: a vector with the cluster (0 to N-1) of each spot
+    """
+    if isinstance(counts, pd.DataFrame):
+        counts = counts.values
+    num_spots = counts.shape[1]
+    num_clusters = max(int(num_spots // max(min_size, 1)), 1)
+    if num_clusters == 1:
+        return np.zeros(num_spots, dtype=np.int64)
+    lib_size = np.asarray(counts.sum(axis=0), dtype=np.float64).ravel()
+    scaling = np.mean(lib_size) / np.where(lib_size > 0, lib_size, 1.0)
+    # Spots as rows
+    if sp.issparse(counts):
+        norm_counts = sp.diags(scaling).dot(sp.csr_matrix(counts.T, dtype=np.float64)).log1p()
+    else:
+        norm_counts = np.log1p(np.asarray(counts, dtype=np.float64).T * scaling[:,np.newaxis])
+    num_components = min(num_components, min(norm_counts.shape) - 1)
+    if num_components >= 1:
+        coords = TruncatedSVD(n_components=num_components, 
+                              random_state=random_state).fit_transform(norm_counts)
+    else:
+        coords = norm_counts.toarray() if sp.issparse(norm_counts) else norm_counts
+    clusters = KMeans(n_clusters=num_clusters, n_init=10, 
+                      random_state=random_state).fit_predict(coords)
+    # Merge the smallest cluster into its nearest cluster until all are big enough
+    while True:
+        labels, sizes = np.unique(clusters, return_counts=True)
+        if len(labels) == 1 or sizes.min() >= min_size:
+            break
+        smallest = labels[np.argmin(sizes)]
+        centers = np.array([coords[clusters == label].mean(axis=0) for label in labels])
+        distances = ((centers - centers[labels == smallest]) ** 2).sum(axis=1)
+        distances[labels == smallest] = np.inf
+        clusters[clusters == smallest] = labels[np.argmin(distances)]
+    return np.unique(clusters, return_inverse=True)[1]
+
+def _deconvolveFactors(exprs, ave_cell, lib_size, sizes, chunk_size=256):
+    """ Helper function of computeSumFactors() that estimates the factors
+    of the spots of one cluster relative to their library sizes. 
+    The spots are arranged in a ring ordered by library size and, for each 
+    pool size, every window of consecutive spots in the ring is a pool. 
+    The median ratio of the pooled counts against the pseudo-reference gives 
+    one linear equation on the factors of the spots of the pool. The system
+    of all the pools (plus one lightly weighted equation per spot) is solved 
+    with sparse least squares (LSQR).
+    :param exprs: the library size normalized counts of the cluster (genes as rows)
+    :param ave_cell: the pseudo-reference (mean normalized count of each gene)
+    :param lib_size: the library sizes of the spots of the cluster
+    :param sizes: the pool sizes
+    :param chunk_size: the number of pools to compute at once
+    :return: the factors (relative to the library sizes) of the spots
+    """
+    num_spots = exprs.shape[1]
+    # Ring with the odd ranked spots in increasing order of library size 
+    # and the even ranked spots in decreasing order
+    order = np.argsort(lib_size, kind="mergesort")
+    ring = np.concatenate([order[0::2], order[1::2][::-1]])
+    sizes = sorted(set(int(size) for size in sizes if 1 <= size <= num_spots))
+    if len(sizes) == 0:
+        sizes = [num_spots]
+    # Design matrix (pools x spots) where each row marks the spots of a pool
+    rows = list()
+    cols = list()
+    for size in sizes:
+        windows = (np.arange(num_spots)[:,np.newaxis] + np.arange(size)) % num_spots
+        rows.append(np.repeat(np.arange(num_spots), size) + len(rows) * num_spots)
+        cols.append(ring[windows.ravel()])
+    rows = np.concatenate(rows)
+    design = sp.csr_matrix((np.ones(len(rows)), (rows, np.concatenate(cols))),
+                           shape=(num_spots * len(sizes), num_spots))
+    # Median ratio of each pool against the pseudo-reference
+    # (the pooled counts are computed as pools x genes)
+    exprs_t = exprs.T.tocsr() if sp.issparse(exprs) else exprs.T
+    pool_ratios = np.empty(design.shape[0])
+    for start in range(0, design.shape[0], chunk_size):
+        end = min(start + chunk_size, design.shape[0])
+        pooled = design[start:end].dot(exprs_t)
+        pooled = pooled.toarray() if sp.issparse(pooled) else np.asarray(pooled)
+        pool_ratios[start:end] = np.median(pooled / ave_cell, axis=1)
+    # One equation per spot with a low weight so the system has full rank
+    spot_ratios = np.empty(num_spots)
+    for start, end, chunk in dense_chunks(exprs, chunk_size):
+        spot_ratios[start:end] = np.median(chunk / ave_cell[:,np.newaxis], axis=0)
+    weight = np.sqrt(0.000001)
+    system = sp.vstack([design, sp.identity(num_spots, format="csr") * weight]).tocsr()
+    values = np.concatenate([pool_ratios, spot_ratios * weight])
+    factors = lsqr(system, values, atol=1e-12, btol=1e-12, iter_lim=max(10 * num_spots, 1000))[0]
+    # The factors must be positive, non positive factors are interpolated 
+    # from the spots with positive factors and the closest library sizes
+    positive = factors > 0
+    if not positive.all() and positive.any():
+        order = np.argsort(lib_size[positive], kind="mergesort")
+        factors[~positive] = np.interp(lib_size[~positive], lib_size[positive][order],
+                                       factors[positive][order])
+    elif not positive.any():
+        raise RuntimeError("Error, the deconvolution size factors are not positive\n")
+    return factors
+
+def computeSumFactors(counts, scran_clusters=True, clusters=None, sizes=None, 
+                      min_mean=0.1, chunk_size=256):
+    """ Native implementation of scran::computeSumFactors() (the 
+    deconvolution method described in Lun, Bach and Marioni 2016).
+    Spots are pooled (see _deconvolveFactors()) within each cluster
+    and the clusters are rescaled to a reference cluster using the
+    median ratio of their pseudo-references.
+    Returns the computed size factors (strictly positive and centered
+    to a mean of one) as a vector.
+    :param counts: a matrix of counts (genes as rows) as a Pandas data frame,
+    a numpy array or a scipy sparse matrix
+    :param scran_clusters: True to cluster the spots with quickCluster() when 
+    the clusters are not given
+    :param clusters: a vector with the cluster of each spot (optional)
+    :param sizes: the pool sizes (default 21 to 101 in steps of 5 for each cluster)
+    :param min_mean: the minimum mean count of the genes used to compute the factors
+    (0.1 is recommended by scran for UMI counts)
+    :param chunk_size: the number of pools to compute at once
     :return returns the normalization factors a vector
+    :raises: RuntimeError
     """
-    n_cells = len(counts.columns)
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
-    scran = RimportLibrary("scran")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-    as_matrix = r["as.matrix"]
-    if scran_clusters:
-        r_clusters = scran.quickCluster(as_matrix(r_counts), max(n_cells/10, 10))
-        min_cluster_size = min(Counter(r_clusters).values())
-        sizes = list(set([round((min_cluster_size/2) / i) for i in [5,4,3,2,1]]))
-        dds = scran.computeSumFactors(as_matrix(r_counts), 
-                                      clusters=r_clusters, sizes=sizes, positive=True)
+    if isinstance(counts, pd.DataFrame):
+        counts = counts.values
+    if sp.issparse(counts):
+        counts = sp.csc_matrix(counts, dtype=np.float64)
     else:
-        sizes = list(set([round((n_cells/2) * i) for i in [0.1,0.2,0.3,0.4,0.5]]))
-        dds = scran.computeSumFactors(as_matrix(r_counts), sizes=sizes, positive=True)        
-    pandas_sf = pandas2ri.ri2py(dds)
-    pandas2ri.deactivate()
-    return pandas_sf
+        counts = np.asarray(counts, dtype=np.float64)
+    num_spots = counts.shape[1]
+    lib_size = np.asarray(counts.sum(axis=0)).ravel()
+    if np.any(lib_size <= 0):
+        raise RuntimeError("Error, spots without counts cannot be normalized " \
+                           "with the deconvolution method\n")
+    if clusters is None:
+        clusters = quickCluster(counts, max(num_spots // 10, 10)) if scran_clusters \
+            else np.zeros(num_spots, dtype=np.int64)
+    clusters = np.unique(np.asarray(clusters), return_inverse=True)[1]
+    num_clusters = clusters.max() + 1
+    # Library size normalized counts
+    if sp.issparse(counts):
+        exprs = counts.dot(sp.diags(1.0 / lib_size)).tocsc()
+    else:
+        exprs = counts / lib_size
+    size_factors = np.empty(num_spots)
+    ave_cells = list()
+    for cluster in range(num_clusters):
+        spots = np.flatnonzero(clusters == cluster)
+        cluster_exprs = exprs[:,spots]
+        ave_cell = np.asarray(cluster_exprs.mean(axis=1)).ravel()
+        genes = ave_cell * lib_size[spots].mean() >= min_mean
+        genes &= ave_cell > 0
+        if not genes.any():
+            raise RuntimeError("Error, no genes with a mean count of at least {} " \
+                               "to compute size factors\n".format(min_mean))
+        cluster_sizes = sizes if sizes is not None else np.arange(21, 102, 5)
+        if sizes is None and len(spots) < 21:
+            cluster_sizes = [len(spots)]
+        factors = _deconvolveFactors(cluster_exprs[genes], ave_cell[genes], 
+                                     lib_size[spots], cluster_sizes, chunk_size)
+        size_factors[spots] = factors * lib_size[spots]
+        ave_cells.append((ave_cell, genes))
+    # Rescale each cluster to the cluster with the median library size
+    median_libs = [np.median(lib_size[clusters == cluster]) for cluster in range(num_clusters)]
+    reference = np.argsort(median_libs, kind="mergesort")[(num_clusters - 1) // 2]
+    ref_ave, ref_genes = ave_cells[reference]
+    for cluster in range(num_clusters):
+        if cluster == reference:
+            continue
+        ave_cell, genes = ave_cells[cluster]
+        common = genes & ref_genes
+        if not common.any():
+            raise RuntimeError("Error, clusters without common genes cannot be rescaled\n")
+        size_factors[clusters == cluster] *= np.median(ave_cell[common] / ref_ave[common])
+    return size_factors / np.mean(size_factors)
 
-def logCountsWithFactors(counts, size_factors):
-    """ Uses the R package scater to log a matrix of counts (genes as rows)
-    and a vector of size factor using the method normalize().
-    :param counts: a matrix of counts (genes as rows)
+def logCountsWithFactors(counts, size_factors, center=True, pseudo_count=1.0, copy=True):
+    """ Native implementation of the log normalized counts of scater 
+    (normalize() and logcounts()) for a matrix of counts (genes as rows) and 
+    a vector of size factors. The size factors are centered to a mean of one
+    (like scater does) and the counts are transformed to log2(counts/sf + pseudo_count).
+    With the default pseudo count zeroes stay zeroes so sparse matrices keep their
+    sparsity (only the stored values are transformed). Float32 matrices stay float32.
+    :param counts: a matrix of counts (genes as rows) as a Pandas data frame,
+    a numpy array or a scipy sparse matrix
     :param size_factors: a vector of size factors
-    :return the normalized log counts (genes as rows)
+    :param center: True to center the size factors to a mean of one
+    :param pseudo_count: the pseudo count added before the log
+    :param copy: False to transform float matrices in place
+    :return the normalized log counts (genes as rows) with the same type as the input
     """
-    columns = counts.columns
-    indexes = counts.index
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
-    scater = RimportLibrary("scran")
-    r_call = """
-        function(counts, size_factors){
-          sce = SingleCellExperiment(assays=list(counts=as.matrix(counts)))
-          sizeFactors(sce) = size_factors
-          sce = normalize(sce)
-          norm_counts = logcounts(sce)
-          return(as.data.frame(norm_counts))
-        }
+    size_factors = np.asarray(size_factors, dtype=np.float64)
+    if center:
+        size_factors = size_factors / np.mean(size_factors)
+    is_data_frame = isinstance(counts, pd.DataFrame)
+    values = counts.values if is_data_frame else counts
+    dtype = values.dtype.type if values.dtype in (np.float32, np.float64) else np.float64
+    if sp.issparse(values):
+        if pseudo_count != 1.0:
+            values = values.toarray()
+        else:
+            values = sp.csc_matrix(values, dtype=dtype, copy=copy)
+            # The column (spot) of each stored value
+            spots = np.repeat(np.arange(values.shape[1]), np.diff(values.indptr))
+            data = values.data
+            data /= size_factors[spots].astype(dtype)
+            np.log1p(data, out=data)
+            data /= dtype(np.log(2.0))
+    if not sp.issparse(values):
+        values = np.array(values, dtype=dtype, copy=copy or values.dtype != dtype)
+        values /= size_factors.astype(dtype)
+        if pseudo_count == 1.0:
+            np.log1p(values, out=values)
+            values /= dtype(np.log(2.0))
+        else:
+            values += dtype(pseudo_count)
+            np.log2(values, out=values)
+    if is_data_frame:
+        return pd.DataFrame(values, index=counts.index, columns=counts.columns)
+    return values
+
+def estimateSizeFactorsForMatrix(counts, pseudo_count=0.0, chunk_size=256):
+    """ Native implementation of DESeq2::estimateSizeFactorsForMatrix()
+    (median of ratios). The reference sample is the geometric mean of 
+    each gene over all the spots and only the genes with positive
+    counts in every spot are used to compute the median of the ratios.
+    The spots are processed in chunks so a sparse matrix is never
+    made dense at once.
+    :param counts: a matrix of counts (genes as rows) as a Pandas data frame,
+    a numpy array or a scipy sparse matrix
+    :param pseudo_count: a value (or a vector with one value per spot) that
+    is added to the counts before computing the factors
+    :param chunk_size: the number of spots to process at once
+    :return returns the normalization factors a vector
     """
-    r_func = r(r_call)
-    r_norm_counts = r_func(r_counts, size_factors)
-    pandas_norm_counts = pandas2ri.ri2py(r_norm_counts)
-    pandas_norm_counts.index = indexes
-    pandas_norm_counts.columns = columns
-    pandas2ri.deactivate()
-    return pandas_norm_counts
+    if isinstance(counts, pd.DataFrame):
+        counts = counts.values
+    num_genes, num_spots = counts.shape
+    pseudo_count = np.broadcast_to(np.asarray(pseudo_count, dtype=np.float64), (num_spots,))
+    if sp.issparse(counts):
+        counts = sp.csr_matrix(counts, dtype=np.float64)
+        counts.eliminate_zeros()
+        # Without pseudo counts only the genes present in every spot are useful
+        if not np.any(pseudo_count):
+            counts = counts[np.diff(counts.indptr) == num_spots]
+    else:
+        counts = np.asarray(counts, dtype=np.float64)
+    # Log geometric means of each gene (-Inf for genes with zeroes)
+    loggeomeans = np.zeros(counts.shape[0])
+    with np.errstate(divide="ignore"):
+        for start, end, chunk in dense_chunks(counts, chunk_size):
+            loggeomeans += np.log(chunk + pseudo_count[start:end]).sum(axis=1)
+    loggeomeans /= num_spots
+    genes = np.isfinite(loggeomeans)
+    if not genes.any():
+        raise RuntimeError("Error, every gene contains at least one zero, "
+                           "cannot compute log geometric means\n")
+    size_factors = np.empty(num_spots)
+    for start, end, chunk in dense_chunks(counts[genes], chunk_size):
+        log_ratios = np.log(chunk + pseudo_count[start:end]) - loggeomeans[genes,np.newaxis]
+        size_factors[start:end] = np.exp(np.median(log_ratios, axis=0))
+    return size_factors
 
 def computeSizeFactors(counts):
     """ Computes size factors using DESeq
@@ -122,15 +414,7 @@ def computeSizeFactors(counts):
     :param counts: a matrix of counts (genes as rows)
     :return returns the normalization factors a vector
     """
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
-    deseq2 = RimportLibrary("DESeq2")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-    dds = deseq2.estimateSizeFactorsForMatrix(r_counts)
-    pandas_sf = pandas2ri.ri2py(dds)
-    pandas2ri.deactivate()
-    return pandas_sf
+    return estimateSizeFactorsForMatrix(counts)
 
 def computeSizeFactorsSizeAdjusted(counts):
     """ Computes size factors using DESeq
@@ -140,9 +424,8 @@ def computeSizeFactorsSizeAdjusted(counts):
     :param counts: a matrix of counts (genes as rows)
     :return returns the normalization factors a vector
     """
-    lib_size = counts.sum(axis=0)
-    counts = counts + (lib_size / np.mean(lib_size))
-    return computeSizeFactors(counts)
+    lib_size = np.asarray(counts.sum(axis=0), dtype=np.float64).ravel()
+    return estimateSizeFactorsForMatrix(counts, pseudo_count=lib_size / np.mean(lib_size))
 
 def computeSizeFactorsLinear(counts):
     """ Computes size factors using DESeq2 iterative size factors
@@ -152,17 +435,17 @@ def computeSizeFactorsLinear(counts):
     :param counts: a matrix of counts (genes as rows)
     :return returns the normalization factors a vector
     """
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
+    from rpy2.robjects import r
     deseq2 = RimportLibrary("DESeq2")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-    vec = rpackages.importr('S4Vectors')
-    bio_generics = rpackages.importr("BiocGenerics")
-    cond = vec.DataFrame(condition=base.factor(base.c(base.colnames(r_counts))))
-    design = r('formula(~ condition)')
-    dds = deseq2.DESeqDataSetFromMatrix(countData=r_counts, colData=cond, design=design)
-    dds = bio_generics.estimateSizeFactors(dds, type="iterate")
-    pandas_sf = pandas2ri.ri2py(bio_generics.sizeFactors(dds))
-    pandas2ri.deactivate()
-    return pandas_sf
\ No newline at end of file
+    vec = RimportLibrary("S4Vectors")
+    bio_generics = RimportLibrary("BiocGenerics")
+    base = RimportLibrary("base")
+    RregisterParallel()
+    r_counts = Rmatrix(counts)
+    with Rtimer("compute"):
+        cond = vec.DataFrame(condition=base.factor(base.c(base.colnames(r_counts))))
+        design = r('formula(~ condition)')
+        dds = deseq2.DESeqDataSetFromMatrix(countData=r_counts, colData=cond, design=design)
+        dds = bio_generics.estimateSizeFactors(dds, type="iterate")
+        r_sf = bio_generics.sizeFactors(dds)
+    return np.array(Rnumpy(r_sf))
\ No newline at end of file
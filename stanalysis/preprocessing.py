@@ -5,49 +5,368 @@ functions (noisy spots and noisy genes)
 """
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
 import math
 import os
 from stanalysis.normalization import *
+from stanalysis.cache import file_fingerprint, array_fingerprint, cache_get, cache_put, cache_enabled
+
+class SparseCounts(object):
+    """ A ST matrix of counts (spots as rows and genes as columns)
+    stored as a scipy CSR matrix together with the spot names (index)
+    and the gene names (columns). It exposes the attributes of a Pandas
+    data frame that the scripts use (index, columns and shape) so it
+    can be passed to remove_noise(), keep_top_genes() and normalize_data()
+    without creating a dense matrix.
+    """
+    def __init__(self, matrix, index, columns):
+        self.matrix = sp.csr_matrix(matrix)
+        self.index = pd.Index(index)
+        self.columns = pd.Index(columns)
+        assert(self.matrix.shape == (len(self.index), len(self.columns)))
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def take(self, rows=None, cols=None):
+        """ Returns a new SparseCounts object with only the
+        given spots (rows) and genes (cols).
+        :param rows: a boolean mask or a list of positions (None to keep all)
+        :param cols: a boolean mask or a list of positions (None to keep all)
+        :return: a new SparseCounts object
+        """
+        matrix = self.matrix
+        index = self.index
+        columns = self.columns
+        if rows is not None:
+            rows = np.flatnonzero(rows) if np.asarray(rows).dtype == bool else rows
+            matrix = matrix[rows]
+            index = index[rows]
+        if cols is not None:
+            cols = np.flatnonzero(cols) if np.asarray(cols).dtype == bool else cols
+            matrix = matrix[:,cols]
+            columns = columns[cols]
+        return SparseCounts(matrix, index, columns)
+
+    def to_dataframe(self):
+        """ Returns the counts as a dense Pandas data frame
+        (spots as rows and genes as columns)
+        """
+        return pd.DataFrame(self.matrix.toarray(), index=self.index, columns=self.columns)
+
+def parse_spots(spots, with_dataset=True):
+    """ Parses the spot names of a ST matrix of counts once
+    and returns them as a structured index. The spot names are
+    XxY or TAG_XxY and when several datasets are aggregated
+    (see aggregate_datatasets()) the index of the dataset is 
+    prepended to them (i_XxY or i_TAG_XxY).
+    :param spots: a list of spot names (for instance the index of a data frame)
+    :param with_dataset: True if the spot names contain the dataset index
+    :return: a Pandas data frame with the spot names as index and the columns 
+    dataset (int, only if with_dataset is True), tag (str), x (float) and y (float)
+    :raises: RuntimeError
+    """
+    spots = pd.Index(spots)
+    pattern = r"^(?:(?P<tag>.+)_)?(?P<x>[^_x]+)x(?P<y>[^_x]+)$"
+    if with_dataset:
+        pattern = r"^(?P<dataset>\d+)_" + pattern[1:]
+    tokens = pd.Series(spots.astype(str), index=spots).str.extract(pattern, expand=True)
+    x_values = pd.to_numeric(tokens["x"], errors="coerce").values.astype(np.float64)
+    y_values = pd.to_numeric(tokens["y"], errors="coerce").values.astype(np.float64)
+    # Spot names that do not match the format (or with non numeric coordinates)
+    wrong = np.isnan(x_values) | np.isnan(y_values)
+    if wrong.any():
+        raise RuntimeError("Error, the spots in the input data have "
+                           "the wrong format {}\n".format(spots[np.flatnonzero(wrong)[0]]))
+    spot_index = pd.DataFrame(index=spots)
+    if with_dataset:
+        spot_index["dataset"] = tokens["dataset"].astype(np.int64)
+    spot_index["tag"] = tokens["tag"].fillna("")
+    spot_index["x"] = x_values
+    spot_index["y"] = y_values
+    return spot_index
+
+def merge_replicates(counts_tables, merging_action="SUM", tolerance=0.6):
+    """ This function merges two or more ST datasets (matrices of counts)
+    assuming that they are consecutive sections and that they
+    are aligned so each spot is on the same position on the tissue.
+    The spots of each dataset are matched to the spots of the first dataset
+    (the nearest spot within the given tolerance in both coordinates) 
+    and the genes are matched by name. Spots or genes that are not present 
+    in all the datasets are discarded.
+    The type of merging can be SUM (sum the counts) or AVG (average 
+    of the counts).
+    :param counts_tables: a list of ST matrices of counts (data frames or SparseCounts)
+    :param merging_action: Either SUM or AVG (for the merging of counts)
+    :param tolerance: the maximum distance (in array coordinates) between matching spots
+    :return: a ST matrix of counts with the merged counts (for common genes/spots) 
+    and the spot names of the first dataset (a SparseCounts object if the first
+    dataset is a SparseCounts object)
+    :raises: RuntimeError
+    """
+    if merging_action not in ["SUM", "AVG"]:
+        raise RuntimeError("Error, invalid merging action {}\n".format(merging_action))
+    if len(counts_tables) < 2:
+        raise RuntimeError("Error, at least two datasets are needed to merge\n")
+    reference = counts_tables[0]
+    replicates = counts_tables[1:]
+    
+    # Genes present in all the datasets (in the order of the first dataset)
+    common_genes = np.ones(len(reference.columns), dtype=bool)
+    for counts in replicates:
+        common_genes &= reference.columns.isin(counts.columns)
+    for gene in reference.columns[~common_genes]:
+        print("Gene {} is not present in all the datasets and will be skipped".format(gene))
+    genes = reference.columns[common_genes]
+    
+    # Nearest spot of each replicate for each spot of the first dataset
+    # (the Chebyshev distance is the tolerance applied to both coordinates).
+    # Only mutual nearest spots are matched so no spot of a replicate
+    # is used for more than one spot of the first dataset
+    reference_coords = parse_spots(reference.index, with_dataset=False)[["x","y"]].values
+    reference_tree = cKDTree(reference_coords)
+    common_spots = np.ones(len(reference.index), dtype=bool)
+    matches = list()
+    for counts in replicates:
+        coords = parse_spots(counts.index, with_dataset=False)[["x","y"]].values
+        distances, positions = cKDTree(coords).query(reference_coords, k=1, p=np.inf,
+                                                     distance_upper_bound=tolerance + 1e-9)
+        found = np.isfinite(distances)
+        _, back_positions = reference_tree.query(coords[positions[found]], k=1, p=np.inf)
+        found[found] = back_positions == np.flatnonzero(found)
+        common_spots &= found
+        matches.append(positions)
+    for spot in reference.index[~common_spots]:
+        print("Spot {} does not match in all the datasets and will be skipped".format(spot))
+    rows = np.flatnonzero(common_spots)
+    
+    # Accumulate the counts of the common spots/genes of all the datasets
+    is_sparse = isinstance(reference, SparseCounts)
+    def aligned_counts(counts, spot_positions):
+        gene_positions = counts.columns.get_indexer(genes)
+        if isinstance(counts, SparseCounts):
+            values = counts.take(spot_positions, gene_positions).matrix
+            return values if is_sparse else values.toarray()
+        values = counts.values[np.ix_(spot_positions, gene_positions)]
+        return sp.csr_matrix(values) if is_sparse else values
+    merged = aligned_counts(reference, rows)
+    for counts, positions in zip(replicates, matches):
+        merged = merged + aligned_counts(counts, positions[rows])
+    if merging_action == "AVG":
+        merged = merged / float(len(counts_tables))
+    if is_sparse:
+        return SparseCounts(sp.csr_matrix(merged), reference.index[rows], genes)
+    return pd.DataFrame(merged, index=reference.index[rows], columns=genes)
 
 def merge_datasets(counts_tableA, counts_tableB, merging_action="SUM"):
     """ This function merges two ST datasts (matrix of counts)
     assuming that they are consecutive sections and that they
-    are aligned so each spot on the same position on the tissue
-    and the number of spots in the same.
+    are aligned so each spot on the same position on the tissue.
     The type of merging can be SUM (sum both counts) or AVG (average 
     sum of both counts).
     It returns the merged matrix of counts for the commong spots/genes.
+    See merge_replicates() to merge more than two datasets.
     :param counts_tableA: a ST matrix of counts
     :param counts_tableB: a ST matrix of counts
     :param merging_action: Either SUM or AVG (for the merging of counts)
     :return: a ST matrix of counts with the merged counts (for common genes/spots)
     """
-    merged_table = counts_tableA.copy()       
-    for indexA, indexB in zip(counts_tableA.index, counts_tableB.index):
-        tokens = indexA.split("x")
-        assert(len(tokens) == 2)
-        x_a = float(tokens[0])
-        y_a = float(tokens[1])
-        tokens = indexB.split("x")
-        assert(len(tokens) == 2)
-        x_b = float(tokens[0])
-        y_b = float(tokens[1]) 
-        if abs(x_a - x_b) > 0.6 or abs(y_a - y_b) > 0.6:
-            print("Spots {} and {} dot not match and will be skipped".format(indexA, indexB))
-            merged_table.drop(indexA, axis=0, inplace=True)
-            continue        
-        for geneA, geneB in zip(counts_tableA.loc[indexA], counts_tableB.loc[indexB]):
-            if geneA != geneB:
-                print("Genes {} and {} dot not match and will be skipped".format(geneA, geneB))
-                merged_table.drop(geneA, axis=1, inplace=True)
-            elif merging_action == "SUM":
-                merged_table.loc[indexA,geneA] += counts_tableB.loc[indexB, geneB]      
-            else:
-                merged_table.loc[indexA,geneA] += counts_tableB.loc[indexB, geneB]
-                merged_table.loc[indexA,geneA] /= 2
-    return merged_table
+    return merge_replicates([counts_tableA, counts_tableB], merging_action)
+
+def read_counts_table(counts_file, sparse=False, use_cache=True):
+    """ Reads a ST matrix of counts in TSV format (genes as columns
+    and spots as rows). The parsed matrix is stored in the on-disk cache
+    (see stanalysis.cache) keyed by the content of the file so next reads
+    skip the text parsing and memory-map the stored arrays instead.
+    The matrix is stored as CSR arrays when it is sparse and as a dense 
+    array otherwise, using int32 or float32 values when it is lossless.
+    Dense matrices are returned with the stored type and memory-mapped
+    copy-on-write (no copy is made unless the data frame is modified).
+    :param counts_file: the path to the TSV file
+    :param sparse: True to return a SparseCounts object instead of a data frame
+    :param use_cache: False to always parse the file
+    :return: a Pandas data frame (or a SparseCounts object) with the counts
+    """
+    key = file_fingerprint(counts_file) if use_cache and cache_enabled() else None
+    arrays = cache_get("counts", key, writable=True) if key is not None else None
+    if arrays is None:
+        counts = pd.read_table(counts_file, sep="\t", header=0, index_col=0)
+        values = counts.values.astype(np.float64)
+        values[~np.isfinite(values)] = 0.0
+        values = _compact_values(values)
+        arrays = {"index": np.asarray(counts.index.astype(str), dtype=np.str_),
+                  "columns": np.asarray(counts.columns.astype(str), dtype=np.str_)}
+        # CSR takes less space than dense when less than a third are non zeroes
+        if np.count_nonzero(values) * 3 < values.size:
+            matrix = sp.csr_matrix(values)
+            arrays["data"] = matrix.data
+            arrays["indices"] = matrix.indices
+            arrays["indptr"] = matrix.indptr
+        else:
+            arrays["values"] = values
+        if key is not None:
+            cache_put("counts", key, arrays)
+        del counts
+    index = arrays["index"].astype(object)
+    columns = arrays["columns"].astype(object)
+    if "values" in arrays:
+        matrix = np.asarray(arrays["values"])
+    else:
+        matrix = sp.csr_matrix((np.asarray(arrays["data"]), np.array(arrays["indices"]), 
+                                np.array(arrays["indptr"])), shape=(len(index), len(columns)))
+    if sparse:
+        return SparseCounts(sp.csr_matrix(matrix, dtype=np.float64), index, columns)
+    if sp.issparse(matrix):
+        matrix = matrix.toarray()
+    # The (memory-mapped) values are not copied
+    return pd.DataFrame(matrix, index=index, columns=columns, copy=False)
+
+def _compact_values(values):
+    """ Helper function that returns the values as int32 or float32
+    when it does not lose information (float64 otherwise)
+    """
+    if np.array_equal(values.astype(np.int32), values):
+        return values.astype(np.int32)
+    elif np.array_equal(values.astype(np.float32), values):
+        return values.astype(np.float32)
+    return values
+
+def iter_counts_table(counts_file, chunk_size=1000, use_cache=True):
+    """ Reads a ST matrix of counts in TSV format (genes as columns
+    and spots as rows) in chunks of spots so only one chunk at a time 
+    is in memory. If the matrix is in the on-disk cache (see read_counts_table())
+    the chunks are sliced from the memory-mapped arrays instead of parsed.
+    Otherwise the parsed chunks are stored in the cache (as CSR arrays) 
+    once the whole file has been read so next reads are not parsed again.
+    :param counts_file: the path to the TSV file
+    :param chunk_size: the number of spots (rows) in each chunk
+    :param use_cache: False to always parse the file
+    :return: a generator of SparseCounts objects (one for each chunk)
+    """
+    key = file_fingerprint(counts_file) if use_cache and cache_enabled() else None
+    arrays = cache_get("counts", key) if key is not None else None
+    if arrays is None:
+        # CSR arrays of the chunks to store in the cache
+        parts = {"index": list(), "data": list(), "indices": list(), "nnz": list()}
+        columns = None
+        for counts in pd.read_table(counts_file, sep="\t", header=0, 
+                                    index_col=0, chunksize=chunk_size):
+            values = counts.values.astype(np.float64)
+            values[~np.isfinite(values)] = 0.0
+            chunk = sp.csr_matrix(values)
+            columns = counts.columns.astype(str)
+            if key is not None:
+                parts["index"].append(np.asarray(counts.index.astype(str), dtype=np.str_))
+                parts["data"].append(chunk.data)
+                parts["indices"].append(chunk.indices)
+                parts["nnz"].append(np.diff(chunk.indptr))
+            yield SparseCounts(chunk, counts.index.astype(str), columns)
+        if key is not None and columns is not None:
+            nnz = np.concatenate(parts["nnz"])
+            cache_put("counts", key, 
+                      {"index": np.concatenate(parts["index"]),
+                       "columns": np.asarray(columns, dtype=np.str_),
+                       "data": _compact_values(np.concatenate(parts["data"])),
+                       "indices": np.concatenate(parts["indices"]).astype(np.int32),
+                       "indptr": np.concatenate([[0], np.cumsum(nnz)]).astype(np.int64)})
+        return
+    index = arrays["index"].astype(object)
+    columns = arrays["columns"].astype(object)
+    for start in range(0, len(index), chunk_size):
+        end = min(start + chunk_size, len(index))
+        if "values" in arrays:
+            chunk = sp.csr_matrix(np.asarray(arrays["values"][start:end], dtype=np.float64))
+        else:
+            indptr = np.asarray(arrays["indptr"][start:end + 1])
+            chunk = sp.csr_matrix((np.asarray(arrays["data"][indptr[0]:indptr[-1]], dtype=np.float64),
+                                   np.array(arrays["indices"][indptr[0]:indptr[-1]]), 
+                                   indptr - indptr[0]), shape=(end - start, len(columns)))
+        yield SparseCounts(chunk, index[start:end], columns)
+
+def stream_aggregate_datatasets(counts_table_files, num_exp_genes=0.01, num_exp_spots=0.01, 
+                                min_expression=1, chunk_size=1000):
+    """ Same as calling aggregate_datatasets() and then remove_noise() 
+    but the datasets are read in chunks of spots (see iter_counts_table()) so 
+    neither the dense matrix nor the noisy spots are ever in memory.
+    A first pass computes the number of expressed genes of each spot and the 
+    second pass keeps only the spots that pass the filter while counting
+    the number of spots where each gene is expressed. Only the genes that
+    pass the filter are added to the final matrix.
+    :param counts_table_files: a list of file names of the datasets
+    :param num_exp_genes: a float from 0-1 representing the % of 
+    the distribution of expressed genes a spot must have to be kept
+    :param num_exp_spots: a float from 0-1 representing the % of 
+    the total number of spots that a gene must have with a count bigger
+    than the parameter min_expression in order to be kept
+    :param min_expression: the minimum expression for a gene to be
+    considered expressed
+    :param chunk_size: the number of spots to read at once
+    :return: a SparseCounts object with the merged datasets (noisy spots/genes removed)
+    """
+    for counts_file in counts_table_files:
+        if not os.path.isfile(counts_file):
+            raise IOError("Error parsing data frame", "Invalid input file")
+    # First pass, number of expressed genes per spot and union of genes
+    genes = dict()
+    genes_per_spot = list()
+    for counts_file in counts_table_files:
+        for chunk in iter_counts_table(counts_file, chunk_size):
+            for gene in chunk.columns:
+                genes.setdefault(gene, len(genes))
+            chunk.matrix.eliminate_zeros()
+            genes_per_spot.append(np.diff(chunk.matrix.indptr))
+    genes_per_spot = np.concatenate(genes_per_spot) if genes_per_spot else np.zeros(0)
+    num_spots = len(genes_per_spot)
+    num_genes = len(genes)
+    print("Total number of spots {}".format(num_spots))
+    print("Total number of genes {}".format(num_genes))
+    min_genes_spot_exp = round(np.percentile(genes_per_spot, num_exp_genes * 100))
+    print("Number of expressed genes a spot must have to be kept " \
+    "({}% of total expressed genes) {}".format(num_exp_genes, min_genes_spot_exp))
+    keep_spots = genes_per_spot >= min_genes_spot_exp
+    print("Dropped {} spots".format(num_spots - np.count_nonzero(keep_spots)))
+    # Second pass, keep only the good spots and count expressed spots per gene
+    spots = list()
+    rows = list()
+    cols = list()
+    values = list()
+    spots_per_gene = np.zeros(num_genes, dtype=np.int64)
+    offset = 0
+    for i,counts_file in enumerate(counts_table_files):
+        for chunk in iter_counts_table(counts_file, chunk_size):
+            keep = keep_spots[offset:offset + len(chunk.index)]
+            offset += len(chunk.index)
+            if not keep.any():
+                continue
+            chunk = chunk.take(rows=keep)
+            gene_ids = np.asarray([genes[gene] for gene in chunk.columns], dtype=np.int64)
+            matrix = chunk.matrix.tocoo()
+            rows.append(matrix.row + len(spots))
+            cols.append(gene_ids[matrix.col])
+            values.append(matrix.data)
+            spots_per_gene += np.bincount(cols[-1][matrix.data >= min_expression], 
+                                          minlength=num_genes)
+            spots.extend(["{0}_{1}".format(i, spot) for spot in chunk.index])
+    # Remove noisy genes
+    min_features_gene = round(len(spots) * num_exp_spots)
+    print("Removing genes that are expressed in less than {} " \
+    "spots with a count of at least {}".format(min_features_gene, min_expression))
+    keep_genes = spots_per_gene >= min_features_gene
+    print("Dropped {} genes".format(num_genes - np.count_nonzero(keep_genes)))
+    # New positions of the genes that are kept
+    gene_pos = np.cumsum(keep_genes) - 1
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+    values = np.concatenate(values) if values else np.zeros(0)
+    entries = keep_genes[cols]
+    matrix = sp.coo_matrix((values[entries], (rows[entries], gene_pos[cols[entries]])),
+                           shape=(len(spots), np.count_nonzero(keep_genes)), dtype=np.float64)
+    genes = np.asarray(sorted(genes, key=genes.get), dtype=object)
+    return SparseCounts(matrix.tocsr(), spots, genes[keep_genes])
 
-def aggregate_datatasets(counts_table_files, plot_hist=False):
+def aggregate_datatasets(counts_table_files, plot_hist=False, sparse=False):
     """ This functions takes a list of data frames with ST data
     (genes as columns and spots as rows) and merges them into
     one data frame using the genes as merging criteria. 
@@ -56,30 +375,164 @@ def aggregate_datatasets(counts_table_files, plot_hist=False):
     distributions can be generated for each dataset.
     :param counts_table_files: a list of file names of the datasets
     :param plot_hist: True if we want to generate the histogram plots
-    :return: a Pandas data frame with the merged data frames
+    :param sparse: True to return a SparseCounts object (CSR matrix) 
+    instead of a dense data frame
+    :return: a Pandas data frame (or a SparseCounts object) with the merged data frames
     """
     # Spots are rows and genes are columns
-    counts = pd.DataFrame()
-    sample_counts = dict()
+    datasets = list()
+    # Sparse triplets (spot, gene, count) and the union of genes
+    # which is built in a single pass over the datasets
+    spots = list()
+    rows = list()
+    cols = list()
+    values = list()
+    genes = dict()
+    num_spots = 0
     for i,counts_file in enumerate(counts_table_files):
         if not os.path.isfile(counts_file):
             raise IOError("Error parsing data frame", "Invalid input file")
-        new_counts = pd.read_table(counts_file, sep="\t", header=0, index_col=0)
+        new_counts = read_counts_table(counts_file, sparse=sparse)
         # Plot reads/genes distributions per spot
         if plot_hist:
-            histogram(x_points=new_counts.sum(axis=1).values,
+            matrix = new_counts.matrix if sparse else new_counts.values
+            histogram(x_points=np.asarray(matrix.sum(axis=1)).ravel(),
                       output=os.path.join(outdir, "hist_reads_{}.png".format(i)))
-            histogram(x_points=(new_counts != 0).sum(axis=1).values, 
+            histogram(x_points=np.asarray((matrix != 0).sum(axis=1)).ravel(), 
                       output=os.path.join(outdir, "hist_genes_{}.png".format(i)))
         # Append dataset index to the spots (indexes) so they can be traced
         new_spots = ["{0}_{1}".format(i, spot) for spot in new_counts.index]
-        new_counts.index = new_spots
-        counts = counts.append(new_counts)
+        if not sparse:
+            new_counts.index = new_spots
+            datasets.append(new_counts)
+            continue
+        # Map the genes of the dataset to the shared gene vocabulary
+        gene_ids = np.asarray([genes.setdefault(gene, len(genes)) 
+                               for gene in new_counts.columns], dtype=np.int64)
+        matrix = new_counts.matrix.tocoo()
+        rows.append(matrix.row + num_spots)
+        cols.append(gene_ids[matrix.col])
+        values.append(matrix.data)
+        spots.extend(new_spots)
+        num_spots += len(new_spots)
+        del new_counts, matrix
+    if sparse:
+        genes = sorted(genes, key=genes.get)
+        matrix = sp.coo_matrix((np.concatenate(values) if values else [],
+                                (np.concatenate(rows) if rows else [], 
+                                 np.concatenate(cols) if cols else [])),
+                               shape=(num_spots, len(genes)), dtype=np.float64)
+        return SparseCounts(matrix.tocsr(), spots, genes)
+    # Concatenate all the datasets at once (genes not present are NaN)
+    counts = pd.concat(datasets, axis=0, sort=False)
     # Replace Nan and Inf by zeroes
-    counts.replace([np.inf, -np.inf], np.nan)
+    counts.replace([np.inf, -np.inf], np.nan, inplace=True)
     counts.fillna(0.0, inplace=True)
     return counts
   
+class QCStats(object):
+    """ Quality control statistics of a ST matrix of counts (spots as rows
+    and genes as columns) computed in one pass (see compute_qc_stats()):
+    - spot_nnz: the number of expressed genes (non zero counts) of each spot
+    - spot_lib_size: the total count of each spot
+    - gene_expressed: the number of spots where each gene has a count >= min_expression
+    - gene_sum, gene_mean and gene_var: the total count, mean and unbiased
+    variance of each gene over all the spots
+    """
+    def __init__(self, spot_nnz, spot_lib_size, gene_expressed, gene_mean, gene_m2, min_expression):
+        self.spot_nnz = spot_nnz
+        self.spot_lib_size = spot_lib_size
+        self.gene_expressed = gene_expressed
+        self.gene_mean = gene_mean
+        # Sum of squared differences from the mean of each gene
+        self.gene_m2 = gene_m2
+        self.min_expression = min_expression
+
+    @property
+    def num_spots(self):
+        return len(self.spot_nnz)
+
+    @property
+    def gene_sum(self):
+        return self.gene_mean * self.num_spots
+
+    @property
+    def gene_var(self):
+        if self.num_spots < 2:
+            return np.full(len(self.gene_mean), np.nan)
+        return self.gene_m2 / (self.num_spots - 1)
+
+    def remove_spots(self, removed):
+        """ Returns the statistics of the matrix without some of its spots
+        given the statistics of the removed spots (the gene statistics
+        are updated without another pass over the kept spots).
+        :param removed: a QCStats object of the removed spots
+        :return: a new QCStats object (with the gene statistics only)
+        """
+        num_spots = self.num_spots - removed.num_spots
+        if num_spots <= 0:
+            zeros = np.zeros(len(self.gene_mean))
+            return QCStats(np.zeros(0, dtype=np.int64), np.zeros(0), 
+                           np.zeros(len(zeros), dtype=np.int64), zeros, zeros, self.min_expression)
+        gene_mean = (self.gene_sum - removed.gene_sum) / num_spots
+        delta = removed.gene_mean - gene_mean
+        gene_m2 = self.gene_m2 - removed.gene_m2 - \
+            delta ** 2 * num_spots * removed.num_spots / self.num_spots
+        # The spot statistics of the kept spots are unknown here
+        return QCStats(np.zeros(num_spots, dtype=np.int64), np.zeros(num_spots), 
+                       self.gene_expressed - removed.gene_expressed,
+                       gene_mean, np.maximum(gene_m2, 0.0), self.min_expression)
+
+def compute_qc_stats(counts, min_expression=1, chunk_size=1000):
+    """ Computes the quality control statistics (see QCStats) of a ST
+    matrix of counts in one pass over chunks of spots. The gene means
+    and variances of the chunks are merged with the parallel Welford 
+    algorithm. Sparse matrices are never made dense and dense matrices
+    are never transposed or copied as a whole.
+    :param counts: a Pandas data frame (or a SparseCounts object) with the counts
+    :param min_expression: the minimum count for a gene to be considered expressed in a spot
+    :param chunk_size: the number of spots to process at once
+    :return: a QCStats object
+    """
+    if isinstance(counts, SparseCounts):
+        matrix = counts.matrix
+    else:
+        matrix = counts.values
+    num_spots, num_genes = matrix.shape
+    spot_nnz = np.zeros(num_spots, dtype=np.int64)
+    spot_lib_size = np.zeros(num_spots)
+    gene_expressed = np.zeros(num_genes, dtype=np.int64)
+    gene_mean = np.zeros(num_genes)
+    gene_m2 = np.zeros(num_genes)
+    for start in range(0, num_spots, chunk_size):
+        end = min(start + chunk_size, num_spots)
+        chunk = matrix[start:end]
+        size = end - start
+        if sp.issparse(chunk):
+            data = chunk.data.astype(np.float64)
+            indices = chunk.indices
+            spot_ids = np.repeat(np.arange(size), np.diff(chunk.indptr))
+            spot_nnz[start:end] = np.bincount(spot_ids, weights=data != 0, minlength=size)
+            spot_lib_size[start:end] = np.bincount(spot_ids, weights=data, minlength=size)
+            gene_expressed += np.bincount(indices[data >= min_expression], minlength=num_genes)
+            chunk_mean = np.bincount(indices, weights=data, minlength=num_genes) / size
+            # The implicit zeroes contribute mean^2 each to the squared differences
+            chunk_m2 = np.bincount(indices, weights=(data - chunk_mean[indices]) ** 2, 
+                                   minlength=num_genes) + \
+                (size - np.bincount(indices, minlength=num_genes)) * chunk_mean ** 2
+        else:
+            chunk = np.asarray(chunk, dtype=np.float64)
+            spot_nnz[start:end] = np.count_nonzero(chunk, axis=1)
+            spot_lib_size[start:end] = chunk.sum(axis=1)
+            gene_expressed += np.count_nonzero(chunk >= min_expression, axis=0)
+            chunk_mean = chunk.mean(axis=0)
+            chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+        # Merge the statistics of the chunk with the previous ones
+        delta = chunk_mean - gene_mean
+        gene_mean += delta * size / end
+        gene_m2 += chunk_m2 + delta ** 2 * start * size / end
+    return QCStats(spot_nnz, spot_lib_size, gene_expressed, gene_mean, gene_m2, min_expression)
+
 def remove_noise(counts, num_exp_genes=0.01, num_exp_spots=0.01, min_expression=1):
     """This functions remove noisy genes and spots 
     for a given data frame (Genes as columns and spots as rows).
@@ -88,7 +541,9 @@ def remove_noise(counts, num_exp_genes=0.01, num_exp_spots=0.01, min_expression=
     The percentage is given as a parameter.
     - The noisy genes are removed so every gene that is expressed
     in less than 1% of the total spots. Expressed with a count >= 2. 
-    :param counts: a Pandas data frame with the counts
+    The statistics are computed in one pass (see compute_qc_stats()) 
+    and the removed spots are subtracted from them afterwards.
+    :param counts: a Pandas data frame (or a SparseCounts object) with the counts
     :param num_exp_genes: a float from 0-1 representing the % of 
     the distribution of expressed genes a spot must have to be kept
     :param num_exp_spots: a float from 0-1 representing the % of 
@@ -96,76 +551,110 @@ def remove_noise(counts, num_exp_genes=0.01, num_exp_spots=0.01, min_expression=
     than the parameter min_expression in order to be kept
     :param min_expression: the minimum expression for a gene to be
     considered expressed
-    :return: a new Pandas data frame with noisy spots/genes removed
+    :return: a new Pandas data frame (or SparseCounts object) with noisy spots/genes removed
     """
+    num_spots, num_genes = counts.shape
+    stats = compute_qc_stats(counts, min_expression)
     
     # How many spots do we keep based on the number of genes expressed?
-    num_spots = len(counts.index)
-    num_genes = len(counts.columns)
-    min_genes_spot_exp = round((counts != 0).sum(axis=1).quantile(num_exp_genes))
+    min_genes_spot_exp = round(np.percentile(stats.spot_nnz, num_exp_genes * 100)) \
+        if num_spots > 0 else 0
     print("Number of expressed genes a spot must have to be kept " \
     "({}% of total expressed genes) {}".format(num_exp_genes, min_genes_spot_exp))
-    counts = counts[(counts != 0).sum(axis=1) >= min_genes_spot_exp]
-    print("Dropped {} spots".format(num_spots - len(counts.index)))
-          
-    # Spots are columns and genes are rows
-    counts = counts.transpose()
+    keep_spots = stats.spot_nnz >= min_genes_spot_exp
+    num_kept_spots = np.count_nonzero(keep_spots)
+    print("Dropped {} spots".format(num_spots - num_kept_spots))
+    if num_kept_spots < num_spots:
+        if isinstance(counts, SparseCounts):
+            removed = counts.take(rows=~keep_spots)
+        else:
+            removed = counts[~keep_spots]
+        stats = stats.remove_spots(compute_qc_stats(removed, min_expression))
   
     # Remove noisy genes
-    min_features_gene = round(len(counts.columns) * num_exp_spots) 
+    min_features_gene = round(num_kept_spots * num_exp_spots) 
     print("Removing genes that are expressed in less than {} " \
     "spots with a count of at least {}".format(min_features_gene, min_expression))
-    counts = counts[(counts >= min_expression).sum(axis=1) >= min_features_gene]
-    print("Dropped {} genes".format(num_genes - len(counts.index)))
+    keep_genes = stats.gene_expressed >= min_features_gene
+    print("Dropped {} genes".format(num_genes - np.count_nonzero(keep_genes)))
     
-    return counts.transpose()
+    if isinstance(counts, SparseCounts):
+        return counts.take(keep_spots, keep_genes)
+    return counts.loc[keep_spots, keep_genes]
     
-def keep_top_genes(counts, num_genes_keep, criteria="Variance"):
+def keep_top_genes(counts, num_genes_keep, criteria="Variance", stats=None):
     """ This function takes a Pandas data frame
     with ST data (Genes as columns and spots as rows)
     and returns a new data frame where only the top
     genes are kept by using the variance or the total count.
-    :param counts: a Pandas data frame with the counts
+    :param counts: a Pandas data frame (or a SparseCounts object) with the counts
     :param num_genes_keep: the % (1-100) of genes to keep
     :param criteria: the criteria used to select ("Variance or "TopRanked")
-    :return: a new Pandas data frame with only the top ranked genes. 
+    :param stats: the QCStats object of the counts (computed if not given)
+    :return: a new Pandas data frame (or SparseCounts object) with only the top ranked genes. 
     """
-    # Spots as columns and genes as rows
-    counts = counts.transpose()
-    # Keep only the genes with higher over-all variance
-    num_genes = len(counts.index)
+    if criteria not in ["Variance", "TopRanked"]:
+        raise RuntimeError("Error, incorrect criteria method\n")
+    num_genes = len(counts.columns)
     print("Removing {}% of genes based on the {}".format(num_genes_keep * 100, criteria))
+    # Per gene statistics computed over all the spots
+    if stats is None:
+        stats = compute_qc_stats(counts)
     if criteria == "Variance":
-        min_genes_spot_var = counts.var(axis=1).quantile(num_genes_keep)
-        if math.isnan(min_genes_spot_var):
-            print("Computed variance is NaN! Check your normalization factors..")
-        else:
-            print("Min normalized variance a gene must have over all spots " \
-            "to be kept ({0}% of total) {1}".format(num_genes_keep, min_genes_spot_var))
-            counts = counts[counts.var(axis=1) >= min_genes_spot_var]
-    elif criteria == "TopRanked":
-        min_genes_spot_sum = counts.sum(axis=1).quantile(num_genes_keep)
-        if math.isnan(min_genes_spot_var):
-            print("Computed sum is NaN! Check your normalization factors..")
-        else:
-            print("Min normalized total count a gene must have over all spots " \
-            "to be kept ({0}% of total) {1}".format(num_genes_keep, min_genes_spot_sum))
-            counts = counts[counts.sum(axis=1) >= min_genes_spot_var]
+        gene_stat = stats.gene_var
+        stat_name = "variance"
     else:
-        raise RunTimeError("Error, incorrect criteria method\n")  
-    print("Dropped {} genes".format(num_genes - len(counts.index)))
-    return counts.transpose()
+        gene_stat = stats.gene_sum
+        stat_name = "total count"
+    min_gene_stat = np.nanpercentile(gene_stat, num_genes_keep * 100)
+    if math.isnan(min_gene_stat):
+        print("Computed {} is NaN! Check your normalization factors..".format(stat_name))
+        return counts
+    print("Min normalized {0} a gene must have over all spots " \
+    "to be kept ({1}% of total) {2}".format(stat_name, num_genes_keep, min_gene_stat))
+    if isinstance(counts, SparseCounts):
+        counts = counts.take(cols=gene_stat >= min_gene_stat)
+    else:
+        counts = counts.loc[:,gene_stat >= min_gene_stat]
+    print("Dropped {} genes".format(num_genes - len(counts.columns)))
+    return counts
 
-def compute_size_factors(counts, normalization, scran_clusters=True):
+def compute_size_factors(counts, normalization, scran_clusters=True, use_cache=True):
     """ Helper function to compute normalization
-    size factors"""
-    counts = counts.transpose()
+    size factors. The size factors are stored in the on-disk 
+    cache (see stanalysis.cache) keyed by the content of the matrix
+    and the method so they are not computed again for the same matrix.
+    :param counts: a Pandas data frame (or a SparseCounts object) with the counts
+    :param normalization: the normalization method to use
+    :param scran_clusters: True to cluster the spots before computing Scran factors
+    :param use_cache: False to always compute the size factors
+    :return: the size factors (a vector)
+    """
+    cache_key = None
+    if use_cache and cache_enabled() and normalization != "RAW":
+        if isinstance(counts, SparseCounts):
+            arrays = [counts.matrix.indptr, counts.matrix.indices, counts.matrix.data]
+        else:
+            arrays = [counts.values]
+        cache_key = array_fingerprint(arrays, counts.shape, normalization, scran_clusters)
+        cached = cache_get("size_factors", cache_key, mmap=False)
+        if cached is not None and "size_factors" in cached:
+            return cached["size_factors"]
+    if isinstance(counts, SparseCounts):
+        # The native methods can use the sparse matrix directly
+        if normalization in ["DESeq2", "DESeq2PseudoCount", "DESeq2SizeAdjusted", 
+                             "TMM", "RLE", "REL", "RAW", "Scran"]:
+            counts = counts.matrix.transpose().tocsr()
+        else:
+            counts = counts.to_dataframe().transpose()
+    else:
+        counts = counts.transpose()
     if normalization in "DESeq2":
         size_factors = computeSizeFactors(counts)
     elif normalization in "DESeq2Linear":
         size_factors = computeSizeFactorsLinear(counts)
     elif normalization in "DESeq2PseudoCount":
-        size_factors = computeSizeFactors(counts + 1)
+        size_factors = estimateSizeFactorsForMatrix(counts, pseudo_count=1.0)
     elif normalization in "DESeq2SizeAdjusted":
         size_factors = computeSizeFactorsSizeAdjusted(counts)
     elif normalization in "TMM":
@@ -173,13 +662,13 @@ def compute_size_factors(counts, normalization, scran_clusters=True):
     elif normalization in "RLE":
         size_factors = computeRLEFactors(counts)
     elif normalization in "REL":
-        size_factors = counts.sum(axis=0)
+        size_factors = np.asarray(counts.sum(axis=0), dtype=np.float64).ravel()
     elif normalization in "RAW":
         size_factors = 1
     elif normalization in "Scran":
         size_factors = computeSumFactors(counts, scran_clusters)         
     else:
-        raise RunTimeError("Error, incorrect normalization method\n")
+        raise RuntimeError("Error, incorrect normalization method\n")
     if np.isnan(size_factors).any() or np.isinf(size_factors).any():
         print("Warning: Computed size factors contained NaN or Inf."
               "\nThey will be replaced by 1.0!")
@@ -189,29 +678,40 @@ def compute_size_factors(counts, normalization, scran_clusters=True):
         print("Warning: Computed size factors contained zeroes or negative values."
               "\nThey will be replaced by 1.0!")
         size_factors[size_factors <= 0.0] = 1.0     
+    if cache_key is not None:
+        cache_put("size_factors", cache_key, {"size_factors": size_factors})
     return size_factors
 
-def normalize_data(counts, normalization, center=False, adjusted_log=False):
+def normalize_data(counts, normalization, center=False, adjusted_log=False, use_cache=True):
     """This functions takes a data frame as input
     with ST data (genes as columns and spots as rows) and 
     returns a data frame with the normalized counts using
     different methods.
-    :param counts: a Pandas data frame with the counts
+    :param counts: a Pandas data frame (or a SparseCounts object) with the counts
     :param normalization: the normalization method to use
     :param center: if True the size factors will be centered by their mean
     :param adjusted_log: return adjusted logged normalized counts if True
     (DESeq2, DESeq2Linear, DESeq2PseudoCount, DESeq2SizeAdjusted,RLE, REL, RAW, TMM, Scran)
-    :return: a Pandas data frame with the normalized counts (genes as columns)
+    :param use_cache: False to compute the size factors even if they are in the cache
+    :return: a Pandas data frame (or SparseCounts object) with the normalized counts (genes as columns)
     """
     # Compute the size factors
-    size_factors = compute_size_factors(counts, normalization)
+    size_factors = compute_size_factors(counts, normalization, use_cache=use_cache)
     if np.all(size_factors == 1.0):
         return counts
-    # Spots as columns and genes as rows
-    counts = counts.transpose()
     # Center and/or adjust log the size_factors and counts
     if center: 
         size_factors = size_factors / np.mean(size_factors)
+    if isinstance(counts, SparseCounts):
+        if adjusted_log:
+            # The log counts keep the sparsity (genes as rows)
+            norm_counts = logCountsWithFactors(counts.matrix.transpose(), size_factors)
+            return SparseCounts(norm_counts.transpose().tocsr(), counts.index, counts.columns)
+        # Scale each spot (row) by its size factor keeping the sparsity
+        scale = sp.diags(1.0 / np.asarray(size_factors, dtype=np.float64))
+        return SparseCounts(scale.dot(counts.matrix), counts.index, counts.columns)
+    # Spots as columns and genes as rows
+    counts = counts.transpose()
     if adjusted_log:
         norm_counts = logCountsWithFactors(counts, size_factors)
     else:
@@ -228,45 +728,63 @@ def normalize_samples(counts, number_datasets):
     in each dataset to later compute normalization
     factors for each dataset using DESeq. Finally
     it will apply the factors to each dataset. 
-    :param counts: a Pandas dataframe conposed of several ST Datasets
+    :param counts: a Pandas dataframe (or a SparseCounts object) conposed of several ST Datasets
     :param number_datasets: the number of different datasets merged in the input data frame
     :return: the same dataframe as input with the counts normalized
     """
-    # First store the aggregated gene counts for each dataset in a dictionary
-    sample_counts = dict()
-    tot_spots = counts.index
-    for i in xrange(number_datasets):
-        spots_to_keep = [spot for spot in tot_spots if spot.startswith("{}_".format(i))]
-        slice_counts = counts.loc[spots_to_keep]
-        sample_counts[i] = slice_counts.sum(axis=0)
-        
-    # Now build up a data frame with the accumulated gene counts for
-    # each sample
-    per_sample_factors = pd.DataFrame(index=sample_counts.keys(), columns=counts.columns)
-    for key,value in sample_counts.iteritems():
-        per_sample_factors.loc[key] = value
-    # Replace Nan and Inf by zeroes
-    per_sample_factors.replace([np.inf, -np.inf], np.nan)
-    per_sample_factors.fillna(0.0, inplace=True)
+    # Dataset index of each spot
+    dataset_ids = parse_spots(counts.index)["dataset"].values
+    num_spots = len(dataset_ids)
     
-    # Spots are columns and genes are rows
-    per_sample_factors = per_sample_factors.transpose()
+    # Aggregate the gene counts of each dataset with one product 
+    # of a (datasets x spots) indicator matrix and the counts
+    indicator = sp.csr_matrix((np.ones(num_spots), (dataset_ids, np.arange(num_spots))),
+                              shape=(number_datasets, num_spots))
+    values = counts.matrix if isinstance(counts, SparseCounts) else counts.values
+    per_sample_counts = indicator.dot(values)
+    if sp.issparse(per_sample_counts):
+        per_sample_counts = per_sample_counts.toarray()
+    per_sample_counts = np.asarray(per_sample_counts, dtype=np.float64)
+    # Replace Nan and Inf by zeroes
+    per_sample_counts[~np.isfinite(per_sample_counts)] = 0.0
     
     # Compute normalization factors for each dataset(sample) using DESeq 
-    per_sample_size_factors = computeSizeFactors(per_sample_factors)
+    # (genes are rows and samples are columns)
+    per_sample_size_factors = computeSizeFactors(per_sample_counts.T)
     
     # Now use the factors per sample to normalize genes in each sample
     # one factor per sample so we divide every gene count of each sample by its factor
-    for spot in counts.index:
-        # spot is i_XxY
-        tokens = spot.split("x")
-        assert(len(tokens) == 2)
-        index = int(tokens[0].split("_")[0])
-        factor = per_sample_size_factors[index]
-        counts.loc[spot] = counts.loc[spot] / factor
+    spot_factors = per_sample_size_factors[dataset_ids]
+    if isinstance(counts, SparseCounts):
+        return SparseCounts(sp.diags(1.0 / spot_factors).dot(counts.matrix), 
+                            counts.index, counts.columns)
+    counts = pd.DataFrame(values / spot_factors[:,np.newaxis], 
+                          index=counts.index, columns=counts.columns)
         
     # Replace Nan and Inf by zeroes
-    counts.replace([np.inf, -np.inf], np.nan)
+    counts.replace([np.inf, -np.inf], np.nan, inplace=True)
     counts.fillna(0.0, inplace=True)
         
-    return counts
\ No newline at end of file
+    return counts
+
+def pseudo_bulk(counts, groups):
+    """ This function aggregates the spots of a ST data frame
+    (genes as columns and spots as rows) into pseudo-bulk samples
+    by summing the counts of the spots of each group (for instance 
+    each dataset or each region of each dataset) with one product
+    of a (groups x spots) indicator matrix and the counts.
+    :param counts: a Pandas dataframe (or a SparseCounts object) with the counts
+    :param groups: the group of each spot
+    :return: a Pandas dataframe with the summed counts (groups as rows
+    sorted by name and genes as columns)
+    """
+    names, group_ids = np.unique(np.asarray(groups, dtype=str), return_inverse=True)
+    num_spots = len(group_ids)
+    assert(num_spots == counts.shape[0])
+    indicator = sp.csr_matrix((np.ones(num_spots), (group_ids, np.arange(num_spots))),
+                              shape=(len(names), num_spots))
+    values = counts.matrix if isinstance(counts, SparseCounts) else counts.values
+    group_counts = indicator.dot(values)
+    if sp.issparse(group_counts):
+        group_counts = group_counts.toarray()
+    return pd.DataFrame(group_counts, index=names, columns=counts.columns)
@@ -0,0 +1,177 @@
+"""
+R session functions for the st analysis package.
+The R libraries are imported only once and their handles are cached,
+the BiocParallel backend is registered only once and the time spent
+converting data to/from R and computing in R is recorded.
+R libraries are never installed at call time.
+Matrices are transferred to R as a single numeric vector with
+dimensions (copying the data at most once) and R vectors are
+returned as NumPy views.
+rpy2 is imported only when R is used so the native methods
+of the package do not require R.
+"""
+import time
+import multiprocessing
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+# Default number of workers of the BiocParallel backend
+R_WORKERS = max(multiprocessing.cpu_count() - 1, 1)
+
+# Handles of the imported R libraries
+_libraries = dict()
+# Number of workers of the registered BiocParallel backend (None if not registered)
+_registered_workers = None
+# Accumulated time (in seconds) spent in each category
+_timings = {"import": 0.0, "conversion": 0.0, "compute": 0.0}
+
+def RimportLibrary(lib_name):
+    """ Helper function to import R libraries
+    using the rpy2 binder. The library is imported
+    only the first time, after that the cached handle is returned.
+    :param lib_name: the name of the R library
+    :return: the rpy2 handle of the library
+    :raises: RuntimeError if rpy2 or the library are not installed
+    """
+    if lib_name not in _libraries:
+        with Rtimer("import"):
+            try:
+                import rpy2.robjects.packages as rpackages
+            except ImportError:
+                raise RuntimeError("Error, the R library {} requires the package rpy2 " \
+                                   "(see README)\n".format(lib_name))
+            if not rpackages.isinstalled(lib_name):
+                raise RuntimeError("Error, the R library {} is not installed. " \
+                                   "Install it with Bioconductor (see README)\n".format(lib_name))
+            _libraries[lib_name] = rpackages.importr(lib_name)
+    return _libraries[lib_name]
+
+def RregisterParallel(workers=None):
+    """ Registers the BiocParallel multicore backend. The backend
+    is only registered again if the number of workers changes.
+    :param workers: the number of workers (default R_WORKERS)
+    """
+    global _registered_workers
+    workers = R_WORKERS if workers is None else max(int(workers), 1)
+    if _registered_workers != workers:
+        multicore = RimportLibrary("BiocParallel")
+        with Rtimer("import"):
+            multicore.register(multicore.MulticoreParam(workers))
+        _registered_workers = workers
+
+def Rinitialize(libraries=("DESeq2", "edgeR", "scran", "Rtsne"), workers=None):
+    """ Imports the given R libraries and registers the
+    parallel backend upfront so the first call to an
+    R function does not pay for it (useful in batch jobs).
+    :param libraries: the names of the R libraries to import
+    :param workers: the number of workers of the parallel backend (default R_WORKERS)
+    """
+    for lib_name in libraries:
+        RimportLibrary(lib_name)
+    RregisterParallel(workers)
+
+@contextmanager
+def Rtimer(category):
+    """ Context manager that adds the time spent in
+    the block to the given category (import, conversion or compute)
+    :param category: the name of the category
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        _timings[category] = _timings.get(category, 0.0) + time.time() - start
+
+def RgetTimings():
+    """ Returns a dictionary with the accumulated time (seconds)
+    spent importing R libraries, converting data to/from R and
+    computing in R.
+    """
+    return dict(_timings)
+
+def RresetTimings():
+    """ Resets the accumulated timings
+    """
+    for category in _timings:
+        _timings[category] = 0.0
+
+def Rmatrix(counts, rownames=None, colnames=None):
+    """ Converts a matrix to an R matrix (numeric or integer) with dimnames.
+    The data is copied once into a single R vector (instead of one R vector 
+    per column as when converting a data frame) and the R dimensions
+    are set on it directly. Sparse matrices are made dense directly with
+    the R type and memory layout (column major).
+    :param counts: a Pandas data frame, a numpy array or a scipy sparse matrix
+    :param rownames: the row names (default the index of the data frame)
+    :param colnames: the column names (default the columns of the data frame)
+    :return: the R matrix
+    """
+    if isinstance(counts, pd.DataFrame):
+        rownames = counts.index if rownames is None else rownames
+        colnames = counts.columns if colnames is None else colnames
+        counts = counts.values
+    import rpy2.rinterface as ri
+    import rpy2.robjects as robjects
+    with Rtimer("conversion"):
+        if not sp.issparse(counts):
+            counts = np.asarray(counts)
+        # Integer matrices are kept as integers if they fit in an R integer
+        stored = counts.data if sp.issparse(counts) else counts
+        if counts.dtype.kind in "iub" and (stored.size == 0 or
+                                           np.abs(stored).max() < np.iinfo(np.int32).max):
+            dtype, sexp_type = np.int32, ri.IntSexpVector
+        else:
+            dtype, sexp_type = np.float64, ri.FloatSexpVector
+        # The matrix is made dense/cast directly into column major
+        # order with the R type (no copy if it already is)
+        if sp.issparse(counts):
+            values = counts.astype(dtype).toarray(order="F")
+        else:
+            values = np.asfortranarray(counts, dtype=dtype)
+        # Column major order is the memory layout of R matrices (no copy here)
+        flat = values.ravel(order="F")
+        try:
+            r_values = sexp_type.from_memoryview(memoryview(flat))
+        except AttributeError:
+            # rpy2 < 3.0
+            r_values = ri.SexpVector(flat, ri.INTSXP if sexp_type is ri.IntSexpVector else ri.REALSXP)
+        r_values.do_slot_assign("dim", ri.IntSexpVector(values.shape))
+        if rownames is not None or colnames is not None:
+            dimnames = [ri.NULL if names is None else ri.StrSexpVector([str(x) for x in names]) 
+                        for names in (rownames, colnames)]
+            r_values.do_slot_assign("dimnames", ri.ListSexpVector(dimnames))
+        return robjects.conversion.ri2ro(r_values) if hasattr(robjects.conversion, "ri2ro") \
+            else robjects.conversion.rpy2py(r_values)
+
+def Rnumpy(r_values):
+    """ Returns a numeric R vector or matrix as a numpy array that 
+    is a view of the R memory (no copy). Matrices keep their 
+    dimensions (column major order).
+    Note that the view is only valid while the R object exists.
+    :param r_values: an R vector or matrix (numeric or integer)
+    :return: a numpy array
+    """
+    with Rtimer("conversion"):
+        try:
+            values = np.asarray(r_values.memoryview())
+        except AttributeError:
+            # rpy2 < 3.0 exposes the numpy array interface
+            values = np.asarray(r_values)
+        if values.ndim == 1 and "dim" in list(r_values.list_attrs()):
+            values = values.reshape(tuple(r_values.do_slot("dim")), order="F")
+        return values
+
+def RdataFrame(r_data_frame):
+    """ Converts an R data frame of numeric columns to a Pandas
+    data frame using numpy views of each column.
+    :param r_data_frame: an R data frame
+    :return: a Pandas data frame (with the R row names as index)
+    """
+    import rpy2.robjects as robjects
+    columns = list(r_data_frame.names)
+    rownames = list(robjects.r["rownames"](r_data_frame))
+    return pd.DataFrame(dict((name, Rnumpy(column)) for name, column 
+                             in zip(columns, r_data_frame)), 
+                        index=rownames, columns=columns)
@@ -28,9 +28,9 @@ def volcano(dea_results, fdr, outfile):
     colors = ["red" if p <= fdr else "blue" for p in dea_results["padj"]]
     x_points = dea_results["log2FoldChange"]
     y_points = -np.log10(dea_results["pvalue"])
-    x_points_conf = dea_results.ix[dea_results["padj"] <= fdr]["log2FoldChange"]
-    y_points_conf = -np.log10(dea_results.ix[dea_results["padj"] <= fdr]["pvalue"])
-    names_conf = dea_results.ix[dea_results["padj"] <= fdr].index
+    x_points_conf = dea_results.loc[dea_results["padj"] <= fdr]["log2FoldChange"]
+    y_points_conf = -np.log10(dea_results.loc[dea_results["padj"] <= fdr]["pvalue"])
+    names_conf = dea_results.loc[dea_results["padj"] <= fdr].index
     # Scale axes
     OFFSET = 0.1
     a.set_xlim([min(x_points) - OFFSET, max(x_points) + OFFSET])
@@ -42,6 +42,7 @@ def volcano(dea_results, fdr, outfile):
     for x,y,text in zip(x_points_conf,y_points_conf,names_conf):
         a.text(x,y,text,size="x-small")
     fig.savefig(outfile, dpi=300)
+    plt.close(fig)
     
 def histogram(x_points, output, title="Histogram", xlabel="X", color="blue"):
     """ This function generates a simple density histogram
@@ -0,0 +1,40 @@
+"""
+The comparisons of the native DEA engine (scripts/differential_analysis.py)
+are processed in worker processes that receive the fitted model when they
+start, so they must also work with the spawn start method (macOS, Windows)
+"""
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+sys.path.insert(0, SCRIPTS_DIR)
+
+import differential_analysis
+from stanalysis.dea import fitNegativeBinomial
+
+@pytest.fixture(scope="module")
+def dea_fit():
+    random = np.random.RandomState(0)
+    conds = ["A"] * 10 + ["B"] * 10 + ["C"] * 10
+    means = random.gamma(2.0, 10.0, size=(30, 1)) * np.repeat([1.0, 2.0, 0.5], 10)
+    counts = pd.DataFrame(random.poisson(means),
+                          index=["gene{}".format(i) for i in range(30)],
+                          columns=["{}x1".format(i) for i in range(30)])
+    return fitNegativeBinomial(counts, conds, n_jobs=1, use_cache=False)
+
+@pytest.mark.parametrize("num_workers, start_method", [(1, None), (2, "spawn")])
+def test_process_comparisons(dea_fit, tmp_path, num_workers, start_method):
+    comparisons = [("A", "B"), ("A", "C"), ("B", "C")]
+    tasks = [(comp, None, 0.05, str(tmp_path)) for comp in comparisons]
+    timings = differential_analysis.process_comparisons(tasks, dea_fit, num_workers=num_workers,
+                                                        start_method=start_method)
+    assert [comp for comp, _ in timings] == comparisons
+    for A, B in comparisons:
+        results = pd.read_csv(os.path.join(str(tmp_path), "dea_results_{}_vs_{}.tsv".format(A, B)),
+                              sep="\t", index_col=0)
+        assert len(results.index) > 0
+        assert os.path.isfile(os.path.join(str(tmp_path), "filtered_dea_results_{}_vs_{}.tsv".format(A, B)))
+        assert os.path.isfile(os.path.join(str(tmp_path), "volcano_{}_vs_{}.pdf".format(A, B)))
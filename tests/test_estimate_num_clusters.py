@@ -0,0 +1,34 @@
+"""
+The labels returned by estimate_num_clusters_hierarchical() are the
+clusters of AgglomerativeClustering (Ward) with the same connectivity
+"""
+import numpy as np
+import pytest
+from sklearn.cluster import AgglomerativeClustering
+from sklearn.metrics import adjusted_rand_score
+
+from stanalysis.analysis import estimate_num_clusters_hierarchical
+from stanalysis.neighbors import knn_graph
+
+@pytest.fixture(scope="module")
+def data():
+    random = np.random.RandomState(0)
+    centers = np.array([[0.0, 0.0], [6.0, 0.0], [0.0, 6.0], [6.0, 6.0]])
+    return np.vstack([random.randn(50, 2) + center for center in centers])
+
+@pytest.mark.parametrize("num_clusters", [2, 4, 6])
+def test_cuts_match_agglomerative_clustering(data, num_clusters):
+    graph = knn_graph(data, n_neighbors=15)
+    chosen, labels = estimate_num_clusters_hierarchical(data, connectivity=graph,
+                                                        min_clusters=num_clusters,
+                                                        max_clusters=num_clusters)
+    expected = AgglomerativeClustering(n_clusters=num_clusters, connectivity=graph,
+                                       linkage="ward").fit_predict(data)
+    assert chosen == num_clusters
+    assert adjusted_rand_score(expected, labels) == 1.0
+
+def test_estimates_the_number_of_clusters(data):
+    num_clusters, labels = estimate_num_clusters_hierarchical(data, connectivity=knn_graph(data, 15),
+                                                              max_clusters=8)
+    assert num_clusters == 4
+    assert len(np.unique(labels)) == 4
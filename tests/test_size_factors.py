@@ -0,0 +1,33 @@
+"""
+Native DESeq2 size factors (compute_size_factors()) of a small matrix
+of counts against reference values in tests/data. The reference values
+were computed with a direct transcription of
+DESeq2::estimateSizeFactorsForMatrix() (median of the ratios to the
+geometric means of the genes without zeroes), not with R; they can be
+replaced by the output of DESeq2 with tests/data/record_size_factors.R
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from stanalysis.preprocessing import SparseCounts, compute_size_factors
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+@pytest.fixture(scope="module")
+def counts():
+    return pd.read_csv(os.path.join(DATA_DIR, "size_factors_counts.tsv"), sep="\t", index_col=0)
+
+@pytest.fixture(scope="module")
+def reference():
+    return pd.read_csv(os.path.join(DATA_DIR, "size_factors_reference.tsv"), sep="\t", index_col=0)
+
+@pytest.mark.parametrize("normalization", ["DESeq2", "DESeq2PseudoCount", "DESeq2SizeAdjusted"])
+@pytest.mark.parametrize("sparse", [False, True])
+def test_compute_size_factors_matches_reference(counts, reference, normalization, sparse):
+    if sparse:
+        counts = SparseCounts(counts.values, counts.index, counts.columns)
+    size_factors = compute_size_factors(counts, normalization, use_cache=False)
+    assert np.allclose(size_factors, reference.loc[counts.index, normalization].values,
+                       rtol=1e-10, atol=0.0)